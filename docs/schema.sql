@@ -3,3 +3,38 @@
 -- still needs work
 
 INSERT INTO channels (name) VALUES ('container');
+
+-- Decaying counters of recent container builds per owner and per package,
+-- used by fair share priorities of hub plugin (see hub_containerbuild.conf).
+-- usage is the count at time updated, it halves every half_life seconds.
+-- Counters are updated by INSERT ... ON CONFLICT, PostgreSQL 9.5 or newer is
+-- needed.
+CREATE TABLE container_build_usage (
+	kind TEXT NOT NULL CHECK (kind IN ('owner', 'package')),
+	name TEXT NOT NULL,
+	usage DOUBLE PRECISION NOT NULL DEFAULT 0,
+	updated TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+	PRIMARY KEY (kind, name)
+) WITHOUT OIDS;
+
+-- Finished container build tasks, recorded by hub plugin when its
+-- [container_builds] section is enabled, queried by listContainerBuilds.
+-- component and scm_commit are known only for successful builds.
+CREATE TABLE container_builds (
+	task_id INTEGER NOT NULL PRIMARY KEY REFERENCES task(id),
+	component TEXT,
+	target TEXT NOT NULL,
+	source TEXT NOT NULL,
+	scm_commit TEXT,
+	owner INTEGER NOT NULL REFERENCES users(id),
+	state INTEGER NOT NULL,
+	scratch BOOLEAN NOT NULL,
+	koji_build_id INTEGER REFERENCES build(id),
+	completed TIMESTAMPTZ NOT NULL
+) WITHOUT OIDS;
+-- task_id last, pages are walked by task_id within the other columns
+CREATE INDEX container_builds_by_component ON container_builds(component, target, task_id);
+CREATE INDEX container_builds_by_target ON container_builds(target, task_id);
+CREATE INDEX container_builds_by_commit ON container_builds(scm_commit);
+CREATE INDEX container_builds_by_owner ON container_builds(owner, task_id);
+CREATE INDEX container_builds_by_state ON container_builds(state, task_id);
@@ -87,8 +87,12 @@ rm -rf $RPM_BUILD_ROOT
 %{__install} -p -m 0755 cli/koji-containerbuild $RPM_BUILD_ROOT%{_bindir}/koji-containerbuild
 %{__install} -d $RPM_BUILD_ROOT%{_prefix}/lib/koji-hub-plugins
 %{__install} -p -m 0644 %{module}/plugins/hub_containerbuild.py $RPM_BUILD_ROOT%{_prefix}/lib/koji-hub-plugins/hub_containerbuild.py
+%{__install} -d $RPM_BUILD_ROOT%{_sysconfdir}/koji-hub/plugins
+%{__install} -p -m 0644 %{module}/plugins/hub_containerbuild.conf $RPM_BUILD_ROOT%{_sysconfdir}/koji-hub/plugins/hub_containerbuild.conf
 %{__install} -d $RPM_BUILD_ROOT%{_prefix}/lib/koji-builder-plugins
 %{__install} -p -m 0644 %{module}/plugins/builder_containerbuild.py $RPM_BUILD_ROOT%{_prefix}/lib/koji-builder-plugins/builder_containerbuild.py
+%{__install} -d $RPM_BUILD_ROOT%{_sysconfdir}/kojid/plugins
+%{__install} -p -m 0644 %{module}/plugins/builder_containerbuild.conf $RPM_BUILD_ROOT%{_sysconfdir}/kojid/plugins/builder_containerbuild.conf
 
 
 %files
@@ -104,9 +108,11 @@ rm -rf $RPM_BUILD_ROOT
 
 %files hub
 %{_prefix}/lib/koji-hub-plugins/hub_containerbuild.py*
+%config(noreplace) %{_sysconfdir}/koji-hub/plugins/hub_containerbuild.conf
 
 %files builder
 %{_prefix}/lib/koji-builder-plugins/builder_containerbuild.py*
+%config(noreplace) %{_sysconfdir}/kojid/plugins/builder_containerbuild.conf
 
 %clean
 rm -rf $RPM_BUILD_ROOT
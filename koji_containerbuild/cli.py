@@ -21,9 +21,21 @@
 #       Pavol Babincak <pbabinca@redhat.com>
 
 import os
+import sys
+import json
+import time
+import zlib
+import base64
+import koji
 from koji import _
 from optparse import OptionParser
 
+# YAML manifests are supported only with PyYAML installed
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 # Koji API has changed - activate_session requires two arguments
 # _running_in_bg has been moved to koji_cli.lib
 # parse_arches has been added to koji_cli.lib
@@ -54,6 +66,25 @@ clikoji = None
 # matches hub's buildContainer parameter channel
 DEFAULT_CHANNEL = 'container'
 
+# Keys of builds in chain file, see load_chain
+CHAIN_REQUIRED_KEYS = ('name', 'target', 'source', 'git_branch')
+CHAIN_OPTIONAL_KEYS = ('parent', 'koji_parent_build', 'yum_repourls', 'release',
+                       'epoch')
+
+# Keys of builds in batch manifest, see load_batch
+BATCH_REQUIRED_KEYS = ('target', 'source', 'git_branch')
+BATCH_OPTIONAL_KEYS = ('name', 'scratch', 'isolated', 'arch_override', 'yum_repourls',
+                       'release', 'epoch', 'koji_parent_build')
+
+# Exit codes of builds in batch summary
+BATCH_EXIT_CODES = {
+    'CLOSED': 0,
+    'FAILED': 1,
+    'CANCELED': 2,
+    'invalid': 3,
+    'submit_failed': 4,
+}
+
 
 def print_value(value, level, indent, suffix=''):
     offset = ' ' * level * indent
@@ -72,15 +103,286 @@ def print_result(result, level=0, indent=2):
         print_value(result, level, indent)
 
 
-def print_task_result(task_id, result, weburl):
+def result_with_urls(result, weburl):
+    """Returns task result with URLs of koji builds instead of their IDs"""
     try:
+        result = dict(result)
         result["koji_builds"] = ["%s/buildinfo?buildID=%s" % (weburl, build_id)
                                  for build_id in result.get("koji_builds", [])]
-    except TypeError:
+    except (TypeError, ValueError):
         pass
+    return result
 
+
+def print_task_result(task_id, result, weburl):
     print "Task Result (%s):" % task_id
-    print_result(result)
+    print_result(result_with_urls(result, weburl))
+
+
+# Formats of --output
+OUTPUT_FORMATS = ('text', 'json', 'jsonl')
+
+
+def emit_event(event, out=None, **fields):
+    """Print event as a line of JSON (for --output jsonl)"""
+    out = out or sys.stdout
+    fields['event'] = event
+    out.write(json.dumps(fields, sort_keys=True) + '\n')
+    out.flush()
+
+
+FINISHED_STATES = ('CLOSED', 'FAILED', 'CANCELED')
+
+# Most tasks hub's getContainerTaskStates takes at once
+TASK_STATES_MAX_TASKS = 1000
+
+
+class TaskWatcher(object):
+    """Watches tasks with one multicall per round
+
+    States of tasks are asked for by getContainerTaskStates of the hub
+    plugin, which returns only tasks that changed since the previous round.
+    Hubs without it are asked for info of each task. Results of tasks (or
+    errors of failed ones) of tasks which were open in the previous round
+    are requested in the same multicall as their state. Tasks which finish
+    without being seen open get their results by another multicall in the
+    same round. Interval between rounds grows with age of the youngest
+    unfinished task, long builds are checked less often.
+    """
+
+    def __init__(self, session, min_interval=2.0, max_interval=60.0, backoff=0.1):
+        self.session = session
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.tasks = {}
+        self.task_states = True
+        self._since = None
+
+    def add(self, task_id):
+        self.tasks[task_id] = {'state': None, 'create_ts': None, 'done': False,
+                               'result': None, 'error': None}
+
+    def state(self, task_id):
+        return self.tasks[task_id]['state']
+
+    def result(self, task_id):
+        return self.tasks[task_id]['result']
+
+    def error(self, task_id):
+        return self.tasks[task_id]['error']
+
+    def unfinished(self):
+        return sorted(task_id for task_id, task in self.tasks.items()
+                      if not task['done'])
+
+    def _update(self, task_id, info, changed):
+        task = self.tasks[task_id]
+        task['create_ts'] = info.get('create_ts')
+        state = koji.TASK_STATES[info['state']]
+        if state != task['state']:
+            changed.append(task_id)
+        task['state'] = state
+
+    def poll(self):
+        """Check unfinished tasks, returns IDs of tasks which changed state"""
+        unfinished = self.unfinished()
+        watched = [task_id for task_id in unfinished
+                   if self.tasks[task_id]['state'] not in FINISHED_STATES]
+        calls = []
+        task_states = self.task_states
+        self.session.multicall = True
+        if task_states:
+            since = self._since
+            if any(self.tasks[task_id]['state'] is None for task_id in watched):
+                # new tasks, their state is needed even if it didn't change
+                since = None
+            for i in range(0, len(watched), TASK_STATES_MAX_TASKS):
+                self.session.getContainerTaskStates(
+                    watched[i:i + TASK_STATES_MAX_TASKS], since)
+                calls.append((None, 'states'))
+        else:
+            for task_id in watched:
+                self.session.getTaskInfo(task_id)
+                calls.append((task_id, 'info'))
+        for task_id in unfinished:
+            if self.tasks[task_id]['state'] in ('OPEN',) + FINISHED_STATES:
+                self.session.getTaskResult(task_id)
+                calls.append((task_id, 'result'))
+        responses = self.session.multiCall(strict=False)
+
+        changed = []
+        cursors = []
+        for (task_id, kind), response in zip(calls, responses):
+            if kind == 'states':
+                if isinstance(response, dict):
+                    # hub without the plugin call
+                    self.task_states = False
+                    continue
+                cursors.append(response[0]['ts'])
+                for info in response[0]['tasks']:
+                    self._update(info['id'], info, changed)
+            elif kind == 'info':
+                if isinstance(response, dict):
+                    raise koji.GenericError(response['faultString'])
+                self._update(task_id, response[0], changed)
+            elif self.tasks[task_id]['state'] in FINISHED_STATES:
+                # state came before the result in the same batch
+                self._set_result(task_id, response)
+        if task_states and not self.task_states:
+            # states weren't checked this round, ask for info of each task
+            return changed + self.poll()
+        if cursors:
+            self._since = min(cursors)
+        missing = [task_id for task_id in watched
+                   if self.tasks[task_id]['state'] is None]
+        if missing:
+            raise koji.GenericError('No such task: %s' % missing[0])
+        finished = [task_id for task_id in changed
+                    if self.tasks[task_id]['state'] in FINISHED_STATES and
+                    not self.tasks[task_id]['done']]
+        if finished:
+            # finished without being seen open, results are needed now
+            self.session.multicall = True
+            for task_id in finished:
+                self.session.getTaskResult(task_id)
+            responses = self.session.multiCall(strict=False)
+            for task_id, response in zip(finished, responses):
+                self._set_result(task_id, response)
+        return changed
+
+    def _set_result(self, task_id, response):
+        task = self.tasks[task_id]
+        if isinstance(response, dict):
+            task['error'] = response['faultString']
+        else:
+            task['result'] = response[0]
+        task['done'] = True
+
+    def interval(self):
+        """Seconds to wait before next round"""
+        unfinished = [self.tasks[task_id] for task_id in self.unfinished()]
+        ages = [time.time() - task['create_ts'] for task in unfinished
+                if task['create_ts']]
+        age = min(ages) if ages else 0
+        return min(max(age * self.backoff, self.min_interval), self.max_interval)
+
+    def wait(self, report=None):
+        """Poll until all tasks finish, report is called with changed tasks"""
+        while True:
+            changed = self.poll()
+            if report:
+                report(changed)
+            if not self.unfinished():
+                return
+            time.sleep(self.interval())
+
+
+# Summary of logs uploaded by failed container build task
+FAILURE_TAIL_LOG = 'failure-tail.log'
+
+# Logs uploaded by container build task which --follow-logs doesn't show
+LOGS_NOT_FOLLOWED = ('osbs-client.log', 'checkout-for-labels.log', FAILURE_TAIL_LOG)
+
+
+class LogFollower(object):
+    """Prints content of OSBS logs uploaded by a task as they grow
+
+    Only new bytes of each log are downloaded, at most chunk_size at once.
+    Lines are prefixed by name of their log (platform), or passed to on_line
+    with it. Compressed logs
+    (.log.gz) are decompressed as they come. Memory use doesn't depend on
+    size of logs.
+    """
+
+    def __init__(self, session, task_id, out=sys.stdout, chunk_size=1048576,
+                 on_line=None):
+        self.session = session
+        self.task_id = task_id
+        self.out = out
+        self.chunk_size = chunk_size
+        self.on_line = on_line or self._print_line
+        self._offsets = {}
+        self._partial = {}
+        self._decompressors = {}
+
+    def _followed(self, fname):
+        if fname in LOGS_NOT_FOLLOWED:
+            return False
+        return fname.endswith('.log') or fname.endswith('.log.gz')
+
+    def _write(self, fname, data, final=False):
+        prefix = fname.split('.', 1)[0]
+        data = self._partial.pop(fname, '') + data
+        lines = data.split('\n')
+        rest = lines.pop()
+        if rest and (final or len(rest) >= self.chunk_size):
+            # don't keep unterminated line forever
+            lines.append(rest)
+            rest = ''
+        if rest:
+            self._partial[fname] = rest
+        for line in lines:
+            self.on_line(prefix, line)
+
+    def _print_line(self, prefix, line):
+        self.out.write('[%s] %s\n' % (prefix, line))
+
+    def _reset(self, fname):
+        self._offsets.pop(fname, None)
+        self._partial.pop(fname, None)
+        self._decompressors.pop(fname, None)
+
+    def _decompress(self, fname, data):
+        if fname not in self._decompressors:
+            self._decompressors[fname] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressor = self._decompressors[fname]
+        data = decompressor.decompress(data)
+        if decompressor.unused_data:
+            # the old stream was finished, more bytes are from a new one
+            raise zlib.error('data after end of compressed stream')
+        return data
+
+    def poll(self, final=False):
+        """Print what was uploaded since last poll, all of it when final"""
+        files = self.session.listTaskOutput(self.task_id, stat=True)
+        for fname in sorted(files):
+            if not self._followed(fname):
+                continue
+            size = int(files[fname]['st_size'])
+            offset = self._offsets.get(fname, 0)
+            if size < offset:
+                # log was rewritten from the beginning (e.g. compressed
+                # again), state of the old content is of no use
+                self._reset(fname)
+                offset = 0
+            restarted = False
+            while offset < size:
+                chunk = min(self.chunk_size, size - offset)
+                data = base64.b64decode(self.session.downloadTaskOutput(
+                    self.task_id, fname, offset=offset, size=chunk))
+                if not data:
+                    break
+                downloaded = len(data)
+                if fname.endswith('.gz'):
+                    try:
+                        data = self._decompress(fname, data)
+                    except zlib.error:
+                        # compressed again from the beginning past the old
+                        # offset, bytes don't continue the old stream
+                        self._reset(fname)
+                        offset = 0
+                        if restarted:
+                            # rewritten again meanwhile, try next time
+                            break
+                        restarted = True
+                        continue
+                offset += downloaded
+                self._write(fname, data)
+            self._offsets[fname] = offset
+            if final and fname in self._partial:
+                self._write(fname, '', final=True)
+        self.out.flush()
 
 
 def parse_arguments(options, args, flatpak):
@@ -101,6 +403,9 @@ def parse_arguments(options, args, flatpak):
     if not flatpak:
         parser.add_option("--isolated", action="store_true",
                           help=_("Perform an isolated build"))
+    parser.add_option("--reuse-scratch", action="store_true",
+                      help=_("Requires --scratch. Reuse result of an identical "
+                             "recent scratch build if there's one"))
     parser.add_option("--arch-override",
                       help=_("Requires --scratch. Limit a scratch build to "
                              "the specified arches. Comma or space separated."))
@@ -109,6 +414,12 @@ def parse_arguments(options, args, flatpak):
                              "background"))
     parser.add_option("--nowait", action="store_false", dest="wait",
                       help=_("Don't wait on build"))
+    parser.add_option("--follow-logs", action="store_true",
+                      help=_("Print logs of the build while waiting on it"))
+    parser.add_option("--output", type="choice", choices=OUTPUT_FORMATS,
+                      default="text",
+                      help=_("Output format: text, json (result at the end) or "
+                             "jsonl (events as they happen) [default: %default]"))
     parser.add_option("--quiet", action="store_true",
                       help=_("Do not print the task information"),
                       default=options.quiet)
@@ -140,6 +451,16 @@ def parse_arguments(options, args, flatpak):
     if build_opts.arch_override and not build_opts.scratch:
         parser.error(_("--arch-override is only allowed for --scratch builds"))
 
+    if build_opts.follow_logs:
+        if build_opts.wait is False:
+            parser.error(_("--follow-logs can't be used with --nowait"))
+        build_opts.wait = True
+        if build_opts.output == 'json':
+            parser.error(_("--follow-logs can't be used with --output json"))
+
+    if build_opts.reuse_scratch and not build_opts.scratch:
+        parser.error(_("--reuse-scratch is only allowed for --scratch builds"))
+
     opts = {}
     if not build_opts.git_branch:
         parser.error(_("git-branch must be specified"))
@@ -160,6 +481,9 @@ def parse_arguments(options, args, flatpak):
     if build_opts.arch_override:
         opts['arch_override'] = parse_arches(build_opts.arch_override)
 
+    if build_opts.reuse_scratch:
+        opts['reuse_scratch'] = True
+
     for key in keys:
         val = getattr(build_opts, key)
         if val is not None:
@@ -181,13 +505,13 @@ def handle_build(options, session, args, flatpak):
     else:
         build_target = session.getBuildTarget(target)
         if not build_target:
-            parser.error(_("Unknown build target: %s" % target))
+            parser.error(_("Unknown build target: %s") % target)
         dest_tag = session.getTag(build_target['dest_tag'])
         if not dest_tag:
             parser.error(_("Unknown destination tag: %s" %
                            build_target['dest_tag_name']))
         if dest_tag['locked'] and not build_opts.scratch:
-            parser.error(_("Destination tag %s is locked" % dest_tag['name']))
+            parser.error(_("Destination tag %s is locked") % dest_tag['name'])
     source = args[1]
 
     priority = None
@@ -200,24 +524,573 @@ def handle_build(options, session, args, flatpak):
         parser.error(_("scm URL must be of the form <url_to_repository>#<revision>)"))
     task_id = session.buildContainer(source, target, opts, priority=priority,
                                      channel=build_opts.channel_override)
-    if not build_opts.quiet:
+    task_url = "%s/taskinfo?taskID=%s" % (options.weburl, task_id)
+    text = build_opts.output == 'text'
+    if build_opts.output == 'jsonl':
+        emit_event('created', task_id=task_id, url=task_url)
+    elif text and not build_opts.quiet:
         print "Created task:", task_id
-        print "Task info: %s/taskinfo?taskID=%s" % (options.weburl, task_id)
-    if build_opts.wait or (build_opts.wait is None and not _running_in_bg()):
-        session.logout()
-        rv = clikoji.watch_tasks(session, [task_id], quiet=build_opts.quiet)
+        print "Task info: %s" % task_url
+    if not (build_opts.wait or (build_opts.wait is None and not _running_in_bg())):
+        if build_opts.output == 'json':
+            print json.dumps({'task_id': task_id, 'url': task_url}, sort_keys=True)
+        return
+
+    session.logout()
+    follower = None
+    if build_opts.follow_logs:
+        on_line = None
+        if not text:
+            def on_line(log, line):
+                emit_event('log', task_id=task_id, log=log, line=line)
+        follower = LogFollower(session, task_id, on_line=on_line)
+        # logs should show up soon even for long builds
+        watcher = TaskWatcher(session, max_interval=5)
+    else:
+        watcher = TaskWatcher(session)
+    watcher.add(task_id)
 
-        # Task completed and a result should be available.
+    def report(changed):
+        if changed:
+            if build_opts.output == 'jsonl':
+                emit_event('state', task_id=task_id, state=watcher.state(task_id))
+            elif text and not build_opts.quiet:
+                if watcher.error(task_id):
+                    # fault of the task carries failure class and log tail
+                    print "%s: %s: %s" % (task_id, watcher.state(task_id),
+                                          watcher.error(task_id))
+                else:
+                    print "%s: %s" % (task_id, watcher.state(task_id))
+        if follower:
+            follower.poll(final=not watcher.unfinished())
+    try:
+        watcher.wait(report)
+    except KeyboardInterrupt:
+        if text:
+            print "Task still running. You can continue to watch with the " \
+                  "'koji watch-task' command."
+        return 1
+    rv = 0 if watcher.state(task_id) == 'CLOSED' else 1
+    failure_summary = None
+    if rv != 0 and (not text or not build_opts.quiet):
+        # tasks which failed before the build started don't upload it
+        if FAILURE_TAIL_LOG in session.listTaskOutput(task_id):
+            failure_summary = "%s/getfile?taskID=%s&name=%s" % (
+                options.weburl, task_id, FAILURE_TAIL_LOG)
+
+    if not text:
+        final = {'task_id': task_id, 'url': task_url, 'state': watcher.state(task_id)}
         if rv == 0:
-            result = session.getTaskResult(task_id)
-            print_task_result(task_id, result, options.weburl)
+            final['result'] = result_with_urls(watcher.result(task_id), options.weburl)
+        else:
+            final['error'] = watcher.error(task_id)
+            if failure_summary:
+                final['failure_summary'] = failure_summary
+        if build_opts.output == 'jsonl':
+            emit_event('result', **final)
+        else:
+            print json.dumps(final, sort_keys=True)
+    # Task completed and the result was fetched with its state.
+    elif rv == 0:
+        print_task_result(task_id, watcher.result(task_id), options.weburl)
+    elif failure_summary:
+        print "Failure summary: %s" % failure_summary
+
+    return rv
 
-        return rv
-    else:
-        return
 
 def handle_container_build(options, session, args):
     return handle_build(options, session, args, flatpak=False)
 
 def handle_flatpak_build(options, session, args):
     return handle_build(options, session, args, flatpak=True)
+
+
+def load_manifest(path):
+    """Load list of builds from JSON or YAML (.yaml or .yml) file
+
+    Raises ValueError if it isn't a list.
+    """
+    with open(path) as f:
+        if os.path.splitext(path)[1] in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ValueError("PyYAML is needed to read YAML files")
+            try:
+                builds = yaml.safe_load(f)
+            except yaml.YAMLError, error:
+                raise ValueError(str(error))
+        else:
+            builds = json.load(f)
+    if not isinstance(builds, list):
+        raise ValueError("File must contain a list of builds")
+    return builds
+
+
+def load_chain(path):
+    """Load chain of layered builds from JSON or YAML file
+
+    File contains list of builds, each with name, target, source and
+    git_branch. Build with parent (name of another build in the file) is
+    started once its parent's koji build exists, with koji_parent_build set
+    to it.
+
+    Returns list of builds with parents before their children. Raises
+    ValueError if the chain isn't valid.
+    """
+    builds = load_manifest(path)
+
+    by_name = {}
+    for build in builds:
+        if not isinstance(build, dict):
+            raise ValueError("Build must be an object: %r" % (build,))
+        missing = [key for key in CHAIN_REQUIRED_KEYS if not build.get(key)]
+        if missing:
+            raise ValueError("Build %r is missing %s" % (build.get('name'),
+                                                         ', '.join(missing)))
+        unknown = set(build) - set(CHAIN_REQUIRED_KEYS + CHAIN_OPTIONAL_KEYS)
+        if unknown:
+            raise ValueError("Build %s has unknown keys: %s" %
+                             (build['name'], ', '.join(sorted(unknown))))
+        if build['name'] in by_name:
+            raise ValueError("Duplicate build name: %s" % build['name'])
+        if build.get('parent') and build.get('koji_parent_build'):
+            raise ValueError("Build %s has both parent and koji_parent_build" %
+                             build['name'])
+        by_name[build['name']] = build
+
+    ordered = []
+    done = set()
+    for build in builds:
+        # walk up to a build whose parent is already ordered
+        path = []
+        name = build['name']
+        while name not in done:
+            if name in path:
+                raise ValueError("Cycle in chain: %s" % ' -> '.join(path + [name]))
+            if name not in by_name:
+                raise ValueError("Unknown parent %s of build %s" % (name, path[-1]))
+            path.append(name)
+            name = by_name[name].get('parent')
+            if not name:
+                break
+        for name in reversed(path):
+            ordered.append(by_name[name])
+            done.add(name)
+    return ordered
+
+
+def run_chain(session, builds, max_concurrent, priority=None,
+              channel=DEFAULT_CHANNEL, poll_interval=2, quiet=False):
+    """Submit builds of a chain and wait for them
+
+    Each build is submitted as soon as its parent's koji build is known, up
+    to max_concurrent builds run at a time. Children of failed builds,
+    including builds which couldn't be submitted, are skipped.
+
+    Returns dict mapping build names to (state, task_id, nvr).
+    """
+    def report(name, msg):
+        if not quiet:
+            print "%s: %s" % (name, msg)
+
+    pending = list(builds)
+    running = {}
+    states = {}
+    nvrs = {}
+    watcher = TaskWatcher(session, min_interval=poll_interval)
+    while pending or running:
+        for build in pending[:]:
+            parent = build.get('parent')
+            if parent and states.get(parent, (None,))[0] in ('failed', 'skipped'):
+                pending.remove(build)
+                states[build['name']] = ('skipped', None, None)
+                report(build['name'], "skipped, parent %s didn't build" % parent)
+
+        submit_failed = False
+        for build in pending[:]:
+            if len(running) >= max_concurrent:
+                break
+            parent = build.get('parent')
+            if parent and parent not in nvrs:
+                continue
+            opts = {'git_branch': build['git_branch']}
+            for key in CHAIN_OPTIONAL_KEYS:
+                if key != 'parent' and build.get(key) is not None:
+                    opts[key] = build[key]
+            if parent:
+                opts['koji_parent_build'] = nvrs[parent]
+            pending.remove(build)
+            try:
+                task_id = session.buildContainer(build['source'], build['target'], opts,
+                                                 priority=priority, channel=channel)
+            except Exception, error:
+                # builds already running are still watched
+                submit_failed = True
+                states[build['name']] = ('failed', None, None)
+                report(build['name'], "failed to create task: %s" % error)
+                continue
+            running[task_id] = build['name']
+            watcher.add(task_id)
+            states[build['name']] = ('running', task_id, None)
+            report(build['name'], "created task %s" % task_id)
+
+        if not running:
+            if submit_failed:
+                # skip children of the failed builds
+                continue
+            break
+        time.sleep(watcher.interval())
+        watcher.poll()
+
+        for task_id, name in sorted(running.items()):
+            state = watcher.state(task_id)
+            if task_id in watcher.unfinished():
+                continue
+            del running[task_id]
+            if state != 'CLOSED':
+                states[name] = ('failed', task_id, None)
+                report(name, "task %s %s: %s" % (task_id, state.lower(),
+                                                 watcher.error(task_id)))
+                continue
+            koji_builds = watcher.result(task_id).get('koji_builds')
+            if not koji_builds:
+                states[name] = ('failed', task_id, None)
+                report(name, "task %s didn't produce a koji build" % task_id)
+                continue
+            nvr = session.getBuild(koji_builds[0])['nvr']
+            nvrs[name] = nvr
+            states[name] = ('succeeded', task_id, nvr)
+            report(name, "built %s" % nvr)
+    return states
+
+
+def handle_container_build_chain(options, session, args):
+    "[build] Build a chain of layered container images"
+    usage = _("usage: %prog container-build-chain [options] <chain file>")
+    usage += _("\n(Specify the --help global option for a list of other help "
+               "options)")
+    parser = OptionParser(usage=usage)
+    parser.add_option("--max-concurrent", type="int", default=4,
+                      help=_("Maximum number of builds running at once "
+                             "[default: %default]"))
+    parser.add_option("--poll-interval", type="float", default=2,
+                      help=_("Minimum seconds between checks of running builds, "
+                             "older builds are checked less often "
+                             "[default: %default]"))
+    parser.add_option("--quiet", action="store_true",
+                      help=_("Do not print progress of the builds"),
+                      default=options.quiet)
+    parser.add_option("--background", action="store_true",
+                      help=_("Run the builds at a lower priority"))
+    parser.add_option("--channel-override",
+                      help=_("Use a non-standard channel [default: %default]"),
+                      default=DEFAULT_CHANNEL)
+    build_opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error(_("Exactly one argument (a chain file) is required"))
+    if build_opts.max_concurrent < 1:
+        parser.error(_("--max-concurrent must be at least 1"))
+    try:
+        builds = load_chain(args[0])
+    except (IOError, ValueError), error:
+        parser.error(_("Invalid chain file: %s") % error)
+
+    activate_session(session, options)
+    priority = None
+    if build_opts.background:
+        # relative to koji.PRIO_DEFAULT
+        priority = 5
+    states = run_chain(session, builds, build_opts.max_concurrent,
+                       priority=priority, channel=build_opts.channel_override,
+                       poll_interval=build_opts.poll_interval,
+                       quiet=build_opts.quiet)
+    rv = 0
+    for build in builds:
+        state, task_id, nvr = states.get(build['name'], ('skipped', None, None))
+        if state != 'succeeded':
+            rv = 1
+        if build_opts.quiet:
+            continue
+        detail = nvr or ''
+        if not nvr and task_id:
+            detail = "%s/taskinfo?taskID=%s" % (options.weburl, task_id)
+        print "%s: %s %s" % (build['name'], state, detail)
+    return rv
+
+
+def load_batch(path):
+    """Load builds of batch manifest, list of builds in JSON or YAML file
+
+    Each build has target, source and git_branch, optionally name and
+    options of container-build. Returns the list with name set in every
+    build. Raises ValueError if the manifest isn't valid.
+    """
+    builds = load_manifest(path)
+    names = set()
+    for index, build in enumerate(builds):
+        if not isinstance(build, dict):
+            raise ValueError("Build must be an object: %r" % (build,))
+        build.setdefault('name', str(index + 1))
+        missing = [key for key in BATCH_REQUIRED_KEYS if not build.get(key)]
+        if missing:
+            raise ValueError("Build %s is missing %s" % (build['name'],
+                                                         ', '.join(missing)))
+        unknown = set(build) - set(BATCH_REQUIRED_KEYS + BATCH_OPTIONAL_KEYS)
+        if unknown:
+            raise ValueError("Build %s has unknown keys: %s" %
+                             (build['name'], ', '.join(sorted(unknown))))
+        if build['name'] in names:
+            raise ValueError("Duplicate build name: %s" % build['name'])
+        names.add(build['name'])
+        if build.get('arch_override') and not build.get('scratch'):
+            raise ValueError("Build %s: arch_override is only allowed for scratch "
+                             "builds" % build['name'])
+        if build.get('isolated') and build.get('scratch'):
+            raise ValueError("Build %s cannot be both isolated and scratch" %
+                             build['name'])
+        if '://' not in build['source'] or '#' not in build['source']:
+            raise ValueError("Build %s: source must be of the form "
+                             "<url_to_repository>#<revision>" % build['name'])
+    return builds
+
+
+def _check_batch_target(session, target):
+    """Returns (destination tag, None) or (None, error) for a target"""
+    build_target = session.getBuildTarget(target)
+    if not build_target:
+        return None, "Unknown build target: %s" % target
+    dest_tag = session.getTag(build_target['dest_tag'])
+    if not dest_tag:
+        return None, "Unknown destination tag: %s" % build_target['dest_tag_name']
+    return dest_tag, None
+
+
+def check_batch_targets(session, builds):
+    """Check targets of builds, each target once
+
+    Returns dict mapping names of builds with invalid target to the reason.
+    """
+    errors = {}
+    targets = {}
+    for build in builds:
+        target = build['target']
+        if target not in targets:
+            targets[target] = _check_batch_target(session, target)
+        dest_tag, error = targets[target]
+        if not error and dest_tag['locked'] and not build.get('scratch'):
+            error = "Destination tag %s is locked" % dest_tag['name']
+        if error:
+            errors[build['name']] = error
+    return errors
+
+
+def submit_batch(session, builds, priority=None, channel=DEFAULT_CHANNEL,
+                 batch_size=20):
+    """Submit builds in multicalls of batch_size builds
+
+    Returns list of (task_id, error) in order of builds.
+    """
+    submitted = []
+    for start in range(0, len(builds), batch_size):
+        session.multicall = True
+        for build in builds[start:start + batch_size]:
+            opts = dict((key, build[key]) for key in BATCH_OPTIONAL_KEYS
+                        if key != 'name' and build.get(key) is not None)
+            opts['git_branch'] = build['git_branch']
+            if opts.get('arch_override'):
+                opts['arch_override'] = parse_arches(opts['arch_override'])
+            session.buildContainer(build['source'], build['target'], opts,
+                                   priority=priority, channel=channel)
+        for result in session.multiCall(strict=False):
+            if isinstance(result, dict):
+                submitted.append((None, result['faultString']))
+            else:
+                submitted.append((result[0], None))
+    return submitted
+
+
+def format_batch_table(rows):
+    """Format rows of (name, task_id, state) as lines of a table"""
+    rows = [('NAME', 'TASK', 'STATE')] + [(name, str(task_id or '-'), state)
+                                          for name, task_id, state in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(2)]
+    return ['%-*s  %-*s  %s' % (widths[0], row[0], widths[1], row[1], row[2])
+            for row in rows]
+
+
+def watch_batch(session, tasks, poll_interval=2, out=sys.stdout, live=None,
+                on_round=None):
+    """Wait for tasks to finish, returns TaskWatcher with their states
+
+    tasks is list of (name, task_id). The table of states is redrawn in
+    place when live (defaults to out being a terminal), otherwise only
+    changes are printed. on_round is called with the watcher and IDs of
+    changed tasks after every round.
+    """
+    if live is None:
+        live = out.isatty()
+    watcher = TaskWatcher(session, min_interval=poll_interval)
+    for name, task_id in tasks:
+        watcher.add(task_id)
+    drawn = [0]
+
+    def report(changed):
+        if live:
+            lines = format_batch_table([(name, task_id, watcher.state(task_id))
+                                        for name, task_id in tasks])
+            if drawn[0]:
+                out.write('\x1b[%dA' % drawn[0])
+            for line in lines:
+                out.write('\x1b[K%s\n' % line)
+            drawn[0] = len(lines)
+        else:
+            for name, task_id in tasks:
+                if task_id not in changed:
+                    continue
+                if watcher.error(task_id):
+                    out.write('%s (%s): %s: %s\n' % (name, task_id, watcher.state(task_id),
+                                                     watcher.error(task_id)))
+                else:
+                    out.write('%s (%s): %s\n' % (name, task_id, watcher.state(task_id)))
+        out.flush()
+        if on_round:
+            on_round(watcher, changed)
+
+    watcher.wait(report)
+    return watcher
+
+
+def handle_container_build_batch(options, session, args):
+    "[build] Build containers listed in a manifest"
+    usage = _("usage: %prog container-build-batch [options] <manifest>")
+    usage += _("\n(Specify the --help global option for a list of other help "
+               "options)")
+    parser = OptionParser(usage=usage)
+    parser.add_option("--batch-size", type="int", default=20,
+                      help=_("Number of builds submitted in one hub call "
+                             "[default: %default]"))
+    parser.add_option("--poll-interval", type="float", default=2,
+                      help=_("Minimum seconds between checks of the builds, "
+                             "older builds are checked less often "
+                             "[default: %default]"))
+    parser.add_option("--summary", metavar="FILE",
+                      help=_("Write JSON summary of the builds to FILE, - for "
+                             "standard output"))
+    parser.add_option("--nowait", action="store_false", dest="wait", default=True,
+                      help=_("Don't wait on the builds"))
+    parser.add_option("--output", type="choice", choices=OUTPUT_FORMATS,
+                      default="text",
+                      help=_("Output format: text, json (summary at the end) or "
+                             "jsonl (events as they happen) [default: %default]"))
+    parser.add_option("--quiet", action="store_true",
+                      help=_("Do not print the table of builds"),
+                      default=options.quiet)
+    parser.add_option("--background", action="store_true",
+                      help=_("Run the builds at a lower priority"))
+    parser.add_option("--channel-override",
+                      help=_("Use a non-standard channel [default: %default]"),
+                      default=DEFAULT_CHANNEL)
+    build_opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error(_("Exactly one argument (a manifest) is required"))
+    if build_opts.batch_size < 1:
+        parser.error(_("--batch-size must be at least 1"))
+    if build_opts.output == 'jsonl' and build_opts.summary == '-':
+        parser.error(_("--summary - can't be used with --output jsonl"))
+    try:
+        builds = load_batch(args[0])
+    except (IOError, ValueError), error:
+        parser.error(_("Invalid manifest: %s") % error)
+
+    activate_session(session, options)
+    priority = None
+    if build_opts.background:
+        # relative to koji.PRIO_DEFAULT
+        priority = 5
+
+    summary = [{'name': build['name'], 'target': build['target'],
+                'source': build['source'], 'task_id': None}
+               for build in builds]
+    by_name = dict((entry['name'], entry) for entry in summary)
+    for name, error in check_batch_targets(session, builds).items():
+        by_name[name].update(state='invalid', error=error)
+    valid = [build for build in builds if 'state' not in by_name[build['name']]]
+    submitted = submit_batch(session, valid, priority=priority,
+                             channel=build_opts.channel_override,
+                             batch_size=build_opts.batch_size)
+    for build, (task_id, error) in zip(valid, submitted):
+        if error:
+            by_name[build['name']].update(state='submit_failed', error=error)
+        else:
+            by_name[build['name']].update(task_id=task_id, state='FREE')
+
+    text = build_opts.output == 'text' and build_opts.summary != '-'
+    jsonl = build_opts.output == 'jsonl'
+    if jsonl:
+        for entry in summary:
+            if entry['task_id']:
+                emit_event('created', name=entry['name'], task_id=entry['task_id'],
+                           url="%s/taskinfo?taskID=%s" % (options.weburl,
+                                                         entry['task_id']))
+            else:
+                emit_event(entry['state'], name=entry['name'], error=entry['error'])
+
+    task_ids = [entry['task_id'] for entry in summary if entry['task_id']]
+    if build_opts.wait and task_ids:
+        tasks = [(entry['name'], entry['task_id']) for entry in summary
+                 if entry['task_id']]
+        names = dict((task_id, name) for name, task_id in tasks)
+        reported = set()
+
+        def on_round(watcher, changed):
+            for task_id in changed:
+                emit_event('state', name=names[task_id], task_id=task_id,
+                           state=watcher.state(task_id))
+            for task_id in task_ids:
+                if task_id in reported or task_id in watcher.unfinished():
+                    continue
+                reported.add(task_id)
+                fields = {'name': names[task_id], 'task_id': task_id,
+                          'state': watcher.state(task_id)}
+                if watcher.error(task_id):
+                    fields['error'] = watcher.error(task_id)
+                else:
+                    fields['result'] = result_with_urls(watcher.result(task_id),
+                                                        options.weburl)
+                emit_event('result', **fields)
+
+        if build_opts.quiet or not text:
+            with open(os.devnull, 'w') as out:
+                watcher = watch_batch(session, tasks, build_opts.poll_interval,
+                                      out=out, on_round=on_round if jsonl else None)
+        else:
+            watcher = watch_batch(session, tasks, build_opts.poll_interval)
+        for entry in summary:
+            task_id = entry['task_id']
+            if not task_id:
+                continue
+            entry['state'] = watcher.state(task_id)
+            result = watcher.result(task_id)
+            if watcher.error(task_id):
+                entry['error'] = watcher.error(task_id)
+            elif result:
+                entry['repositories'] = result.get('repositories', [])
+                entry['koji_builds'] = result.get('koji_builds', [])
+    for entry in summary:
+        entry['exit_code'] = BATCH_EXIT_CODES.get(entry['state'])
+
+    if text and not build_opts.quiet:
+        for line in format_batch_table([(entry['name'], entry['task_id'], entry['state'])
+                                        for entry in summary]):
+            print line
+        for entry in summary:
+            if entry.get('error'):
+                print "%s: %s" % (entry['name'], entry['error'])
+    if build_opts.summary == '-' or build_opts.output == 'json':
+        print json.dumps(summary, indent=2, sort_keys=True)
+    if build_opts.summary and build_opts.summary != '-':
+        with open(build_opts.summary, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    if any(entry['exit_code'] for entry in summary):
+        return 1
+    return 0
@@ -24,30 +24,60 @@ containers."""
 #       Pavol Babincak <pbabinca@redhat.com>
 import os
 import os.path
+import re
 import sys
+import json
+import hashlib
+import subprocess
+import calendar
+import collections
 import logging
-import imp
+import ConfigParser
 import time
+import random
 import traceback
-import dockerfile_parse
 import signal
+import zlib
+import struct
+import fcntl
+import mmap
+import threading
 
 import koji
 from koji.daemon import SCM, incremental_upload
 from koji.tasks import ServerExit, BaseTaskHandler
 
-import osbs
-from osbs.api import OSBS
-from osbs.conf import Configuration
-try:
-    from osbs.exceptions import OsbsOrchestratorNotEnabled
-except ImportError:
-    from osbs.exceptions import OsbsValidationException as OsbsOrchestratorNotEnabled
-try:
-    from osbs.utils import split_module_spec
-    osbs_flatpak_support = True
-except ImportError:
-    osbs_flatpak_support = False
+
+# osbs-client and dockerfile_parse are imported on first use. kojid loads
+# every plugin at start and on each restart, most of its tasks are not
+# container builds and shouldn't pay for importing them.
+def _import_dockerfile_parse():
+    import dockerfile_parse.parser
+    return dockerfile_parse.parser
+
+
+def _import_osbs():
+    import osbs.api
+    import osbs.conf
+    return osbs
+
+
+def orchestrator_not_enabled_exception():
+    """Exception raised by osbs-client when orchestration isn't available"""
+    try:
+        from osbs.exceptions import OsbsOrchestratorNotEnabled
+    except ImportError:
+        from osbs.exceptions import OsbsValidationException as OsbsOrchestratorNotEnabled
+    return OsbsOrchestratorNotEnabled
+
+
+def osbs_split_module_spec():
+    """Returns osbs-client's split_module_spec or None without Flatpak support"""
+    try:
+        from osbs.utils import split_module_spec
+    except ImportError:
+        return None
+    return split_module_spec
 
 
 # List of LABEL identifiers used within Koji. Values doesn't need to correspond
@@ -89,11 +119,194 @@ LABEL_DEFAULT_VALUES = {
 }
 
 
-class ContainerError(koji.GenericError):
+# Optional configuration of the plugin
+CONFIG_FILE = '/etc/kojid/plugins/builder_containerbuild.conf'
+CONFIG_SECTION = 'containerbuild'
+
+# Options which can be set in CONFIG_FILE with their default values. Type of
+# default value determines how the option is parsed.
+CONFIG_DEFAULTS = {
+    # Compress logs before they are uploaded to the hub: 'none', 'completed'
+    # (logs are uploaded only after the build finishes) or 'live'
+    'compress_logs': 'none',
+    # zlib compression level used for logs, lower is cheaper on CPU
+    'compress_level': 6,
+    # Limits of log uploads of all container tasks on the builder, bytes and
+    # upload calls per second (0 means unlimited)
+    'upload_rate_bytes': 0,
+    'upload_rate_calls': 0,
+    # Size of upload bursts allowed, in seconds worth of the rate
+    'upload_burst': 2.0,
+    # Fraction of the limit kept for orchestrator log and finishing builds
+    'upload_reserve': 0.2,
+    # File which shares state of the limits among tasks
+    'upload_limit_state': '/var/tmp/koji-containerbuild-upload-limit',
+    # Bounds of interval between upload rounds (seconds), the interval grows
+    # while logs are quiet and shrinks while they grow faster than
+    # upload_busy_rate (bytes per second)
+    'upload_interval_min': 0.25,
+    'upload_interval_max': 16.0,
+    'upload_busy_rate': 65536,
+    # Maximum bytes of a single log uploaded in one round
+    'upload_round_max': 8388608,
+    # Maximum number of demultiplexed log files kept open by a task
+    'max_open_logs': 8,
+    # Number of last lines of each log kept for failure summaries
+    'failure_tail_lines': 50,
+    # Stream logs from OSBS directly to the hub instead of through log files
+    'direct_log_upload': False,
+    # Bytes of each log kept in memory in direct mode before spooling to disk
+    'direct_log_buffer': 4194304,
+    # Logs bigger than this (bytes, 0 to disable) are read via memory mapped
+    # windows of large_log_window bytes
+    'large_log_threshold': 1073741824,
+    'large_log_window': 16777216,
+    # Decline new container tasks while more than admission_max_queue builds
+    # wait in OSBS or builds recently waited longer than admission_max_latency
+    # seconds to get scheduled (0 disables either check)
+    'admission_max_queue': 0,
+    'admission_max_latency': 0.0,
+    # Seconds between samples of OSBS queue, and seconds of scheduling
+    # latencies taken into account
+    'admission_sample_interval': 30.0,
+    'admission_latency_window': 600.0,
+    # File which shares samples among kojid and its tasks
+    'admission_state': '/var/tmp/koji-containerbuild-admission',
+    # Prometheus textfile with admission decisions and samples ('' disables)
+    'admission_metrics': '',
+    # How long (seconds) results of scratch builds can be reused by identical
+    # scratch builds which ask for it, 0 disables reuse
+    'scratch_reuse_ttl': 86400,
+    # Seconds from cancel of a task within which its OSBS build is cancelled,
+    # failed attempts are retried after cancel_retry_delay seconds, doubling
+    'cancel_timeout': 8.0,
+    'cancel_retry_delay': 0.5,
+    # Retries of OSBS build submission and scheduling which failed with
+    # transient errors, per task, and bounds of their delay (seconds)
+    'submit_retries': 3,
+    'submit_retry_delay': 15.0,
+    'submit_retry_max_delay': 120.0,
+    # Seconds between checks of OSBS build for progress.json uploaded while
+    # the task runs, 0 disables the progress report
+    'progress_interval': 30.0,
+}
+
+
+# Errors of OSBS requests which are likely to go away when retried, HTTP
+# status codes and messages (API server overloaded, etcd timeouts, quota
+# being recalculated, conflicting updates)
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_ERRORS = re.compile(r"etcdserver: request timed out|exceeded quota|"
+                              r"the object has been modified|timed out|"
+                              r"Connection (?:reset|refused|aborted)|"
+                              r"Temporary failure in name resolution", re.IGNORECASE)
+
+
+# Last lines of logs written by log follower, in resultdir
+LOG_TAILS_FILE = 'log-tails.json'
+
+# Seconds between rewrites of LOG_TAILS_FILE while logs are read, the log
+# writer child is killed when the task is cancelled
+LOG_TAILS_INTERVAL = 5
+
+# Summary of logs of failed or cancelled build uploaded to the hub
+FAILURE_TAIL_LOG = 'failure-tail.log'
+
+# Progress of running build uploaded to the hub, see ProgressReport
+PROGRESS_FILE = 'progress.json'
+
+# Number of last lines of each log put into error message of failed build
+FAILURE_TAIL_MESSAGE_LINES = 10
+
+# Most recent builds of the same commit and target checked for scratch reuse
+SCRATCH_REUSE_CANDIDATES = 20
+
+# Section of CONFIG_FILE with additional failure signatures, 'name = regex'
+# (see FAILURE_SIGNATURES)
+FAILURE_SIGNATURES_SECTION = 'failure_signatures'
+
+# Signatures of common build failures, pairs of failure class and regular
+# expression searched for in lines of build logs. Earlier signatures take
+# precedence. Expressions have to stay linear (no unbounded repetition
+# followed by backtracking) as they are run on huge logs.
+FAILURE_SIGNATURES = [
+    ('oom', r"Out of memory|OOMKilled|Cannot allocate memory|MemoryError|"
+            r"Killed process \d+"),
+    ('repo_unavailable', r"Cannot retrieve repository metadata|"
+                         r"Failed to download metadata for repo|"
+                         r"Cannot find a valid baseurl for repo|"
+                         r"failure: repodata/repomd\.xml from|"
+                         r"Errors during downloading metadata for repository"),
+    ('dnf_depsolve', r"Error: Unable to find a match|No package \S+ available|"
+                     r"Problem(?: \d+)?: conflicting requests|nothing provides \S+|"
+                     r"Error: Package: \S+ \(|Depsolving problems|Depsolve Error"),
+    ('registry_push_timeout', r"(?:push|upload)[^\n]{0,200}(?:timed out|[Tt]imeout)|"
+                              r"(?:timed out|[Tt]imeout)[^\n]{0,200}push"),
+]
+
+
+def to_unicode(text):
+    """Returns text as unicode, byte strings are decoded as UTF-8"""
+    if isinstance(text, unicode):
+        return text
+    return str(text).decode('utf-8', 'replace')
+
+
+def read_config(path=CONFIG_FILE):
+    """Returns dict with plugin configuration, defaults for missing options
+
+    Additional failure signatures are returned as list of (name, regex) under
+    'failure_signatures' key. Defaults are used when the file is broken.
+    """
+    try:
+        return _read_config(path)
+    except (ConfigParser.Error, ValueError), error:
+        logging.getLogger('koji.plugin').error("Invalid configuration in %s, using "
+                                               "defaults: %s", path, error)
+        return dict(CONFIG_DEFAULTS, failure_signatures=[])
+
+
+def _read_config(path):
+    config = CONFIG_DEFAULTS.copy()
+    config['failure_signatures'] = []
+    parser = ConfigParser.SafeConfigParser()
+    if not parser.read(path):
+        return config
+    if parser.has_section(FAILURE_SIGNATURES_SECTION):
+        config['failure_signatures'] = parser.items(FAILURE_SIGNATURES_SECTION, raw=True)
+    if not parser.has_section(CONFIG_SECTION):
+        return config
+    for key, default in CONFIG_DEFAULTS.items():
+        if not parser.has_option(CONFIG_SECTION, key):
+            continue
+        if isinstance(default, bool):
+            config[key] = parser.getboolean(CONFIG_SECTION, key)
+        elif isinstance(default, int):
+            config[key] = parser.getint(CONFIG_SECTION, key)
+        elif isinstance(default, float):
+            config[key] = parser.getfloat(CONFIG_SECTION, key)
+        else:
+            config[key] = parser.get(CONFIG_SECTION, key)
+    return config
+
+
+class TaskFailure(koji.GenericError):
+    """Base of errors failing the task, message may be unicode
+
+    kojid passes str() of koji errors to the hub as the fault string, it's
+    UTF-8 here rather than repr of attributes as for non-ASCII unicode in
+    koji.GenericError.
+    """
+    def __str__(self):
+        if self.args and isinstance(self.args[0], unicode):
+            return self.args[0].encode('utf-8')
+        return koji.GenericError.__str__(self)
+
+class ContainerError(TaskFailure):
     """Raised when container creation fails"""
     faultCode = 2001
 
-class ContainerCancelled(koji.GenericError):
+class ContainerCancelled(TaskFailure):
     """Raised when container creation is cancelled by OSBS"""
     faultCode = 2002
 
@@ -116,16 +329,209 @@ class My_SCM(SCM):
         return git_uri
 
 
+# Size of blocks for which checksums of uploaded log content are kept. Matches
+# chunk size used by koji.daemon.incremental_upload.
+UPLOAD_BLOCK_SIZE = 65536
+
+
+class UploadedContent(object):
+    """Rolling checksums of log content which has already been uploaded
+
+    Content is split into blocks of block_size bytes and adler32 checksum of
+    every complete block is kept together with running checksum of the last
+    incomplete block. This allows to find out how much of a replaced or
+    truncated file is the same as what the hub already has without keeping
+    the content itself.
+    """
+    def __init__(self, block_size=UPLOAD_BLOCK_SIZE):
+        self.block_size = block_size
+        self.blocks = []
+        self._partial = zlib.adler32('')
+        self._partial_len = 0
+
+    @property
+    def size(self):
+        return len(self.blocks) * self.block_size + self._partial_len
+
+    def update(self, data):
+        offset = 0
+        while offset < len(data):
+            chunk = data[offset:offset + self.block_size - self._partial_len]
+            offset += len(chunk)
+            self._partial = zlib.adler32(chunk, self._partial)
+            self._partial_len += len(chunk)
+            if self._partial_len == self.block_size:
+                self.blocks.append(self._partial)
+                self._partial = zlib.adler32('')
+                self._partial_len = 0
+
+    def common_prefix(self, fd):
+        """Returns UploadedContent for the longest prefix of fd which matches
+
+        Comparison is done per block so the prefix is rounded down to block
+        boundary unless whole uploaded content matches. Position of fd is
+        left undefined.
+        """
+        matched = UploadedContent(self.block_size)
+        fd.seek(0)
+        for checksum in self.blocks:
+            data = fd.read(self.block_size)
+            if len(data) != self.block_size or zlib.adler32(data) != checksum:
+                return matched
+            matched.update(data)
+        if self._partial_len:
+            data = fd.read(self._partial_len)
+            if (len(data) == self._partial_len and
+                    zlib.adler32(data) == self._partial):
+                matched.update(data)
+        return matched
+
+
+def open_new(path):
+    """Open path for writing as a new file
+
+    Logs are rewritten from the beginning when log follower retries. A file
+    truncated in place would kill readers which have it memory mapped
+    (SIGBUS on pages past its end), a replaced one is read to the end by them.
+    """
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    return open(path, 'wb')
+
+
+class MmapFile(object):
+    """Read-only file object reading content via memory mapped windows
+
+    Only a window of the file is mapped at a time and each read returns just
+    the requested chunk, so memory use stays the same however big the file
+    is. Position of the underlying file object is kept in sync.
+    """
+    def __init__(self, fd, window=16777216):
+        self._fd = fd
+        self.name = fd.name
+        # window has to be aligned to allocation granularity
+        self._window_size = max(window - window % mmap.ALLOCATIONGRANULARITY,
+                                mmap.ALLOCATIONGRANULARITY)
+        self._window = None
+        self._window_offset = 0
+        self._pos = fd.tell()
+
+    def fileno(self):
+        return self._fd.fileno()
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset):
+        self._pos = offset
+        self._fd.seek(offset)
+
+    def _map(self, size):
+        offset = self._pos - self._pos % mmap.ALLOCATIONGRANULARITY
+        length = min(self._window_size, size - offset)
+        self.close_window()
+        self._window = mmap.mmap(self._fd.fileno(), length, mmap.MAP_SHARED,
+                                 mmap.PROT_READ, offset=offset)
+        self._window_offset = offset
+
+    def _read_window(self, size, file_size):
+        window_end = self._window_offset + (len(self._window) if self._window else 0)
+        if not self._window or not self._window_offset <= self._pos < window_end:
+            self._map(file_size)
+            window_end = self._window_offset + len(self._window)
+        start = self._pos - self._window_offset
+        data = self._window[start:start + min(size, window_end - self._pos)]
+        self.seek(self._pos + len(data))
+        return data
+
+    def read(self, size=-1):
+        file_size = os.fstat(self._fd.fileno()).st_size
+        if (self._window is not None and
+                self._window_offset + len(self._window) > file_size):
+            # the file was truncated, pages past its end can't be touched
+            self.close_window()
+        if size < 0:
+            size = file_size - self._pos
+        size = min(size, file_size - self._pos)
+        if size <= 0:
+            return ''
+        data = self._read_window(size, file_size)
+        if len(data) == size:
+            return data
+        # read crosses windows
+        chunks = [data]
+        size -= len(data)
+        while size > 0:
+            data = self._read_window(size, file_size)
+            chunks.append(data)
+            size -= len(data)
+        return ''.join(chunks)
+
+    def close_window(self):
+        if self._window is not None:
+            self._window.close()
+            self._window = None
+
+    def close(self):
+        self.close_window()
+        self._fd.close()
+
+
+class TrackedFile(object):
+    """File object wrapper which records everything read from it
+
+    incremental_upload() uploads content from current position of the file so
+    whatever is read through this wrapper is what the hub receives.
+    """
+    def __init__(self, fd, uploaded):
+        self._fd = fd
+        self.uploaded = uploaded
+        self.name = fd.name
+        # bytes which can be read, None for no limit
+        self.limit = None
+
+    def tell(self):
+        return self._fd.tell()
+
+    def read(self, size=-1):
+        if self.limit is not None and (size < 0 or size > self.limit):
+            size = self.limit
+        data = self._fd.read(size)
+        if self.limit is not None:
+            self.limit -= len(data)
+        self.uploaded.update(data)
+        return data
+
+    def pending(self):
+        """Size of content which hasn't been read yet"""
+        return os.fstat(self._fd.fileno()).st_size - self._fd.tell()
+
+
 class FileWatcher(object):
     """Watch directory for new or changed files which can be iterated on
 
     Rewritten mock() from Buildroot class of kojid. When modifying keep that in
     mind and after the API looks stable enough try to merge the code back to
     koji.
+
+    When a file is replaced or truncated only the part which differs from
+    already uploaded content is uploaded again. truncate_upload is called with
+    file name and size when the uploaded copy has to be cut first; it returns
+    False when that isn't possible and the whole file is uploaded again.
+
+    Files with names ending with suffix (or any of suffixes if it's a tuple)
+    are watched.
     """
-    def __init__(self, result_dir, logger):
+    def __init__(self, result_dir, logger, truncate_upload=None, suffix='.log',
+                 large_log_threshold=0, large_log_window=16777216):
         self._result_dir = result_dir
         self.logger = logger
+        self._suffix = suffix
+        self._large_log_threshold = large_log_threshold
+        self._large_log_window = large_log_window
+        self._truncate_upload = truncate_upload
         self._logs = {}
 
     def _list_files(self):
@@ -136,23 +542,55 @@ class FileWatcher(object):
             return
 
         for fname in results:
-            if fname.endswith('.log') and fname not in self._logs:
+            if fname.endswith(self._suffix) and fname not in self._logs:
                 fpath = os.path.join(self._result_dir, fname)
-                self._logs[fname] = (None, None, 0, fpath)
+                self._logs[fname] = (None, None, 0, fpath, UploadedContent())
+
+    def _resume_upload(self, fname, fd, uploaded):
+        """Position fd after content which is already uploaded
 
-    def _reopen_file(self, fname, fd, inode, size, fpath):
+        Returns UploadedContent which corresponds to the new position.
+        """
+        matched = uploaded.common_prefix(fd)
+        if 0 < matched.size < uploaded.size:
+            if not self._truncate_upload or not self._truncate_upload(fname, matched.size):
+                matched = UploadedContent(uploaded.block_size)
+        fd.seek(matched.size)
+        self.logger.info('Reusing %d of %d uploaded bytes of %s',
+                         matched.size, uploaded.size, fname)
+        return matched
+
+    def _reopen_file(self, fname, fd, inode, size, fpath, uploaded):
         try:
             stat_info = os.stat(fpath)
-            if not fd or stat_info.st_ino != inode or stat_info.st_size < size:
+            if (not fd or stat_info.st_ino != inode or stat_info.st_size < size or
+                    (self._large_log_threshold and not isinstance(fd, MmapFile) and
+                     stat_info.st_size >= self._large_log_threshold)):
                 # either a file we haven't opened before, or mock replaced a file we had open with
                 # a new file and is writing to it, or truncated the file we're reading,
-                # but our fd is pointing to the previous location in the old file
-                if fd:
-                    self.logger.info('Rereading %s, inode: %s -> %s, size: %s -> %s' %
-                                     (fpath, inode, stat_info.st_ino, size, stat_info.st_size))
+                # but our fd is pointing to the previous location in the old file, or the file
+                # became big enough to be read via mmap
+                large = (self._large_log_threshold and
+                         stat_info.st_size >= self._large_log_threshold)
+                if fd and stat_info.st_ino == inode and stat_info.st_size >= size:
+                    # log grew over large_log_threshold, continue where we
+                    # are via mmap
+                    position = fd.tell()
                     fd.close()
-                fd = file(fpath, 'r')
-            self._logs[fname] = (fd, stat_info.st_ino, stat_info.st_size, fpath)
+                    fd = MmapFile(file(fpath, 'r'), window=self._large_log_window)
+                    fd.seek(position)
+                else:
+                    if fd:
+                        self.logger.info('Rereading %s, inode: %s -> %s, size: %s -> %s' %
+                                         (fpath, inode, stat_info.st_ino, size,
+                                          stat_info.st_size))
+                        fd.close()
+                    fd = file(fpath, 'r')
+                    if large:
+                        fd = MmapFile(fd, window=self._large_log_window)
+                    if uploaded.size:
+                        uploaded = self._resume_upload(fname, fd, uploaded)
+            self._logs[fname] = (fd, stat_info.st_ino, stat_info.st_size, fpath, uploaded)
         except OSError:
             self.logger.error("The build has been cancelled")
             raise koji.ActionNotAllowed
@@ -165,18 +603,936 @@ class FileWatcher(object):
     def files_to_upload(self):
         self._list_files()
 
-        for (fname, (fd, inode, size, fpath)) in self._logs.items():
-            fd = self._reopen_file(fname, fd, inode, size, fpath)
+        for (fname, (fd, inode, size, fpath, uploaded)) in self._logs.items():
+            fd = self._reopen_file(fname, fd, inode, size, fpath, uploaded)
             if fd is False:
                 return
-            yield (fd, fname)
+            yield (TrackedFile(fd, self._logs[fname][4]), fname)
 
     def clean(self):
-        for (fname, (fd, inode, size, fpath)) in self._logs.items():
+        for (fname, (fd, inode, size, fpath, uploaded)) in self._logs.items():
             if fd:
                 fd.close()
 
 
+class UploadLimiter(object):
+    """Token buckets limiting bytes and calls per second of log uploads
+
+    State of the buckets is kept in state_file (if given) locked during every
+    update so the limits apply to all tasks on the builder together. Regular
+    uploads have to leave reserve fraction of the buckets for priority ones.
+    Priority uploads never wait; they take what they need even if the buckets
+    go into debt, which holds back later regular uploads instead.
+    """
+    def __init__(self, bytes_rate, calls_rate, burst=2.0, reserve=0.2,
+                 state_file=None):
+        self._rates = (float(bytes_rate), float(calls_rate))
+        self._capacity = [rate * burst for rate in self._rates]
+        self._reserve = reserve
+        self._state_file = state_file
+        self._tokens = list(self._capacity)
+        self._timestamp = time.time()
+
+    def _load(self, fd):
+        fd.seek(0)
+        try:
+            bytes_tokens, calls_tokens, timestamp = fd.read().split()
+            self._tokens = [float(bytes_tokens), float(calls_tokens)]
+            self._timestamp = float(timestamp)
+        except ValueError:
+            # new or corrupted state, start with full buckets
+            pass
+
+    def _save(self, fd):
+        fd.seek(0)
+        fd.truncate()
+        fd.write('%f %f %f\n' % (self._tokens[0], self._tokens[1], self._timestamp))
+        fd.flush()
+
+    def _take(self, amounts, priority):
+        now = time.time()
+        elapsed = max(now - self._timestamp, 0)
+        self._timestamp = now
+        for i, rate in enumerate(self._rates):
+            self._tokens[i] = min(self._tokens[i] + elapsed * rate, self._capacity[i])
+
+        if not priority:
+            for i, amount in enumerate(amounts):
+                if not self._rates[i]:
+                    continue
+                reserve = self._capacity[i] * self._reserve
+                # allow uploads bigger than the bucket when it's full
+                if (self._tokens[i] - amount < reserve and
+                        self._tokens[i] < self._capacity[i]):
+                    return False
+        for i, amount in enumerate(amounts):
+            if self._rates[i]:
+                self._tokens[i] -= amount
+        return True
+
+    def acquire(self, nbytes, ncalls, priority=False):
+        """Returns True if upload of nbytes in ncalls can proceed now"""
+        if not self._state_file:
+            return self._take((nbytes, ncalls), priority)
+        fd = open(self._state_file, 'a+')
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            self._load(fd)
+            allowed = self._take((nbytes, ncalls), priority)
+            self._save(fd)
+        finally:
+            fd.close()
+        return allowed
+
+
+class AdmissionControl(object):
+    """Decides whether the builder takes new container tasks
+
+    Queue depth of OSBS is sampled at most once per sample_interval, tasks
+    record how long their builds waited to get scheduled. Builds still
+    waiting count with their current wait. All is shared by kojid and its
+    task processes via state_file, locked during every update. Samples and
+    counts of decisions are written to metrics_file in Prometheus text
+    format.
+    """
+    def __init__(self, state_file, max_queue=0, max_latency=0, sample_interval=30,
+                 latency_window=600, metrics_file=None):
+        self._state_file = state_file
+        self._max_queue = max_queue
+        self._max_latency = max_latency
+        self._sample_interval = sample_interval
+        self._latency_window = latency_window
+        self._metrics_file = metrics_file
+
+    def _load(self, fd):
+        fd.seek(0)
+        try:
+            state = json.load(fd)
+        except ValueError:
+            # new or corrupted state
+            state = {}
+        for key in ('queue', 'latencies', 'waiting', 'decisions'):
+            state.setdefault(key, {})
+        return state
+
+    def _save(self, fd, state):
+        fd.seek(0)
+        fd.truncate()
+        json.dump(state, fd)
+        fd.flush()
+
+    def _update(self, func):
+        fd = open(self._state_file, 'a+')
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            state = self._load(fd)
+            self._expire(state, time.time())
+            result = func(state)
+            self._save(fd, state)
+        finally:
+            fd.close()
+        if self._metrics_file:
+            self._write_metrics(state)
+        return result
+
+    def _expire(self, state, now):
+        for section, latencies in state['latencies'].items():
+            state['latencies'][section] = [
+                (timestamp, latency) for timestamp, latency in latencies
+                if now - timestamp < self._latency_window]
+        for section, waiting in state['waiting'].items():
+            for task_id, (pid, started) in waiting.items():
+                try:
+                    os.kill(pid, 0)
+                except OSError:
+                    # task process is gone without telling
+                    del waiting[task_id]
+
+    def _latency(self, state, section, now):
+        """Scheduling latency: median of recent ones or the longest wait"""
+        latencies = sorted(latency for timestamp, latency
+                           in state['latencies'].get(section, []))
+        median = latencies[len(latencies) // 2] if latencies else 0.0
+        waits = [now - started for pid, started
+                 in state['waiting'].get(section, {}).values()]
+        return max([median] + waits)
+
+    def wait_started(self, task_id, section):
+        def update(state):
+            waiting = state['waiting'].setdefault(section, {})
+            waiting[str(task_id)] = (os.getpid(), time.time())
+        self._update(update)
+
+    def wait_finished(self, task_id, section, scheduled=True):
+        """Record end of wait for build of task, latency counts if scheduled"""
+        def update(state):
+            entry = state['waiting'].get(section, {}).pop(str(task_id), None)
+            if entry and scheduled:
+                now = time.time()
+                state['latencies'].setdefault(section, []).append(
+                    (now, now - entry[1]))
+        self._update(update)
+
+    def admit(self, section, sample_queue):
+        """Returns (admitted, reason) for a new task
+
+        sample_queue is called to get queue depth of OSBS when the last
+        sample is too old. Without a sample the queue check passes.
+        """
+        def update(state):
+            now = time.time()
+            sample = state['queue'].get(section)
+            if self._max_queue and (not sample or
+                                    now - sample[0] >= self._sample_interval):
+                try:
+                    depth = sample_queue()
+                except Exception:
+                    depth = None
+                sample = state['queue'][section] = (now, depth)
+            reason = None
+            if self._max_queue and sample and sample[1] > self._max_queue:
+                reason = 'queue'
+            elif (self._max_latency and
+                  self._latency(state, section, now) > self._max_latency):
+                reason = 'latency'
+            decision = '%s:%s' % ('declined' if reason else 'accepted', reason or '')
+            state['decisions'][decision] = state['decisions'].get(decision, 0) + 1
+            return reason is None, reason
+        return self._update(update)
+
+    def _write_metrics(self, state):
+        now = time.time()
+        lines = [
+            '# HELP koji_containerbuild_admission_decisions_total '
+            'Container tasks accepted or declined by the builder',
+            '# TYPE koji_containerbuild_admission_decisions_total counter',
+        ]
+        for decision, count in sorted(state['decisions'].items()):
+            decision, reason = decision.split(':', 1)
+            lines.append('koji_containerbuild_admission_decisions_total'
+                         '{decision="%s",reason="%s"} %d' % (decision, reason, count))
+        lines.extend([
+            '# HELP koji_containerbuild_osbs_queue_depth '
+            'Builds waiting in OSBS at the last sample',
+            '# TYPE koji_containerbuild_osbs_queue_depth gauge',
+        ])
+        for section, (timestamp, depth) in sorted(state['queue'].items()):
+            if depth is not None:
+                lines.append('koji_containerbuild_osbs_queue_depth{section="%s"} %d'
+                             % (section, depth))
+        lines.extend([
+            '# HELP koji_containerbuild_osbs_scheduling_latency_seconds '
+            'Recent time builds waited to get scheduled in OSBS',
+            '# TYPE koji_containerbuild_osbs_scheduling_latency_seconds gauge',
+        ])
+        sections = set(state['latencies']) | set(state['waiting'])
+        for section in sorted(sections):
+            lines.append('koji_containerbuild_osbs_scheduling_latency_seconds'
+                         '{section="%s"} %.3f' % (section, self._latency(state, section, now)))
+        tmp_path = '%s.tmp' % self._metrics_file
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self._metrics_file)
+
+
+class CancelCoordinator(object):
+    """Cancels OSBS build of a container task cancelled in koji
+
+    kojid sends SIGINT to the task (SIGTERM and SIGKILL follow a few seconds
+    later) when it's cancelled. The signal handler only records the request,
+    stops the log follower and kills the forked log writer. The OSBS build is
+    cancelled by a thread, failed attempts are retried until timeout seconds
+    after the request, while the task gives up at its next check(). Requests
+    which come while the build is being created are carried out once its ID
+    is known.
+    """
+    def __init__(self, cancel_build, logger, timeout=8.0, retry_delay=0.5):
+        self._cancel_build = cancel_build
+        self.logger = logger
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.build_id = None
+        self.child_pid = None
+        self.requested = None
+        self.latency = None
+        self.stopped = threading.Event()
+        self._handlers = {}
+        self._thread = None
+        self._released = False
+        # never set from the signal handler, the thread polls for requests
+        self._wake = threading.Event()
+
+    def install(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self._handlers[signum] = signal.signal(signum, self._handle_signal)
+        self._thread = threading.Thread(target=self._run, name='osbs-cancel')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def uninstall(self):
+        """Restore signal handlers, wait for cancel of the build if requested"""
+        for signum, handler in self._handlers.items():
+            signal.signal(signum, handler)
+        self._handlers = {}
+        if self._thread:
+            self._released = True
+            self._wake.set()
+            self._thread.join(self.timeout)
+            self._thread = None
+
+    def _handle_signal(self, signum, frame):
+        if self.requested is None:
+            self.requested = time.time()
+            self.logger.warn("Task cancelled (signal %d)", signum)
+        self.stop()
+
+    def _run(self):
+        while True:
+            if self.requested is not None and self.build_id is not None:
+                self.cancel()
+                return
+            if self._released:
+                return
+            self._wake.wait(0.2)
+
+    def stop(self):
+        """Stop log follower and uploads"""
+        self.stopped.set()
+        if self.child_pid:
+            try:
+                os.kill(self.child_pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def set_build(self, build_id):
+        """Record created OSBS build, it's cancelled if the task was cancelled"""
+        self.build_id = build_id
+        self._wake.set()
+
+    def check(self):
+        """Raise ContainerCancelled if the task was cancelled"""
+        if self.requested is not None:
+            raise ContainerCancelled(self.message())
+
+    def message(self):
+        if self.build_id is None:
+            return "Task cancelled before OSBS build was created"
+        if self.latency is None:
+            return "Task cancelled, failed to cancel OSBS build %s" % self.build_id
+        return "Task cancelled, OSBS build %s cancelled" % self.build_id
+
+    def cancel(self):
+        """Cancel OSBS build with retries, returns True if it was cancelled"""
+        deadline = self.requested + self.timeout
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self._cancel_build(self.build_id)
+            except Exception, error:
+                if time.time() + delay > deadline:
+                    self.logger.error("Failed to cancel OSBS build %s (%d attempts): %s",
+                                      self.build_id, attempt, error)
+                    return False
+                self.logger.warn("Failed to cancel OSBS build %s (attempt #%d): %s",
+                                 self.build_id, attempt, error)
+                time.sleep(delay)
+                delay *= 2
+                continue
+            self.latency = time.time() - self.requested
+            self.logger.info("OSBS build %s cancelled %.2fs after cancel of the task "
+                             "(%d attempts)", self.build_id, self.latency, attempt)
+            return True
+
+
+def retryable_error(error):
+    """True if failed OSBS request may succeed when retried"""
+    if isinstance(error, (ContainerCancelled, ContainerError,
+                          orchestrator_not_enabled_exception())):
+        return False
+    if getattr(error, 'status_code', None) in RETRYABLE_STATUS_CODES:
+        return True
+    return RETRYABLE_ERRORS.search(str(error)) is not None
+
+
+class RetryPolicy(object):
+    """Retries OSBS requests which failed with transient errors
+
+    All calls of a task share budget of retries. Delay before a retry doubles
+    from delay up to max_delay, its random half is jitter so that tasks
+    failing at the same time don't retry at the same time.
+    """
+    def __init__(self, budget, delay, max_delay, logger):
+        self.budget = budget
+        self.delay = delay
+        self.max_delay = max_delay
+        self.logger = logger
+        self.retries = 0
+
+    def _delay(self, attempt):
+        delay = min(self.delay * 2 ** attempt, self.max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, what, func, stop=None):
+        """Returns result of func, retried while errors are transient
+
+        Errors are raised when they are permanent, the budget is spent or
+        stop() is true.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception, error:
+                if (self.retries >= self.budget or not retryable_error(error) or
+                        (stop and stop())):
+                    raise
+                delay = self._delay(attempt)
+                attempt += 1
+                self.retries += 1
+                self.logger.warn("%s failed, retry #%d in %.1fs: %s", what,
+                                 self.retries, delay, error)
+            time.sleep(delay)
+            if stop and stop():
+                raise error
+
+
+class ProgressReport(object):
+    """Progress of OSBS build of a task, published as PROGRESS_FILE
+
+    Holds ID and state of the OSBS build and state and repositories of each
+    platform. Platforms are 'pending' until their log shows up, 'building'
+    until the orchestrator reports images of their worker build.
+    """
+    def __init__(self, build_id, platforms):
+        self.build_id = build_id
+        self.data = {
+            'osbs_build_id': build_id,
+            'state': 'new',
+            'platforms': dict((platform, {'state': 'pending', 'repositories': []})
+                              for platform in platforms),
+            'repositories': [],
+            'koji_build_id': None,
+        }
+        self.checked = 0
+        self.published = None
+
+    def set_state(self, state):
+        self.data['state'] = state
+
+    def logs_seen(self, fnames):
+        for fname in fnames:
+            info = self.data['platforms'].get(fname.split('.', 1)[0])
+            if info and info['state'] == 'pending':
+                info['state'] = 'building'
+
+    def update_build(self, response):
+        """Take state of the build and its worker builds from OSBS response"""
+        if response.status:
+            self.data['state'] = response.status
+        metadata = (response.json or {}).get('metadata') or {}
+        try:
+            workers = json.loads((metadata.get('annotations') or {}).get('worker-builds')
+                                 or '{}')
+        except ValueError:
+            workers = {}
+        for platform, worker in workers.items():
+            repositories = sorted('%(registry)s/%(repository)s:%(tag)s' % digest
+                                  for digest in worker.get('digests') or [])
+            if repositories:
+                self.data['platforms'][platform] = {'state': 'succeeded',
+                                                    'repositories': repositories}
+
+    def finish(self, state, repositories=None, koji_build_id=None):
+        """Final state, platforms which didn't succeed get it too"""
+        self.data.update(state=state, repositories=repositories or [],
+                         koji_build_id=koji_build_id)
+        for info in self.data['platforms'].values():
+            if info['state'] != 'succeeded':
+                info['state'] = state
+
+    def content(self):
+        return json.dumps(self.data, indent=2, sort_keys=True) + '\n'
+
+
+class UploadCadence(object):
+    """Adapts interval and size of upload rounds to growth of logs
+
+    Interval doubles after a round with no new content and halves after a
+    round in which logs grew faster than busy_rate. Size of a round (per
+    log) doubles while content is left behind and halves while much less
+    than the size is appended.
+    """
+    def __init__(self, min_interval, max_interval, busy_rate, max_round_bytes):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.busy_rate = busy_rate
+        self.max_round_bytes = max(max_round_bytes, UPLOAD_BLOCK_SIZE)
+        self.interval = min(max(1.0, min_interval), max_interval)
+        self.round_bytes = min(16 * UPLOAD_BLOCK_SIZE, self.max_round_bytes)
+        self.rounds = 0
+        self.total_interval = 0.0
+        self.total_bytes = 0
+
+    def update(self, appended, backlog=False):
+        """Adjust cadence after a round
+
+        appended: bytes appended to logs since previous round
+        backlog: whether some content was left for the next round
+        """
+        self.rounds += 1
+        self.total_interval += self.interval
+        self.total_bytes += appended
+
+        if not appended:
+            self.interval = min(self.interval * 2, self.max_interval)
+        elif appended >= self.busy_rate * self.interval:
+            self.interval = max(self.interval / 2, self.min_interval)
+
+        if backlog:
+            self.round_bytes = min(self.round_bytes * 2, self.max_round_bytes)
+        elif appended < self.round_bytes / 4:
+            self.round_bytes = max(self.round_bytes // 2, UPLOAD_BLOCK_SIZE)
+
+    def summary(self):
+        """Returns (rounds, average interval, average bytes per round)"""
+        if not self.rounds:
+            return (0, 0.0, 0)
+        return (self.rounds, self.total_interval / self.rounds,
+                self.total_bytes // self.rounds)
+
+
+class BufferFile(object):
+    """Minimal read-only file object over a string which starts at offset
+
+    Allows to upload content held in memory via incremental_upload().
+    """
+    def __init__(self, data, offset=0):
+        self._data = data
+        self._offset = offset
+        self._pos = 0
+
+    def tell(self):
+        return self._offset + self._pos
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self._data) - self._pos
+        data = self._data[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+class LogStream(object):
+    """Log streamed to the hub without writing it to the disk first
+
+    Appended content is kept in memory until it's uploaded. When more than
+    max_buffer bytes are waiting for upload (the hub is slow) new content is
+    appended to spool file instead and uploaded from there after content in
+    memory, so reading of logs never waits for the hub. The spool file is
+    removed once it's drained.
+    """
+    def __init__(self, fname, spool_path, max_buffer):
+        self.fname = fname
+        self._spool_path = spool_path
+        self._max_buffer = max_buffer
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffered = 0
+        self._spool = None
+        self._spool_written = 0
+        self._spool_read = 0
+        # bytes appended to the log and offset of the next upload
+        self.received = 0
+        self.uploaded = 0
+
+    def append(self, data):
+        with self._lock:
+            self.received += len(data)
+            if self._spool is None and self._buffered + len(data) <= self._max_buffer:
+                self._buffer.append(data)
+                self._buffered += len(data)
+                return
+            if self._spool is None:
+                self._spool = open(self._spool_path, 'w+b')
+                self._spool_written = self._spool_read = 0
+            self._spool.seek(self._spool_written)
+            self._spool.write(data)
+            self._spool_written += len(data)
+
+    def pending(self):
+        return self.received - self.uploaded
+
+    def take(self, size):
+        """Returns next at most size bytes of content to upload"""
+        with self._lock:
+            if self._buffer:
+                data = ''.join(self._buffer)
+                self._buffer = [data[size:]] if len(data) > size else []
+                data = data[:size]
+                self._buffered -= len(data)
+                return data
+            if self._spool is not None:
+                if self._spool_read < self._spool_written:
+                    self._spool.seek(self._spool_read)
+                    data = self._spool.read(min(size, self._spool_written - self._spool_read))
+                    self._spool_read += len(data)
+                    return data
+                self.close()
+            return ''
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            os.unlink(self._spool_path)
+            self._spool = None
+
+
+class GzipWriter(object):
+    """Writes gzip stream to fileobj, the same content always the same way
+
+    The header has no file name and zero mtime. GzipFile takes mtime only
+    since Python 2.7. Closing doesn't close fileobj.
+    """
+    # magic, deflate, no flags, mtime 0, no extra flags, unknown OS
+    HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+    def __init__(self, fileobj, level=6):
+        self.fileobj = fileobj
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                            zlib.DEF_MEM_LEVEL, 0)
+        self._crc = zlib.crc32('') & 0xffffffff
+        self._size = 0
+        self.fileobj.write(self.HEADER)
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc) & 0xffffffff
+        self._size += len(data)
+        self.fileobj.write(self._compressor.compress(data))
+
+    def flush(self):
+        self.fileobj.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.write(self._compressor.flush())
+        self.fileobj.write(struct.pack('<II', self._crc, self._size & 0xffffffff))
+        self.fileobj.flush()
+
+
+class LogCompressor(object):
+    """Stream-compress logs from a directory into .log.gz files
+
+    Only content appended since the previous call is read and compressed so
+    memory use doesn't depend on the size of the logs. Compressed files are
+    flushed after every call, which makes everything written so far readable
+    (e.g. with zcat) while the build is still running. When a log is replaced
+    or truncated its compressed file is written again from the beginning.
+    """
+    def __init__(self, source_dir, target_dir, logger, level=6):
+        self._source_dir = source_dir
+        self._target_dir = target_dir
+        self.logger = logger
+        self._level = level
+        self._logs = {}
+
+    def _open(self, fname, stat_info):
+        fd = file(os.path.join(self._source_dir, fname), 'r')
+        # fixed mtime makes output the same for the same content so already
+        # uploaded part can be reused when log is compressed again
+        gz_path = os.path.join(self._target_dir, fname + '.gz')
+        gz = GzipWriter(open_new(gz_path), self._level)
+        self._logs[fname] = (fd, gz, stat_info.st_ino)
+        return fd, gz
+
+    def _close(self, fname):
+        fd, gz, inode = self._logs.pop(fname)
+        fd.close()
+        gz.close()
+        gz.fileobj.close()
+
+    def compress(self, final=False):
+        """Compress new content of all logs
+
+        final: whether the logs are complete and compressed files can be
+               finished
+        """
+        koji.ensuredir(self._target_dir)
+        try:
+            fnames = [fname for fname in os.listdir(self._source_dir)
+                      if fname.endswith('.log')]
+        except OSError:
+            return
+        for fname in fnames:
+            stat_info = os.stat(os.path.join(self._source_dir, fname))
+            if fname in self._logs:
+                fd, gz, inode = self._logs[fname]
+                if stat_info.st_ino != inode or stat_info.st_size < fd.tell():
+                    self.logger.info('Compressing %s again', fname)
+                    self._close(fname)
+            if fname not in self._logs:
+                fd, gz = self._open(fname, stat_info)
+            while True:
+                data = fd.read(UPLOAD_BLOCK_SIZE)
+                if not data:
+                    break
+                gz.write(data)
+            gz.flush()
+            if final:
+                self._close(fname)
+
+    def clean(self):
+        for fname in self._logs.keys():
+            self._close(fname)
+
+
+class LogFiles(object):
+    """Demultiplexed log files with limited number of open handles
+
+    When more than max_open files would be open the least recently written
+    one is closed, it's reopened in append mode when it's written again. Use
+    as a context manager so that all files are closed even on errors.
+    """
+    def __init__(self, logs_dir, max_open=8):
+        self._logs_dir = logs_dir
+        self._max_open = max(max_open, 1)
+        # plain dicts with lists keeping the order, OrderedDict is missing
+        # in Python 2.6
+        self._handles = {}
+        self._recent = []
+        self._sizes = {}
+        self._created = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def path(self, prefix):
+        return os.path.join(self._logs_dir, '%s.log' % prefix)
+
+    def _open(self, prefix):
+        while len(self._handles) >= self._max_open:
+            oldest = self._recent.pop(0)
+            self._handles.pop(oldest).close()
+        # first open replaces log written by previous attempt
+        if prefix in self._sizes:
+            fd = open(self.path(prefix), 'ab')
+        else:
+            fd = open_new(self.path(prefix))
+            self._sizes[prefix] = 0
+            self._created.append(prefix)
+        return fd
+
+    def write(self, prefix, data):
+        """Write data to log of prefix, returns offset at which it starts"""
+        fd = self._handles.get(prefix)
+        if fd is None:
+            fd = self._handles[prefix] = self._open(prefix)
+        else:
+            self._recent.remove(prefix)
+        self._recent.append(prefix)
+        offset = self._sizes[prefix]
+        fd.write(data)
+        fd.flush()
+        self._sizes[prefix] = offset + len(data)
+        return offset
+
+    def sizes(self):
+        """Returns list of (prefix, size) of all logs in order of creation"""
+        return [(prefix, self._sizes[prefix]) for prefix in self._created]
+
+    def close(self):
+        while self._recent:
+            self._handles.pop(self._recent.pop()).close()
+
+
+class LogIndexer(object):
+    """Builds index of an atomic-reactor log while the log is being written
+
+    The index is written as JSON to path. It lists plugins which were run with
+    byte offsets of their part of the log, start times (seconds since epoch,
+    in the timezone of the log) and durations, and error lines with their
+    offsets. The index is rewritten at most every write_interval seconds.
+    """
+    LINE_RE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(?:,(\d+))? - (\S+) - ([A-Z]+) - (.*)$')
+    PLUGIN_RE = re.compile(r"^running plugin '([^']+)'")
+    PLUGIN_FAILED_RE = re.compile(r"^plugin '([^']+)' raised an exception")
+    MAX_ERRORS = 100
+    MAX_MESSAGE = 256
+
+    def __init__(self, path, write_interval=5):
+        self.path = path
+        self._write_interval = write_interval
+        self._plugins = []
+        self._errors = []
+        self._last_time = None
+        self._written = 0
+        self._changed = False
+
+    @staticmethod
+    def _parse_time(timestamp):
+        date, msec = timestamp
+        seconds = calendar.timegm(time.strptime(date, '%Y-%m-%d %H:%M:%S'))
+        if msec:
+            seconds += int(msec) / 1000.0
+        return seconds
+
+    def _close_plugin(self, offset):
+        if self._plugins and self._plugins[-1]['end'] is None:
+            plugin = self._plugins[-1]
+            plugin['end'] = offset
+            if self._last_time:
+                plugin['duration'] = round(self._parse_time(self._last_time) -
+                                           plugin['started'], 3)
+
+    def feed(self, offset, line):
+        """Process line of log which starts at byte offset"""
+        match = self.LINE_RE.match(line)
+        if not match:
+            return
+        self._last_time = match.group(1, 2)
+        level, message = match.group(4, 5)
+
+        plugin_match = self.PLUGIN_RE.match(message)
+        if plugin_match:
+            self._close_plugin(offset)
+            self._plugins.append({
+                'name': plugin_match.group(1),
+                'offset': offset,
+                'end': None,
+                'started': self._parse_time(self._last_time),
+                'duration': None,
+                'failed': False,
+            })
+            self._changed = True
+
+        if level in ('ERROR', 'CRITICAL'):
+            failed_match = self.PLUGIN_FAILED_RE.match(message)
+            if failed_match:
+                for plugin in reversed(self._plugins):
+                    if plugin['name'] == failed_match.group(1):
+                        plugin['failed'] = True
+                        break
+            if len(self._errors) < self.MAX_ERRORS:
+                current = self._plugins[-1] if self._plugins else None
+                self._errors.append({
+                    'offset': offset,
+                    'plugin': current['name'] if current and current['end'] is None else None,
+                    'message': message[:self.MAX_MESSAGE],
+                })
+            self._changed = True
+
+        if self._changed and time.time() - self._written >= self._write_interval:
+            self.write()
+
+    def finish(self, size):
+        """Finish index of log which has size bytes"""
+        self._close_plugin(size)
+        self._changed = True
+        self.write(size)
+
+    def write(self, size=None):
+        index = {
+            'version': 1,
+            'size': size,
+            'plugins': self._plugins,
+            'errors': self._errors,
+        }
+        # replace the file at once so that incomplete index isn't uploaded
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump(index, fd, separators=(',', ':'))
+        os.rename(tmp_path, self.path)
+        self._written = time.time()
+        self._changed = False
+
+
+class FailureClassifier(object):
+    """Finds which known failure signature build logs match
+
+    All signatures are combined into one regular expression so each line is
+    searched only once, and only a few lines of context are kept in memory.
+    Lines can be fed while logs are streamed or whole log files classified.
+    """
+    CONTEXT_LINES = 3
+    MAX_LINE = 500
+
+    def __init__(self, signatures=None):
+        if signatures is None:
+            signatures = FAILURE_SIGNATURES
+        self._classes = [name for name, regex in signatures]
+        self._regex = re.compile('|'.join('(?P<s%d>%s)' % (i, regex)
+                                          for i, (name, regex) in enumerate(signatures)))
+        self._contexts = {}
+        self._best = None
+
+    def feed(self, name, line):
+        """Process line of log name
+
+        Returns True when the first of signatures has matched and nothing
+        else can change the result.
+        """
+        line = line[:self.MAX_LINE].rstrip('\n') + '\n'
+        context = self._contexts.setdefault(
+            name, collections.deque(maxlen=self.CONTEXT_LINES))
+        match = self._regex.search(line)
+        if match:
+            index = int(match.lastgroup[1:])
+            if self._best is None or index < self._best[0]:
+                self._best = (index, name, ''.join(context) + line)
+        context.append(line)
+        return self._best is not None and self._best[0] == 0
+
+    def result(self):
+        """Returns (failure class, log excerpt) or (None, None)
+
+        If more signatures match, the first one from signatures wins. For the
+        same signature the first matching line is used.
+        """
+        if self._best is None:
+            return (None, None)
+        index, name, excerpt = self._best
+        excerpt = '%s:\n%s' % (name, excerpt.rstrip('\n'))
+        if isinstance(excerpt, unicode):
+            excerpt = excerpt.encode('utf-8')
+        return (self._classes[index], excerpt)
+
+    def classify(self, paths):
+        """Returns result() for logs in paths"""
+        for path in paths:
+            name = os.path.basename(path)
+            with open(path, 'r') as fd:
+                for line in fd:
+                    if self.feed(name, line):
+                        return self.result()
+        return self.result()
+
+
+class SerializedSession(object):
+    """Koji session which can be shared by threads
+
+    Hub calls are made one at a time. They have to reach the hub in order
+    of their call numbers, see koji.ClientSession.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._session, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def locked_call(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return locked_call
+
+
 class LabelsWrapper(object):
     def __init__(self, dockerfile_path, logger_name=None, label_overwrites=None):
         self.dockerfile_path = dockerfile_path
@@ -187,11 +1543,12 @@ class LabelsWrapper(object):
 
     def _setup_logger(self, logger_name=None):
         if logger_name:
-            dockerfile_parse.parser.logger = logging.getLogger("%s.dockerfile_parse"
-                                                               % logger_name)
+            parser = _import_dockerfile_parse()
+            parser.logger = logging.getLogger("%s.dockerfile_parse" % logger_name)
 
     def _parse(self):
-        self._parser = dockerfile_parse.parser.DockerfileParser(self.dockerfile_path)
+        parser = _import_dockerfile_parse()
+        self._parser = parser.DockerfileParser(self.dockerfile_path)
 
     def get_labels(self):
         """returns all labels how they are found in Dockerfile"""
@@ -281,6 +1638,11 @@ class BuildContainerTask(BaseTaskHandler):
         BaseTaskHandler.__init__(self, id, method, params, session, options,
                                  workdir)
         self._osbs = None
+        self._config = None
+        self._log_classifier = None
+        self._source_commit = None
+        self._canceller = None
+        self._progress = None
         self.demux = demux
 
         self._log_handler_added = False
@@ -288,22 +1650,33 @@ class BuildContainerTask(BaseTaskHandler):
     def osbs(self):
         """Handler of OSBS object"""
         if not self._osbs:
-            os_conf = Configuration()
-            build_conf = Configuration()
-            if self.opts.get('scratch'):
-                os_conf = Configuration(conf_section='scratch')
-                build_conf = Configuration(conf_section='scratch')
-            self._osbs = OSBS(os_conf, build_conf)
+            self._osbs = self._create_osbs()
             assert self._osbs
             self.setup_osbs_logging()
 
         return self._osbs
 
+    def _create_osbs(self):
+        osbs = _import_osbs()
+        Configuration = osbs.conf.Configuration
+        os_conf = Configuration()
+        build_conf = Configuration()
+        if self.opts.get('scratch'):
+            os_conf = Configuration(conf_section='scratch')
+            build_conf = Configuration(conf_section='scratch')
+        return osbs.api.OSBS(os_conf, build_conf)
+
+    def config(self):
+        """Plugin configuration, see CONFIG_DEFAULTS"""
+        if self._config is None:
+            self._config = read_config()
+        return self._config
+
     def setup_osbs_logging(self):
         # Setting handler more than once will cause duplicated log lines.
         # Log handler will persist in child process.
         if not self._log_handler_added:
-            osbs_logger = logging.getLogger(osbs.__name__)
+            osbs_logger = logging.getLogger('osbs')
             osbs_logger.setLevel(logging.INFO)
             log_file = os.path.join(self.resultdir(), 'osbs-client.log')
             handler = logging.FileHandler(filename=log_file)
@@ -326,25 +1699,197 @@ class BuildContainerTask(BaseTaskHandler):
             os.makedirs(path)
         return path
 
+    def compressed_resultdir(self):
+        return os.path.join(self.workdir, 'osbslogs-compressed')
+
     def _incremental_upload_logs(self, child_pid):
         resultdir = self.resultdir()
         uploadpath = self.getUploadPath()
-        watcher = FileWatcher(resultdir, logger=self.logger)
+        compress_logs = self.config()['compress_logs']
+        compressor = None
+        if compress_logs in ('completed', 'live'):
+            compressor = LogCompressor(resultdir, self.compressed_resultdir(),
+                                       logger=self.logger,
+                                       level=self.config()['compress_level'])
+            watchers = [
+                FileWatcher(self.compressed_resultdir(), logger=self.logger,
+                            truncate_upload=self._truncate_upload,
+                            suffix='.log.gz',
+                            large_log_threshold=self.config()['large_log_threshold'],
+                            large_log_window=self.config()['large_log_window']),
+                FileWatcher(resultdir, logger=self.logger,
+                            truncate_upload=self._truncate_upload,
+                            suffix='.idx.json'),
+            ]
+        else:
+            watchers = [
+                FileWatcher(resultdir, logger=self.logger,
+                            truncate_upload=self._truncate_upload,
+                            suffix=('.log', '.idx.json'),
+                            large_log_threshold=self.config()['large_log_threshold'],
+                            large_log_window=self.config()['large_log_window']),
+            ]
+        limiter = self._upload_limiter()
+        config = self.config()
+        cadence = UploadCadence(config['upload_interval_min'],
+                                config['upload_interval_max'],
+                                config['upload_busy_rate'],
+                                config['upload_round_max'])
+        # sizes of logs at previous round, to tell growth from backlog
+        sizes = {}
         finished = False
         try:
             while not finished:
-                time.sleep(1)
-                status = os.waitpid(child_pid, os.WNOHANG)
-                if status[0] != 0:
-                    finished = True
-
-                for result in watcher.files_to_upload():
-                    if result is False:
-                        return
-                    (fd, fname) = result
+                finished = self._wait_for_child(child_pid, cadence.interval)
+
+                if compressor and (finished or compress_logs == 'live'):
+                    compressor.compress(final=finished)
+
+                # orchestrator log goes first as it's the most important one
+                results = []
+                for watcher in watchers:
+                    results.extend(watcher.files_to_upload())
+                results.sort(key=lambda result: not result[1].startswith('orchestrator.'))
+                appended = 0
+                backlog = False
+                for (fd, fname) in results:
+                    pending = fd.pending()
+                    size = fd.tell() + pending
+                    previous = sizes.get(fname, 0)
+                    # a replaced log counts whole, it's written again
+                    appended += size - previous if size >= previous else size
+                    sizes[fname] = size
+                    if not finished and pending > cadence.round_bytes:
+                        fd.limit = pending = cadence.round_bytes
+                        backlog = True
+                    if limiter:
+                        if not pending:
+                            continue
+                        calls = (pending + UPLOAD_BLOCK_SIZE - 1) // UPLOAD_BLOCK_SIZE
+                        priority = finished or fname.startswith('orchestrator.')
+                        if not limiter.acquire(pending, calls, priority=priority):
+                            # content is kept in the file and uploaded
+                            # together with more content in later round
+                            self.logger.debug("Upload of %s throttled, %d bytes "
+                                              "pending", fname, pending)
+                            backlog = True
+                            continue
                     incremental_upload(self.session, fname, fd, uploadpath, logger=self.logger)
+
+                self._publish_progress([fname for (fd, fname) in results])
+                self.logger.debug("Upload round: interval %.2fs, %d bytes",
+                                  cadence.interval, appended)
+                cadence.update(appended, backlog=backlog)
+            self.logger.info("Log uploads: %d rounds, average interval %.2fs, "
+                             "average %d bytes per round", *cadence.summary())
         finally:
-            watcher.clean()
+            for watcher in watchers:
+                watcher.clean()
+            if compressor:
+                compressor.clean()
+
+    def _wait_for_child(self, child_pid, timeout):
+        """Sleep for timeout seconds or until child exits
+
+        Returns True if the child has exited.
+        """
+        deadline = time.time() + timeout
+        while True:
+            time.sleep(max(min(deadline - time.time(), 0.5), 0))
+            status = os.waitpid(child_pid, os.WNOHANG)
+            if status[0] != 0:
+                return True
+            if time.time() >= deadline:
+                return False
+
+    def _upload_limiter(self):
+        """Returns UploadLimiter as configured or None if uploads are unlimited"""
+        config = self.config()
+        if not config['upload_rate_bytes'] and not config['upload_rate_calls']:
+            return None
+        return UploadLimiter(config['upload_rate_bytes'], config['upload_rate_calls'],
+                             burst=config['upload_burst'],
+                             reserve=config['upload_reserve'],
+                             state_file=config['upload_limit_state'] or None)
+
+    def _admission_control(self):
+        """Returns AdmissionControl as configured or None if it's disabled"""
+        config = self.config()
+        if not config['admission_max_queue'] and not config['admission_max_latency']:
+            return None
+        return AdmissionControl(config['admission_state'],
+                                max_queue=config['admission_max_queue'],
+                                max_latency=config['admission_max_latency'],
+                                sample_interval=config['admission_sample_interval'],
+                                latency_window=config['admission_latency_window'],
+                                metrics_file=config['admission_metrics'] or None)
+
+    def _cancelled(self):
+        """True once the task was cancelled, see CancelCoordinator"""
+        return self._canceller is not None and self._canceller.stopped.is_set()
+
+    def _osbs_section(self):
+        return 'scratch' if self.opts.get('scratch') else 'default'
+
+    def _osbs_queue_depth(self):
+        """Returns number of builds waiting to get scheduled in OSBS"""
+        # not self.osbs(), this runs in kojid itself which mustn't log
+        # into resultdir of the task
+        osbs = self._create_osbs()
+        try:
+            builds = osbs.list_builds(running=True)
+        except TypeError:
+            # older osbs-client
+            builds = osbs.list_builds()
+        return len([build for build in builds if build.is_pending()])
+
+    def _find_task_build(self):
+        """Returns ID of unfinished OSBS build of this task, or None"""
+        try:
+            builds = self.osbs().list_builds(koji_task_id=self.id)
+        except TypeError:
+            # older osbs-client can't select builds of a task
+            return None
+        for build in builds:
+            if build.is_running() or build.is_pending():
+                return build.get_build_name()
+        return None
+
+    def checkHost(self, hostdata):
+        """Called by kojid before it takes the task, False declines it
+
+        The task stays free in the hub queue while OSBS is saturated.
+        """
+        admission = self._admission_control()
+        if admission is None:
+            return True
+        opts = None
+        if isinstance(self.params, (list, tuple)) and len(self.params) > 2:
+            opts = self.params[2]
+        self.opts = opts or {}
+        try:
+            admitted, reason = admission.admit(self._osbs_section(),
+                                               self._osbs_queue_depth)
+        except Exception:
+            # kojid would decline the task, rather let it build
+            self.logger.warn("Admission control failed", exc_info=True)
+            return True
+        if not admitted:
+            self.logger.info("Declining task %s, OSBS is saturated (%s)",
+                             self.id, reason)
+        return admitted
+
+    def _truncate_upload(self, fname, size):
+        """Truncate already uploaded log on the hub to size bytes
+
+        Returns False if the hub doesn't support it.
+        """
+        try:
+            self.session.truncateContainerUpload(self.getUploadPath(), fname, size)
+        except koji.GenericError, error:
+            self.logger.warn("Couldn't truncate uploaded %s: %s", fname, error)
+            return False
+        return True
 
     def _write_combined_log(self, build_id, logs_dir):
         log_basename = 'openshift-incremental.log'
@@ -356,17 +1901,23 @@ class BuildContainerTask(BaseTaskHandler):
         except Exception, error:
             msg = "Exception while waiting for build logs: %s" % error
             raise ContainerError(msg)
-        outfile = open(log_filename, 'wb')
+        tail = collections.deque(maxlen=self.config()['failure_tail_lines'])
+        tails_written = time.time()
+        outfile = open_new(log_filename)
         try:
             for line in log:
                 outfile.write(("%s\n" % line).encode('utf-8'))
                 outfile.flush()
+                tail.append(line)
+                tails_written = self._write_log_tails_due(
+                    logs_dir, {'openshift-incremental': tail}, tails_written)
         except Exception, error:
             msg = "Exception (%s) while writing build logs: %s" % (type(error),
                                                                    error)
             raise ContainerError(msg)
         finally:
             outfile.close()
+            self._write_log_tails(logs_dir, {'openshift-incremental': tail})
         self.logger.info("%s written", log_basename)
 
     def _write_demultiplexed_logs(self, build_id, logs_dir):
@@ -376,23 +1927,90 @@ class BuildContainerTask(BaseTaskHandler):
         except Exception, error:
             msg = "Exception while waiting for orchestrator build logs: %s" % error
             raise ContainerError(msg)
-        platform_logs = {}
-        for entry in logs:
-            platform = entry.platform
-            if platform not in platform_logs:
-                prefix = 'orchestrator' if platform is None else platform
-                log_filename = os.path.join(logs_dir, "%s.log" % prefix)
-                platform_logs[platform] = open(log_filename, 'wb')
-            try:
-                platform_logs[platform].write((entry.line + '\n').encode('utf-8'))
-                platform_logs[platform].flush()
-            except Exception, error:
-                msg = "Exception (%s) while writing build logs: %s" % (type(error),
-                                                                       error)
-                raise ContainerError(msg)
-        for logfile in platform_logs.values():
-            logfile.close()
-            self.logger.info("%s written", logfile.name)
+        indexers = {}
+        tails = {}
+        tails_written = time.time()
+        try:
+            with LogFiles(logs_dir, max_open=self.config()['max_open_logs']) as log_files:
+                for entry in logs:
+                    prefix = 'orchestrator' if entry.platform is None else entry.platform
+                    if prefix not in indexers:
+                        indexers[prefix] = LogIndexer(os.path.join(logs_dir,
+                                                                   "%s.idx.json" % prefix))
+                        tails[prefix] = collections.deque(
+                            maxlen=self.config()['failure_tail_lines'])
+                    try:
+                        offset = log_files.write(prefix, (entry.line + '\n').encode('utf-8'))
+                        indexers[prefix].feed(offset, entry.line)
+                        tails[prefix].append(entry.line)
+                        tails_written = self._write_log_tails_due(logs_dir, tails,
+                                                                  tails_written)
+                    except Exception, error:
+                        msg = "Exception (%s) while writing build logs: %s" % (type(error),
+                                                                               error)
+                        raise ContainerError(msg)
+        finally:
+            self._write_log_tails(logs_dir, tails)
+        for prefix, size in log_files.sizes():
+            indexers[prefix].finish(size)
+            self.logger.info("%s written", log_files.path(prefix))
+
+    def _write_log_tails(self, logs_dir, tails):
+        """Save last lines of logs for failure summary, see _failure_tail()"""
+        tails_path = os.path.join(logs_dir, LOG_TAILS_FILE)
+        try:
+            with open(tails_path + '.tmp', 'w') as fd:
+                json.dump(dict((prefix, list(tail)) for prefix, tail in tails.items()), fd)
+            os.rename(tails_path + '.tmp', tails_path)
+        except Exception, error:
+            self.logger.error("Failed to save tails of logs: %s", error)
+
+    def _write_log_tails_due(self, logs_dir, tails, written):
+        """Save tails if LOG_TAILS_INTERVAL passed since written
+
+        Returns time of the last save. Logs are read until the build
+        finishes, the tails are saved periodically to be available when the
+        task is cancelled meanwhile.
+        """
+        now = time.time()
+        if now - written < LOG_TAILS_INTERVAL:
+            return written
+        self._write_log_tails(logs_dir, tails)
+        return now
+
+    def _failure_tail(self, reason):
+        """Upload last lines of logs of failed or cancelled build
+
+        Returns summary of the lines for error message, as unicode.
+        """
+        try:
+            with open(os.path.join(self.resultdir(), LOG_TAILS_FILE), 'r') as fd:
+                tails = json.load(fd)
+        except (IOError, ValueError), error:
+            self.logger.info("No tails of logs available: %s", error)
+            return ''
+
+        # platform logs first, orchestrator log usually only repeats them
+        prefixes = sorted(tails, key=lambda prefix: (prefix == 'orchestrator', prefix))
+        tail_path = os.path.join(self.workdir, FAILURE_TAIL_LOG)
+        with open(tail_path, 'w') as fd:
+            fd.write((u'%s\n' % to_unicode(reason)).encode('utf-8'))
+            for prefix in prefixes:
+                fd.write((u'\n==> %s.log <==\n' % prefix).encode('utf-8'))
+                fd.write(u''.join(u'%s\n' % to_unicode(line)
+                                  for line in tails[prefix]).encode('utf-8'))
+        try:
+            self.uploadFile(tail_path)
+        except Exception, error:
+            self.logger.error("Failed to upload %s: %s", FAILURE_TAIL_LOG, error)
+
+        summary = []
+        for prefix in prefixes:
+            lines = tails[prefix][-FAILURE_TAIL_MESSAGE_LINES:]
+            if lines:
+                summary.append(u'Last lines of %s.log:\n%s' % (
+                    prefix, u'\n'.join(to_unicode(line) for line in lines)))
+        return u'\n'.join(summary)
 
     def _write_incremental_logs(self, build_id, logs_dir):
         build_logs = None
@@ -406,6 +2024,262 @@ class BuildContainerTask(BaseTaskHandler):
             raise ContainerError("Build log finished but build still has not "
                                  "finished: %s." % build_response.status)
 
+    def _upload_logs_from_child(self, build_id, logs_dir):
+        """Upload logs of OSBS build which are written by forked child"""
+        pid = os.fork()
+        if pid:
+            if self._canceller:
+                self._canceller.child_pid = pid
+            try:
+                self._incremental_upload_logs(pid)
+            except koji.ActionNotAllowed:
+                pass
+        else:
+            # cancel is handled by parent, which kills this process
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self._osbs = None
+
+            # Following retry code is here mainly to workaround bug which causes
+            # connection drop while reading logs after about 5 minutes.
+            # OpenShift bug with description:
+            # https://github.com/openshift/origin/issues/2348
+            # and upstream bug in Kubernetes:
+            # https://github.com/GoogleCloudPlatform/kubernetes/issues/9013
+            retry = 0
+            max_retries = 30
+            while retry < max_retries:
+                try:
+                    self._write_incremental_logs(build_id, logs_dir)
+                except Exception, error:
+                    self.logger.info("Error while saving incremental logs "
+                                     "(retry #%d): %s", retry, error)
+                    retry += 1
+                    time.sleep(10)
+                    continue
+                break
+            else:
+                self.logger.info("Gave up trying to save incremental logs "
+                                 "after #%d retries.", retry)
+                os._exit(1)
+            os._exit(0)
+
+    def _read_logs_to_streams(self, osbs, build_id, streams, streams_lock, data_ready,
+                              state):
+        """Follow logs of OSBS build and append them to streams
+
+        Used in direct mode instead of _write_incremental_logs(). Content which
+        is received again after the follower was restarted is skipped. state
+        keeps indexers and tails of logs between restarts. osbs is the client
+        of the reader thread.
+        """
+        logs_dir = self.resultdir()
+        if self.demux and hasattr(osbs, 'get_orchestrator_build_logs'):
+            logs = osbs.get_orchestrator_build_logs(build_id, follow=True)
+            entries = (('orchestrator' if entry.platform is None else entry.platform,
+                        entry.line) for entry in logs)
+        else:
+            logs = osbs.get_build_logs(build_id, follow=True)
+            entries = (('openshift-incremental', line) for line in logs)
+
+        indexers = state.setdefault('indexers', {})
+        tails = state.setdefault('tails', {})
+        received = {}
+        tails_written = time.time()
+        try:
+            for prefix, line in entries:
+                if self._cancelled():
+                    return
+                fname = '%s.log' % prefix
+                data = (line + '\n').encode('utf-8')
+                with streams_lock:
+                    if fname not in streams:
+                        streams[fname] = LogStream(fname,
+                                                   os.path.join(logs_dir, fname + '.spool'),
+                                                   self.config()['direct_log_buffer'])
+                        indexers[prefix] = LogIndexer(os.path.join(logs_dir,
+                                                                   "%s.idx.json" % prefix))
+                        tails[prefix] = collections.deque(
+                            maxlen=self.config()['failure_tail_lines'])
+                    stream = streams[fname]
+                offset = received.get(prefix, 0)
+                received[prefix] = offset + len(data)
+                if offset < stream.received:
+                    continue
+                stream.append(data)
+                data_ready.set()
+                indexers[prefix].feed(offset, line)
+                tails[prefix].append(line)
+                tails_written = self._write_log_tails_due(logs_dir, tails, tails_written)
+                self._log_classifier.feed(fname, line)
+        finally:
+            self._write_log_tails(logs_dir, tails)
+
+        build_response = osbs.get_build(build_id)
+        if (build_response.is_running() or build_response.is_pending()):
+            raise ContainerError("Build log finished but build still has not "
+                                 "finished: %s." % build_response.status)
+        for prefix, indexer in indexers.items():
+            indexer.finish(streams['%s.log' % prefix].received)
+
+    def _follow_logs_to_streams(self, build_id, streams, streams_lock, data_ready):
+        """Thread reading logs in direct mode, retries like the log follower
+
+        The thread has its own OSBS client, the one of the task is used by
+        the main thread meanwhile and its HTTP session isn't thread-safe.
+        """
+        state = {}
+        retry = 0
+        max_retries = 30
+        osbs = None
+        try:
+            while retry < max_retries and not self._cancelled():
+                try:
+                    if osbs is None:
+                        osbs = self._create_osbs()
+                    self._read_logs_to_streams(osbs, build_id, streams, streams_lock,
+                                               data_ready, state)
+                except Exception, error:
+                    self.logger.info("Error while streaming incremental logs "
+                                     "(retry #%d): %s", retry, error)
+                    retry += 1
+                    time.sleep(10)
+                    continue
+                break
+            else:
+                if not self._cancelled():
+                    self.logger.info("Gave up trying to stream incremental logs "
+                                     "after #%d retries.", retry)
+        finally:
+            data_ready.set()
+
+    def _stream_logs_to_hub(self, build_id):
+        """Upload logs of OSBS build to the hub as they are read
+
+        Direct mode: there are no log files on the builder unless uploads
+        fall behind, see LogStream. Logs are read in a thread while this
+        thread uploads them, so the koji session is used only from here.
+        """
+        resultdir = self.resultdir()
+        uploadpath = self.getUploadPath()
+        config = self.config()
+        self._log_classifier = FailureClassifier(FAILURE_SIGNATURES +
+                                                 config['failure_signatures'])
+        streams = {}
+        streams_lock = threading.Lock()
+        data_ready = threading.Event()
+        reader = threading.Thread(target=self._follow_logs_to_streams,
+                                  args=(build_id, streams, streams_lock, data_ready))
+        reader.daemon = True
+        reader.start()
+
+        limiter = self._upload_limiter()
+        finished = False
+        try:
+            while not finished:
+                data_ready.wait(config['upload_interval_max'])
+                data_ready.clear()
+                finished = not reader.is_alive()
+                round_start = time.time()
+
+                with streams_lock:
+                    # orchestrator log goes first as it's the most important one
+                    current = sorted(streams.values(),
+                                     key=lambda stream: not stream.fname.startswith('orchestrator.'))
+                for stream in current:
+                    pending = stream.pending()
+                    if not pending:
+                        continue
+                    if limiter:
+                        calls = (pending + UPLOAD_BLOCK_SIZE - 1) // UPLOAD_BLOCK_SIZE
+                        priority = finished or stream.fname.startswith('orchestrator.')
+                        if not limiter.acquire(pending, calls, priority=priority):
+                            # content waits in memory or spool for later round
+                            continue
+                    # upload only what's there now, not to starve other logs
+                    while pending > 0:
+                        data = stream.take(min(pending, config['upload_round_max']))
+                        if not data:
+                            break
+                        incremental_upload(self.session, stream.fname,
+                                           BufferFile(data, stream.uploaded),
+                                           uploadpath, logger=self.logger)
+                        stream.uploaded += len(data)
+                        pending -= len(data)
+
+                self._publish_progress([stream.fname for stream in current])
+                # coalesce lines arriving in quick succession into one upload
+                if not finished:
+                    time.sleep(max(config['upload_interval_min'] -
+                                   (time.time() - round_start), 0))
+        finally:
+            with streams_lock:
+                for stream in streams.values():
+                    stream.close()
+
+        # these are complete only now
+        for fname in sorted(os.listdir(resultdir)):
+            if fname.endswith('.idx.json') or fname == 'osbs-client.log':
+                try:
+                    self.uploadFile(os.path.join(resultdir, fname))
+                except Exception, error:
+                    self.logger.error("Failed to upload %s: %s", fname, error)
+
+    def _publish_progress(self, logs=()):
+        """Upload PROGRESS_FILE if progress of the build changed
+
+        logs are names of logs which have content, state of the OSBS build is
+        checked at most every progress_interval seconds.
+        """
+        progress = self._progress
+        if not progress:
+            return
+        progress.logs_seen(logs)
+        now = time.time()
+        if now - progress.checked >= self.config()['progress_interval']:
+            progress.checked = now
+            try:
+                progress.update_build(self.osbs().get_build(progress.build_id))
+            except Exception, error:
+                self.logger.debug("Failed to get state of OSBS build %s: %s",
+                                  progress.build_id, error)
+        content = progress.content()
+        if content == progress.published:
+            return
+        try:
+            incremental_upload(self.session, PROGRESS_FILE, BufferFile(content),
+                               self.getUploadPath(), logger=self.logger)
+        except Exception, error:
+            self.logger.warn("Failed to upload %s: %s", PROGRESS_FILE, error)
+            return
+        progress.published = content
+
+    def _finish_progress(self, response):
+        """Publish final progress of finished OSBS build"""
+        progress = self._progress
+        if not progress:
+            return
+        progress.update_build(response)
+        if response.is_cancelled():
+            progress.finish('cancelled')
+        elif response.is_failed():
+            progress.finish('failed')
+        else:
+            progress.finish('succeeded', self._get_repositories(response),
+                            self._get_koji_build_id(response))
+        # final state is known, don't ask OSBS again
+        progress.checked = time.time()
+        self._publish_progress()
+
+    def _abort_progress(self, state):
+        """Publish final state of build which didn't finish in OSBS"""
+        progress = self._progress
+        if not progress:
+            return
+        progress.finish(state)
+        progress.checked = time.time()
+        self._publish_progress()
+
     def _get_repositories(self, response):
         repositories = []
         try:
@@ -437,6 +2311,28 @@ class BuildContainerTask(BaseTaskHandler):
 
         return error_message
 
+    def _classify_failure(self):
+        """Returns (failure class, log excerpt) of failed build from its logs"""
+        if self._log_classifier:
+            # logs were classified while they were streamed
+            failure_class, excerpt = self._log_classifier.result()
+            self.logger.info("Failure class: %s", failure_class)
+            return (failure_class, excerpt)
+        resultdir = self.resultdir()
+        # platform logs first, orchestrator log mostly repeats their errors
+        paths = sorted((os.path.join(resultdir, fname) for fname in os.listdir(resultdir)
+                        if fname.endswith('.log') and fname != 'osbs-client.log'),
+                       key=lambda path: (os.path.basename(path) == 'orchestrator.log', path))
+        try:
+            classifier = FailureClassifier(FAILURE_SIGNATURES +
+                                           self.config()['failure_signatures'])
+            failure_class, excerpt = classifier.classify(paths)
+        except Exception, error:
+            self.logger.error("Failed to classify build failure: %s", error)
+            return (None, None)
+        self.logger.info("Failure class: %s", failure_class)
+        return (failure_class, excerpt)
+
     def check_whitelist(self, name, target_info):
         """Check if container name is whitelisted in destination tag
 
@@ -480,6 +2376,37 @@ class BuildContainerTask(BaseTaskHandler):
         self.logger.debug("Results: %r", results)
         return results
 
+    def _create_build(self, create_build_args, arches, koji_parent_build=None,
+                      isolated=None, release=None):
+        """Start OSBS build, orchestrated one if possible, returns its ID
+
+        create_build_args['architecture'] is set if a single arch build was
+        started instead.
+        """
+        try:
+            orchestrator_create_build_args = create_build_args.copy()
+            orchestrator_create_build_args['platforms'] = arches
+            if koji_parent_build:
+                orchestrator_create_build_args['koji_parent_build'] = koji_parent_build
+            if isolated:
+                orchestrator_create_build_args['isolated'] = isolated
+            if release:
+                orchestrator_create_build_args['release'] = release
+
+            create_method = self.osbs().create_orchestrator_build
+            self.logger.debug("Starting %s with params: '%s",
+                              create_method, orchestrator_create_build_args)
+            build_response = create_method(**orchestrator_create_build_args)
+        except (AttributeError, orchestrator_not_enabled_exception()):
+            # Older osbs-client, or else orchestration not enabled
+            create_build_args['architecture'] = arches[0]
+            create_method = self.osbs().create_build
+            self.logger.debug("Starting %s with params: '%s'",
+                              create_method, create_build_args)
+            build_response = create_method(**create_build_args)
+
+        return build_response.get_build_name()
+
     def createContainer(self, src=None, target_info=None, arches=None,
                         scratch=None, isolated=None, yum_repourls=[],
                         branch=None, push_url=None, koji_parent_build=None,
@@ -521,105 +2448,139 @@ class BuildContainerTask(BaseTaskHandler):
         if module:
             create_build_args['module'] = module
 
+        # When builds are cancelled the builder plugin process gets SIGINT and
+        # SIGKILL soon after. If osbs has started a build it should get cancelled
+        config = self.config()
+        cancel_osbs = []
+
+        def cancel_build(build_id):
+            # called by the thread of the coordinator, the client of the task
+            # is meanwhile used here and its HTTP session isn't thread-safe
+            if not cancel_osbs:
+                cancel_osbs.append(self._create_osbs())
+            cancel_osbs[0].cancel_build(build_id)
+
+        self._canceller = CancelCoordinator(cancel_build, self.logger,
+                                            timeout=config['cancel_timeout'],
+                                            retry_delay=config['cancel_retry_delay'])
+        retry = RetryPolicy(config['submit_retries'], config['submit_retry_delay'],
+                            config['submit_retry_max_delay'], self.logger)
+        attempts = []
+
+        def create_build():
+            if attempts:
+                # failed request might have created the build
+                build_id = self._find_task_build()
+                if build_id:
+                    self.logger.info("Using OSBS build %s of the task created by "
+                                     "failed request", build_id)
+                    return build_id
+            attempts.append(time.time())
+            return self._create_build(create_build_args, arches, koji_parent_build,
+                                      isolated, release)
+
+        canceller = self._canceller
+        canceller.install()
         try:
-            orchestrator_create_build_args = create_build_args.copy()
-            orchestrator_create_build_args['platforms'] = arches
-            if koji_parent_build:
-                orchestrator_create_build_args['koji_parent_build'] = koji_parent_build
-            if isolated:
-                orchestrator_create_build_args['isolated'] = isolated
-            if release:
-                orchestrator_create_build_args['release'] = release
-
-            create_method = self.osbs().create_orchestrator_build
-            self.logger.debug("Starting %s with params: '%s",
-                              create_method, orchestrator_create_build_args)
-            build_response = create_method(**orchestrator_create_build_args)
-        except (AttributeError, OsbsOrchestratorNotEnabled):
-            # Older osbs-client, or else orchestration not enabled
-            create_build_args['architecture'] = arch = arches[0]
-            create_method = self.osbs().create_build
-            self.logger.debug("Starting %s with params: '%s'",
-                              create_method, create_build_args)
-            build_response = create_method(**create_build_args)
-
-        build_id = build_response.get_build_name()
-        self.logger.debug("OSBS build id: %r", build_id)
-
-        # When builds are cancelled the builder plugin process gets SIGINT and SIGKILL
-        # If osbs has started a build it should get cancelled
-        def sigint_handler(*args, **kwargs):
-            if not build_id:
-                return
-
-            self.logger.warn("Cannot read logs, cancelling build %s", build_id)
-            self.osbs().cancel_build(build_id)
-
-        signal.signal(signal.SIGINT, sigint_handler)
-
-        self.logger.debug("Waiting for osbs build_id: %s to be scheduled.",
-                          build_id)
-        # we need to wait for kubelet to schedule the build, otherwise it's 500
-        self.osbs().wait_for_build_to_get_scheduled(build_id)
-        self.logger.debug("Build was scheduled")
-
-        osbs_logs_dir = self.resultdir()
-        koji.ensuredir(osbs_logs_dir)
-        pid = os.fork()
-        if pid:
             try:
-                self._incremental_upload_logs(pid)
-            except koji.ActionNotAllowed:
-                pass
-        else:
-            self._osbs = None
-
-            # Following retry code is here mainly to workaround bug which causes
-            # connection drop while reading logs after about 5 minutes.
-            # OpenShift bug with description:
-            # https://github.com/openshift/origin/issues/2348
-            # and upstream bug in Kubernetes:
-            # https://github.com/GoogleCloudPlatform/kubernetes/issues/9013
-            retry = 0
-            max_retries = 30
-            while retry < max_retries:
-                try:
-                    self._write_incremental_logs(build_id, osbs_logs_dir)
-                except Exception, error:
-                    self.logger.info("Error while saving incremental logs "
-                                     "(retry #%d): %s", retry, error)
-                    retry += 1
-                    time.sleep(10)
-                    continue
-                break
+                build_id = retry.call("Creating OSBS build", create_build,
+                                      stop=self._cancelled)
+            except Exception:
+                if canceller.requested is None:
+                    raise
+                # cancel could interrupt the request after the build was created
+                build_id = self._find_task_build()
+                if not build_id:
+                    raise
+            arch = create_build_args['architecture']
+            self.logger.debug("OSBS build id: %r", build_id)
+            canceller.set_build(build_id)
+            canceller.check()
+            if config['progress_interval']:
+                self._progress = ProgressReport(build_id, arches)
+                self._publish_progress()
+
+            self.logger.debug("Waiting for osbs build_id: %s to be scheduled.",
+                              build_id)
+            # we need to wait for kubelet to schedule the build, otherwise it's 500
+            admission = self._admission_control()
+            if admission:
+                admission.wait_started(self.id, self._osbs_section())
+            scheduled = False
+            try:
+                retry.call("Waiting for OSBS build %s to get scheduled" % build_id,
+                           lambda: self.osbs().wait_for_build_to_get_scheduled(build_id),
+                           stop=self._cancelled)
+                scheduled = True
+            finally:
+                if admission:
+                    admission.wait_finished(self.id, self._osbs_section(), scheduled)
+            canceller.check()
+            self.logger.debug("Build was scheduled")
+            if self._progress:
+                self._progress.set_state('running')
+                self._publish_progress()
+
+            osbs_logs_dir = self.resultdir()
+            koji.ensuredir(osbs_logs_dir)
+            if self.config()['direct_log_upload']:
+                self._stream_logs_to_hub(build_id)
             else:
-                self.logger.info("Gave up trying to save incremental logs "
-                                 "after #%d retries.", retry)
-                os._exit(1)
-            os._exit(0)
-
-        response = self.osbs().wait_for_build_to_finish(build_id)
+                self._upload_logs_from_child(build_id, osbs_logs_dir)
+
+            canceller.check()
+            response = self.osbs().wait_for_build_to_finish(build_id)
+            canceller.check()
+        except Exception:
+            exc_info = sys.exc_info()
+            if canceller.requested is None:
+                self._abort_progress('failed')
+                raise exc_info[0], exc_info[1], exc_info[2]
+            # calls interrupted by the signal fail, the build is being
+            # cancelled by the canceller
+            canceller.uninstall()
+            self._abort_progress('cancelled')
+            msg = canceller.message()
+            tail = self._failure_tail(msg)
+            if tail:
+                msg += '\n' + tail
+            raise ContainerCancelled(msg)
+        finally:
+            # nothing to cancel in OSBS from now on
+            canceller.uninstall()
 
         self.logger.debug("OSBS build finished with status: %s. Build "
                           "response: %s.", response.status,
                           response.json)
 
         self.logger.info("Response status: %r", response.is_succeeded())
+        self._finish_progress(response)
 
         if response.is_cancelled():
+            msg = u'Image build was cancelled by OSBS, maybe by automated rebuild.'
+            tail = self._failure_tail(msg)
             self.session.cancelTask(self.id)
-            raise ContainerCancelled(
-                'Image build was cancelled by OSBS, maybe by automated rebuild.'
-            )
+            if tail:
+                msg += '\n' + tail
+            raise ContainerCancelled(msg)
 
         elif response.is_failed():
             error_message = self._get_error_message(response)
+            # error message and logs can be either bytes or unicode
             if error_message:
-                raise ContainerError('Image build failed. %s. OSBS build id: %s' %
-                                     (error_message, build_id))
+                msg = u'Image build failed. %s. OSBS build id: %s' % (
+                    to_unicode(error_message), build_id)
             else:
-                raise ContainerError('Image build failed. OSBS build id: %s' %
-                                     build_id)
+                msg = u'Image build failed. OSBS build id: %s' % build_id
+            failure_class, excerpt = self._classify_failure()
+            if failure_class:
+                # fault seen by clients starts with '[class] ', stable to
+                # be parsed
+                msg = u'[%s] %s\n%s' % (failure_class, msg, to_unicode(excerpt))
+            tail = self._failure_tail(msg)
+            if tail:
+                msg += '\n' + tail
+            raise ContainerError(msg)
 
         repositories = []
         if response.is_succeeded():
@@ -695,12 +2656,93 @@ class BuildContainerTask(BaseTaskHandler):
 
         # Check out sources from the SCM
         sourcedir = scm.checkout(scmdir, self.session, uploadpath, logfile)
+        self._source_commit = self._get_source_commit(sourcedir)
 
         fn = os.path.join(sourcedir, 'Dockerfile')
         if not os.path.exists(fn):
             raise koji.BuildError, "Dockerfile file missing: %s" % fn
         return fn
 
+    def _get_source_commit(self, sourcedir):
+        """Returns commit checked out in sourcedir, None if it's unknown"""
+        try:
+            proc = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=sourcedir,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+        except OSError, error:
+            self.logger.info("Cannot resolve commit of sources: %s", error)
+            return None
+        if proc.returncode != 0:
+            self.logger.info("Cannot resolve commit of sources: %s", err.strip())
+            return None
+        return out.strip()
+
+    def _scratch_cache_key(self, src, target_info, archlist):
+        """Returns key identifying inputs of scratch build, None if unknown
+
+        Builds with the same key are built from the same commit with the same
+        options against the same repo of the build tag.
+        """
+        if not self._source_commit:
+            return None
+        repo = self.session.getRepo(target_info['build_tag'])
+        if not repo:
+            return None
+        opts = dict((key, value) for key, value in self.opts.items()
+                    if key not in ('reuse_scratch', 'arch_override', 'yum_repourls'))
+        inputs = {
+            'source': src.split('#', 1)[0],
+            'commit': self._source_commit,
+            'target': target_info['name'],
+            'arches': sorted(archlist),
+            'yum_repourls': self.opts.get('yum_repourls') or [],
+            'repo_event': repo['create_event'],
+            'opts': opts,
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def _find_reusable_build(self, cache_key, target_name):
+        """Returns result of successful recent task with cache_key or None
+
+        Candidates are recent scratch builds of the same commit and target
+        recorded by the hub plugin (listContainerBuilds). Hubs without it are
+        asked for recent tasks of the same owner.
+        """
+        after = time.time() - self.config()['scratch_reuse_ttl']
+        try:
+            builds = self.session.listContainerBuilds(
+                commit=self._source_commit, target=target_name, state='CLOSED',
+                scratch=True, after=after, limit=SCRATCH_REUSE_CANDIDATES)
+        except koji.GenericError, error:
+            self.logger.info("Cannot list container builds, checking recent "
+                             "tasks of the owner: %s", error)
+            return self._find_reusable_task(cache_key, after)
+        for build in builds:
+            if build['task_id'] == self.id:
+                continue
+            result = self.session.getTaskResult(build['task_id'])
+            if self._is_reusable(result, cache_key):
+                return build['task_id'], result
+        return None
+
+    def _find_reusable_task(self, cache_key, after):
+        owner = self.session.getTaskInfo(self.id)['owner']
+        tasks = self.session.listTasks(
+            opts={'method': 'buildContainer',
+                  'owner': owner,
+                  'state': [koji.TASK_STATES['CLOSED']],
+                  'completeAfter': after,
+                  'decode': True},
+            queryOpts={'order': '-completion_time'})
+        for task in tasks:
+            if task['id'] != self.id and self._is_reusable(task.get('result'), cache_key):
+                return task['id'], task['result']
+        return None
+
+    def _is_reusable(self, result, cache_key):
+        return (isinstance(result, dict) and result.get('cache_key') == cache_key and
+                bool(result.get('repositories')))
+
     def _get_admin_opts(self, opts):
         epoch = opts.get('epoch', 0)
         if epoch:
@@ -741,20 +2783,91 @@ class BuildContainerTask(BaseTaskHandler):
 
         return (labels_wrapper.get_extra_data(), labels_wrapper.get_expected_nvr())
 
+    def _get_target_arches(self, target):
+        self.event_id = self.session.getLastEvent()['id']
+        target_info = self.session.getBuildTarget(target, event=self.event_id)
+        build_tag = target_info['build_tag']
+        archlist = self.getArchList(build_tag)
+        return target_info, archlist
+
+    def _warm_up_osbs(self):
+        """Create OSBS client ahead of its first use
+
+        Failure isn't fatal here, it's reported again when the client is
+        needed.
+        """
+        try:
+            self.osbs()
+        except Exception:
+            self.logger.debug("Failed to create OSBS client", exc_info=True)
+
+    def _run_preflight(self, steps):
+        """Run independent steps in threads, returns their results
+
+        All steps are waited for. If some fail, exception of the first one
+        in steps is raised so errors don't depend on timing. The koji
+        session is serialized while the steps run.
+        """
+        results = [None] * len(steps)
+        errors = [None] * len(steps)
+
+        def run(index, func):
+            try:
+                results[index] = func()
+            except:
+                errors[index] = sys.exc_info()
+
+        start = time.time()
+        session = self.session
+        self.session = SerializedSession(session)
+        try:
+            threads = []
+            for index, func in enumerate(steps):
+                thread = threading.Thread(target=run, args=(index, func))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        finally:
+            self.session = session
+        self.logger.info("Pre-flight checks took %.1fs", time.time() - start)
+
+        for error in errors:
+            if error:
+                raise error[0], error[1], error[2]
+        return results
+
+    def _build_metadata(self, data):
+        """Component and commit of the build, recorded by hub in its result"""
+        metadata = {'component': data[LABEL_DATA_MAP['COMPONENT']]}
+        if self._source_commit:
+            metadata['commit'] = self._source_commit
+        return metadata
+
     def handler(self, src, target, opts=None):
         if not opts:
             opts = {}
         self.opts = opts
         data = {}
 
-        self.event_id = self.session.getLastEvent()['id']
-        target_info = self.session.getBuildTarget(target, event=self.event_id)
-        build_tag = target_info['build_tag']
-        archlist = self.getArchList(build_tag)
-
         flatpak = opts.get('flatpak', False)
+        label_overwrites = {}
+        release_overwrite = opts.get('release')
+        if release_overwrite:
+            label_overwrites = {LABEL_DATA_MAP['RELEASE']: release_overwrite}
+
+        # checkout of sources doesn't need anything from the hub lookups and
+        # OSBS client is needed only later, do it all at once
+        steps = [lambda: self._get_target_arches(target), self._warm_up_osbs]
+        if not flatpak:
+            steps.append(lambda: self.checkLabels(src, label_overwrites=label_overwrites))
+        results = self._run_preflight(steps)
+        target_info, archlist = results[0]
+
         if flatpak:
-            if not osbs_flatpak_support:
+            split_module_spec = osbs_split_module_spec()
+            if split_module_spec is None:
                 raise koji.BuildError("osbs-client on koji builder doesn't have Flatpak support")
             module = opts.get('module', None)
             if not module:
@@ -771,11 +2884,7 @@ class BuildContainerTask(BaseTaskHandler):
                 data['release'] = module_version
             release_overwrite = None
         else:
-            label_overwrites = {}
-            release_overwrite = opts.get('release')
-            if release_overwrite:
-                label_overwrites = {LABEL_DATA_MAP['RELEASE']: release_overwrite}
-            data, expected_nvr = self.checkLabels(src, label_overwrites=label_overwrites)
+            data, expected_nvr = results[2]
         admin_opts = self._get_admin_opts(opts)
         data.update(admin_opts)
 
@@ -800,6 +2909,26 @@ class BuildContainerTask(BaseTaskHandler):
             if not SCM.is_scm_url(src):
                 raise koji.BuildError('Invalid source specification: %s' % src)
 
+            cache_key = None
+            if (self.opts.get('scratch') and self.opts.get('reuse_scratch') and
+                    self.config()['scratch_reuse_ttl'] > 0):
+                cache_key = self._scratch_cache_key(src, target_info, archlist)
+            if cache_key:
+                reusable = self._find_reusable_build(cache_key, target_info['name'])
+                if reusable:
+                    reused_task_id, result = reusable
+                    self.logger.info("Reusing result of identical scratch build "
+                                     "task %s", reused_task_id)
+                    task_result = {
+                        'repositories': result['repositories'],
+                        'koji_builds': [],
+                        'osbs_builds': result.get('osbs_builds', []),
+                        'cache_key': cache_key,
+                        'reused_task_id': reused_task_id,
+                    }
+                    task_result.update(self._build_metadata(data))
+                    return task_result
+
             # Scratch and auto release builds shouldn't be checked for nvr
             if not self.opts.get('scratch') and not auto_release:
                 try:
@@ -823,6 +2952,7 @@ class BuildContainerTask(BaseTaskHandler):
                                      )
             all_repositories = []
             all_koji_builds = []
+            all_osbs_builds = []
             for result in results:
                 try:
                     repository = result.get('repositories')
@@ -834,6 +2964,7 @@ class BuildContainerTask(BaseTaskHandler):
                 koji_build_id = result.get('koji_build_id')
                 if koji_build_id:
                     all_koji_builds.append(koji_build_id)
+                all_osbs_builds.append(result.get('osbs_build_id'))
 
         except (SystemExit, ServerExit, KeyboardInterrupt):
             # we do not trap these
@@ -842,7 +2973,13 @@ class BuildContainerTask(BaseTaskHandler):
             # reraise the exception
             raise
 
-        return {
+        task_result = {
             'repositories': all_repositories,
             'koji_builds': all_koji_builds,
         }
+        task_result.update(self._build_metadata(data))
+        if cache_key:
+            # lets identical scratch builds find and reuse this result
+            task_result['cache_key'] = cache_key
+            task_result['osbs_builds'] = all_osbs_builds
+        return task_result
@@ -20,12 +20,18 @@
 # Authors:
 #       Pavol Babincak <pbabinca@redhat.com>
 
+import os
 import sys
+import errno
+import time
+import fcntl
 import logging
+import threading
+import ConfigParser
 
 import koji
 from koji.context import context
-from koji.plugin import export
+from koji.plugin import export, callback, ignore_error
 
 koji_hub_path = '/usr/share/koji-hub/'
 sys.path.insert(0, koji_hub_path)
@@ -34,6 +40,143 @@ import kojihub
 #logger = logging.getLogger('koji.plugins.containerbuild')
 logger = logging.getLogger('koji.plugins')
 
+CONFIG_FILE = '/etc/koji-hub/plugins/hub_containerbuild.conf'
+
+# Options of CONFIG_FILE by section, with their default values. Type of
+# default value determines how the option is parsed.
+CONFIG_DEFAULTS = {
+    'fair_share': {
+        'enabled': False,
+        # Seconds after which usage of owner or package drops to half
+        'half_life': 3600.0,
+        # Priority of a task is lowered by one for every owner_step recent
+        # builds of its owner and every package_step recent builds of its
+        # package
+        'owner_step': 20.0,
+        'package_step': 10.0,
+        # The most priority is lowered by
+        'max_penalty': 10,
+    },
+    'container_builds': {
+        # Record finished container build tasks in container_builds table
+        'enabled': False,
+    },
+}
+
+# Most container builds returned by listContainerBuilds at once
+LIST_BUILDS_MAX_LIMIT = 1000
+
+# Most tasks getContainerTaskStates takes at once
+TASK_STATES_MAX_TASKS = 1000
+
+# Seconds for which getContainerTaskStates serves task states from its cache,
+# states of finished tasks don't change
+TASK_STATES_CACHE_TTL = 2.0
+TASK_STATES_FINISHED_CACHE_TTL = 600.0
+
+# Bound of entries cached by getContainerTaskStates in each hub process
+TASK_STATES_CACHE_SIZE = 20000
+
+_config = None
+
+
+def get_config():
+    """Returns dict with plugin configuration, read once per hub process"""
+    global _config
+    if _config is not None:
+        return _config
+    parser = ConfigParser.SafeConfigParser()
+    parser.read(CONFIG_FILE)
+    config = {}
+    for section, defaults in CONFIG_DEFAULTS.items():
+        config[section] = dict(defaults)
+        if not parser.has_section(section):
+            continue
+        for key, default in defaults.items():
+            if not parser.has_option(section, key):
+                continue
+            if isinstance(default, bool):
+                value = parser.getboolean(section, key)
+            else:
+                value = type(default)(parser.get(section, key))
+            config[section][key] = value
+    _config = config
+    return _config
+
+
+def _scm_package(src):
+    """Name of repository of SCM URL, stands for the package on the hub"""
+    path = src.split('#', 1)[0].split('?', 1)[0].rstrip('/')
+    name = path.rsplit('/', 1)[-1]
+    if name.endswith('.git'):
+        name = name[:-4]
+    return name
+
+
+def _decayed(usage, age, half_life):
+    """Usage counted age seconds ago, it halves every half_life seconds"""
+    return usage * 0.5 ** (max(age, 0) / half_life)
+
+
+def _get_usage(kind, name, half_life):
+    """Returns current usage counter of owner or package"""
+    query = kojihub.QueryProcessor(
+        tables=['container_build_usage'],
+        columns=['usage', 'EXTRACT(EPOCH FROM NOW() - updated)'],
+        aliases=['usage', 'age'],
+        clauses=['kind = %(kind)s', 'name = %(name)s'],
+        values={'kind': kind, 'name': name})
+    row = query.executeOne()
+    if not row:
+        return 0.0
+    return _decayed(float(row['usage']), float(row['age']), half_life)
+
+
+def _add_usage(kind, name, half_life):
+    """Decay usage counter of owner or package, add a build to it
+
+    Needs PostgreSQL 9.5 or newer (INSERT ... ON CONFLICT).
+    """
+    query = """
+        INSERT INTO container_build_usage (kind, name, usage, updated)
+        VALUES (%(kind)s, %(name)s, 1, NOW())
+        ON CONFLICT (kind, name) DO UPDATE SET
+            usage = container_build_usage.usage *
+                POWER(0.5, EXTRACT(EPOCH FROM NOW() - container_build_usage.updated)
+                           / %(half_life)s) + 1,
+            updated = NOW()"""
+    kojihub._dml(query, {'kind': kind, 'name': name, 'half_life': half_life})
+
+
+def fair_share_penalty(src):
+    """Returns how much priority of a new task is lowered
+
+    Owners and packages with many recent builds get lower priority so a bulk
+    rebuild doesn't starve other builds in the channel.
+    """
+    config = get_config()['fair_share']
+    if not config['enabled']:
+        return 0
+    owner = context.session.user_data['name']
+    owner_usage = _get_usage('owner', owner, config['half_life'])
+    package_usage = _get_usage('package', _scm_package(src), config['half_life'])
+    penalty = (int(owner_usage / config['owner_step']) +
+               int(package_usage / config['package_step']))
+    penalty = min(penalty, config['max_penalty'])
+    if penalty:
+        logger.debug("Priority of build of %s by %s lowered by %d", src, owner,
+                     penalty)
+    return penalty
+
+
+def charge_fair_share(src):
+    """Add a build of src to usage of its owner and package"""
+    config = get_config()['fair_share']
+    if not config['enabled']:
+        return
+    _add_usage('owner', context.session.user_data['name'], config['half_life'])
+    _add_usage('package', _scm_package(src), config['half_life'])
+
 
 @export
 def buildContainer(src, target, opts=None, priority=None, channel='container'):
@@ -42,7 +185,9 @@ def buildContainer(src, target, opts=None, priority=None, channel='container'):
     target: the build target
     priority: the amount to increase (or decrease) the task priority, relative
               to the default priority; higher values mean lower priority; only
-              admins have the right to specify a negative priority here
+              admins have the right to specify a negative priority here. With
+              fair share enabled, priority is lowered further for owners and
+              packages with many recent builds.
     channel: the channel to allocate the task to (defaults to the "container"
              channel)
 
@@ -51,12 +196,293 @@ def buildContainer(src, target, opts=None, priority=None, channel='container'):
     if not opts:
         opts = {}
     taskOpts = {}
+    # admins asking for high priority aren't subject to fair share
+    fair_share = not (priority and priority < 0)
+    if not fair_share:
+        if not context.session.hasPerm('admin'):
+            raise koji.ActionNotAllowed('only admins may create'
+                                        ' high-priority tasks')
+    else:
+        priority = (priority or 0) + fair_share_penalty(src)
     if priority:
-        if priority < 0:
-            if not context.session.hasPerm('admin'):
-                raise koji.ActionNotAllowed('only admins may create'
-                                            ' high-priority tasks')
         taskOpts['priority'] = koji.PRIO_DEFAULT + priority
     if channel:
         taskOpts['channel'] = channel
-    return kojihub.make_task('buildContainer', [src, target, opts], **taskOpts)
+    task_id = kojihub.make_task('buildContainer', [src, target, opts], **taskOpts)
+    if fair_share:
+        # only builds which were really submitted count
+        charge_fair_share(src)
+    return task_id
+
+
+def _assert_task_upload(host, path):
+    """Raise ActionNotAllowed unless path is upload path of a task of host"""
+    # koji.pathinfo.taskrelpath(): tasks/<task id % 10000>/<task id>
+    parts = os.path.normpath(path).split(os.sep)
+    try:
+        if len(parts) < 3 or parts[0] != 'tasks':
+            raise ValueError(path)
+        task_id = int(parts[2])
+    except ValueError:
+        raise koji.ActionNotAllowed('Not an upload path of a task: %s' % path)
+    kojihub.Task(task_id).assertHost(host.id)
+
+
+@export
+def truncateContainerUpload(path, name, size):
+    """Truncate file uploaded by a container build task
+
+    Used by builders to drop stale content of a log which has been replaced
+    before rest of the log is uploaded again from offset size.
+
+    path: upload path of the file (relative to work directory)
+    name: name of the uploaded file
+    size: new size of the file
+    """
+    host = kojihub.Host()
+    host.verify()
+    if size < 0:
+        raise koji.ParameterError('Invalid size: %r' % size)
+    _assert_task_upload(host, path)
+    fn = kojihub.get_upload_path(path, name)
+    if not os.path.isfile(fn):
+        raise koji.GenericError('No such upload: %s/%s' % (path, name))
+    fd = open(fn, 'r+b')
+    try:
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, error:
+            if error.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            raise koji.LockError('Upload %s/%s is being written' % (path, name))
+        try:
+            if os.fstat(fd.fileno()).st_size > size:
+                fd.truncate(size)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+    finally:
+        fd.close()
+
+
+# Columns of container_builds returned by listContainerBuilds
+CONTAINER_BUILD_COLUMNS = ('task_id', 'component', 'target', 'source', 'scm_commit',
+                           'owner', 'state', 'scratch', 'koji_build_id', 'completed')
+
+
+@callback('postTaskStateChange')
+@ignore_error
+def record_container_build(cbtype, *args, **kws):
+    """Record finished buildContainer task in container_builds table"""
+    if kws.get('attribute') != 'state' or not get_config()['container_builds']['enabled']:
+        return
+    info = kws['info']
+    state = kws['new']
+    if info['method'] != 'buildContainer' or state not in (
+            koji.TASK_STATES['CLOSED'], koji.TASK_STATES['FAILED'],
+            koji.TASK_STATES['CANCELED']):
+        return
+    src, target = info['request'][:2]
+    opts = {}
+    if len(info['request']) > 2:
+        opts = info['request'][2] or {}
+    task = kojihub.Task(info['id'])
+    result = {}
+    if state == koji.TASK_STATES['CLOSED']:
+        result = task.getResult()
+        if not isinstance(result, dict):
+            result = {}
+    koji_builds = result.get('koji_builds') or [None]
+    data = {
+        'task_id': info['id'],
+        'component': result.get('component'),
+        'target': target,
+        'source': src,
+        'scm_commit': result.get('commit'),
+        'owner': info['owner'],
+        'state': state,
+        'scratch': bool(opts.get('scratch')),
+        'koji_build_id': koji_builds[0],
+        # info is from before the state change, completion_time isn't in it
+        'completed': task.getInfo()['completion_time'],
+    }
+    kojihub._dml("DELETE FROM container_builds WHERE task_id = %(task_id)i",
+                 {'task_id': info['id']})
+    insert = kojihub.InsertProcessor('container_builds', data=data)
+    insert.execute()
+
+
+@export
+def listContainerBuilds(component=None, target=None, commit=None, owner=None,
+                        state=None, scratch=None, before=None, after=None, limit=100):
+    """List finished container builds, newest first
+
+    component: name of the component (com.redhat.component label)
+    target: name of the build target
+    commit: git commit the build was built from
+    owner: name or ID of the user who submitted the build
+    state: task state, name (e.g. 'CLOSED') or number
+    scratch: True or False to list only scratch or only regular builds
+    before: list only builds with task ID lower than this, pass task_id of the
+            last build of previous page to get the next one
+    after: list only builds completed after this time (seconds since epoch)
+    limit: maximum number of builds returned (at most LIST_BUILDS_MAX_LIMIT)
+
+    Returns list of dicts with task_id, component, target, source,
+    scm_commit, owner (ID), owner_name, state, scratch, koji_build_id and
+    completed (time as string).
+
+    Builds are recorded only with container_builds enabled in the plugin
+    configuration.
+    """
+    if limit < 1 or limit > LIST_BUILDS_MAX_LIMIT:
+        raise koji.ParameterError('limit must be between 1 and %d' %
+                                  LIST_BUILDS_MAX_LIMIT)
+    clauses = []
+    values = {}
+    for column, value in (('component', component), ('target', target),
+                          ('scm_commit', commit), ('scratch', scratch)):
+        if value is not None:
+            clauses.append('container_builds.%s = %%(%s)s' % (column, column))
+            values[column] = value
+    if owner is not None:
+        clauses.append('container_builds.owner = %(owner)i')
+        values['owner'] = kojihub.get_user(owner, strict=True)['id']
+    if state is not None:
+        state_num = koji.TASK_STATES.getnum(state)
+        if state_num is None:
+            raise koji.ParameterError('Invalid task state: %r' % state)
+        clauses.append('container_builds.state = %(state)i')
+        values['state'] = state_num
+    if before is not None:
+        clauses.append('container_builds.task_id < %(before)i')
+        values['before'] = before
+    if after is not None:
+        clauses.append('container_builds.completed > TO_TIMESTAMP(%(after)s)')
+        values['after'] = after
+
+    columns = ['container_builds.%s' % column for column in CONTAINER_BUILD_COLUMNS]
+    aliases = list(CONTAINER_BUILD_COLUMNS)
+    columns.append('users.name')
+    aliases.append('owner_name')
+    query = kojihub.QueryProcessor(tables=['container_builds'],
+                                   joins=['users ON container_builds.owner = users.id'],
+                                   columns=columns, aliases=aliases,
+                                   clauses=clauses, values=values,
+                                   opts={'order': '-task_id', 'limit': limit})
+    return query.execute()
+
+
+class TaskStatesCache(object):
+    """Short-lived cache of task states and database time of a hub process"""
+
+    def __init__(self, ttl, finished_ttl, size):
+        self._ttl = ttl
+        self._finished_ttl = finished_ttl
+        self._size = size
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._db_time = None
+
+    def _expire(self, now):
+        if len(self._tasks) < self._size:
+            return
+        for task_id, (expires, task) in self._tasks.items():
+            if expires <= now:
+                del self._tasks[task_id]
+        if len(self._tasks) >= self._size:
+            self._tasks.clear()
+
+    def get_tasks(self, task_ids, fetch):
+        """Returns task states, fetch is called with IDs of those not cached"""
+        now = time.time()
+        tasks = {}
+        missing = []
+        with self._lock:
+            for task_id in task_ids:
+                entry = self._tasks.get(task_id)
+                if entry and entry[0] > now:
+                    tasks[task_id] = entry[1]
+                else:
+                    missing.append(task_id)
+        if missing:
+            fetched = fetch(missing)
+            with self._lock:
+                self._expire(now)
+                for task in fetched:
+                    ttl = self._ttl
+                    if task['state'] in FINISHED_TASK_STATES:
+                        ttl = self._finished_ttl
+                    self._tasks[task['id']] = (now + ttl, task)
+                    tasks[task['id']] = task
+        return tasks
+
+    def get_db_time(self):
+        """Current time of the database, clock of task timestamps"""
+        now = time.time()
+        with self._lock:
+            if self._db_time and self._db_time[0] > now:
+                return self._db_time[1]
+        ts = float(kojihub._singleValue("SELECT EXTRACT(EPOCH FROM NOW())", {}))
+        with self._lock:
+            self._db_time = (now + self._ttl, ts)
+        return ts
+
+
+FINISHED_TASK_STATES = (koji.TASK_STATES['CLOSED'], koji.TASK_STATES['FAILED'],
+                        koji.TASK_STATES['CANCELED'])
+
+_task_states_cache = TaskStatesCache(TASK_STATES_CACHE_TTL,
+                                     TASK_STATES_FINISHED_CACHE_TTL,
+                                     TASK_STATES_CACHE_SIZE)
+
+
+def _fetch_task_states(task_ids):
+    query = kojihub.QueryProcessor(
+        tables=['task'],
+        columns=['id', 'state', 'EXTRACT(EPOCH FROM create_time)',
+                 'EXTRACT(EPOCH FROM start_time)',
+                 'EXTRACT(EPOCH FROM completion_time)'],
+        aliases=['id', 'state', 'create_ts', 'start_ts', 'completion_ts'],
+        clauses=['id = ANY(%(task_ids)s)'],
+        values={'task_ids': list(task_ids)})
+    return query.execute()
+
+
+@export
+def getContainerTaskStates(task_ids, since=None):
+    """Get states of tasks which changed since previous call
+
+    Meant for clients watching many tasks. States are served from a cache
+    of the hub process for a few seconds, so polling is cheap but states
+    can be that much late.
+
+    task_ids: list of task IDs
+    since: ts returned by previous call, return only tasks which were
+           started or finished since then. All tasks are returned if it's
+           None.
+
+    Returns dict with ts to pass as since next time and tasks, list of dicts
+    with id, state, create_ts, start_ts and completion_ts (None if the task
+    hasn't started or finished yet). ts is time of the database, the clock
+    task timestamps come from, so it advances even if nothing happens on the
+    hub. The same change can be returned by a few consecutive calls. Tasks
+    which don't exist are left out.
+    """
+    if len(task_ids) > TASK_STATES_MAX_TASKS:
+        raise koji.ParameterError('At most %d tasks can be queried at once' %
+                                  TASK_STATES_MAX_TASKS)
+    task_ids = [int(task_id) for task_id in task_ids]
+    # time first, so changes right after it are returned next time too
+    ts = _task_states_cache.get_db_time()
+    tasks = _task_states_cache.get_tasks(task_ids, _fetch_task_states)
+    if since is not None:
+        # cached states and time are up to TTL old each, and transactions
+        # commit a bit after their time; changes in the margin are returned
+        # twice rather than never
+        since = since - 2 * TASK_STATES_CACHE_TTL
+        tasks = dict((task_id, task) for task_id, task in tasks.items()
+                     if max(task['start_ts'], task['completion_ts']) >= since)
+    return {
+        'ts': ts,
+        'tasks': [tasks[task_id] for task_id in sorted(tasks)],
+    }
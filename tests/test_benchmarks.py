@@ -0,0 +1,85 @@
+"""
+Copyright (c) 2017 Red Hat, Inc
+All rights reserved.
+This software may be modified and distributed under the terms
+of the BSD license. See the LICENSE file for details.
+
+Benchmarks which take long to run, enable them with KCB_BENCHMARKS=1.
+"""
+
+from flexmock import flexmock
+import os
+import resource
+import subprocess
+import sys
+import time
+import pytest
+from koji.daemon import incremental_upload
+from koji.util import adler32_constructor
+from koji_containerbuild.plugins import builder_containerbuild
+
+
+pytestmark = pytest.mark.skipif(not os.environ.get('KCB_BENCHMARKS'),
+                                reason='KCB_BENCHMARKS not set')
+
+
+class UploadSession(object):
+    """Session which accepts fast uploads and throws them away"""
+    opts = {'use_fast_upload': True}
+
+    def __init__(self):
+        self.uploaded = 0
+
+    def rawUpload(self, contents, offset, path, fname, overwrite=False):
+        self.uploaded += len(contents)
+        return {'hexdigest': adler32_constructor(contents).hexdigest()}
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def test_large_log_upload_memory(tmpdir):
+    size = 4 * 1024 ** 3
+    log_path = os.path.join(str(tmpdir), 'x86_64.log')
+    line = 'Compiling something rather verbose with -g3 -O0 ... done\n'
+    with open(log_path, 'w') as f:
+        # mostly sparse file, with real log lines at the start and the end
+        f.write(line * 100000)
+        f.seek(size - len(line) * 100000)
+        f.write(line * 100000)
+
+    session = UploadSession()
+    watcher = builder_containerbuild.FileWatcher(
+        str(tmpdir), logger=flexmock(info=lambda *args: None),
+        large_log_threshold=1024 ** 3)
+    rss_before = max_rss_mb()
+    start = time.time()
+    for fd, fname in watcher.files_to_upload():
+        incremental_upload(session, fname, fd, 'upload-path')
+    elapsed = time.time() - start
+    watcher.clean()
+
+    rss_growth = max_rss_mb() - rss_before
+    print('Uploaded %d MB in %.1fs, peak RSS growth %d MB' %
+          (session.uploaded / 1024 ** 2, elapsed, rss_growth))
+    assert session.uploaded == os.path.getsize(log_path)
+    # mapped window plus upload chunk, independent of size of the log
+    assert rss_growth < 64
+
+
+def test_plugin_import_time():
+    # fresh interpreter for each run, modules imported by an earlier test
+    # would be cached otherwise
+    code = ('import time; start = time.time(); '
+            'from koji_containerbuild.plugins import builder_containerbuild; '
+            'print(time.time() - start)')
+    runs = []
+    for i in range(5):
+        proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        assert proc.returncode == 0
+        runs.append(float(out))
+    print('Plugin import took %.3fs (best of %d)' % (min(runs), len(runs)))
+    # koji itself dominates, osbs-client used to add as much again
+    assert min(runs) < 1.0
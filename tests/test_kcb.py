@@ -7,18 +7,32 @@ of the BSD license. See the LICENSE file for details.
 
 from flexmock import flexmock
 from textwrap import dedent
+from StringIO import StringIO
 from collections import namedtuple
 import pytest
 import osbs
 import os
 import os.path
+import signal
+import subprocess
+import sys
+import gzip
+import imp
+import base64
+import ConfigParser
+import mmap
+import json
+import logging
+import threading
+import time
 import koji
 from koji_containerbuild.plugins import builder_containerbuild
-from osbs.exceptions import OsbsValidationException
+from osbs.exceptions import OsbsValidationException, OsbsResponseException
 try:
     from osbs.exceptions import OsbsOrchestratorNotEnabled
 except ImportError:
     from osbs.exceptions import OsbsValidationException as OsbsOrchestratorNotEnabled
+from koji_containerbuild import cli
 from koji_containerbuild.cli import parse_arguments
 
 
@@ -58,6 +72,16 @@ class TestBuilder(object):
                                                         workdir='workdir')
         assert type(cct.osbs()) is osbs.api.OSBS
 
+    def test_plugin_import_is_lazy(self):
+        code = ('import sys; '
+                'from koji_containerbuild.plugins import builder_containerbuild; '
+                'print(sorted(m for m in sys.modules '
+                'if m.split(".")[0] in ("osbs", "dockerfile_parse")))')
+        proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        assert proc.returncode == 0
+        assert out.strip() == '[]'
+
     @pytest.mark.parametrize("repos", [{'repo1': 'test1'}, {'repo2': 'test2'}])
     def test_get_repositories(self, repos):
         response = flexmock(get_repositories=lambda: repos)
@@ -280,7 +304,8 @@ class TestBuilder(object):
 
             assert task_response == {
                 'repositories': ['unique-repo', 'primary-repo'],
-                'koji_builds': [koji_build_id]
+                'koji_builds': [koji_build_id],
+                'component': 'fedora-docker',
             }
 
     @pytest.mark.parametrize('orchestrator', (True, False))
@@ -333,7 +358,8 @@ class TestBuilder(object):
 
         assert task_response == {
             'repositories': ['unique-repo', 'primary-repo'],
-            'koji_builds': [koji_build_id]
+            'koji_builds': [koji_build_id],
+            'component': 'fedora-docker',
         }
 
     @pytest.mark.parametrize(('module', 'should_raise'), [
@@ -386,7 +412,8 @@ class TestBuilder(object):
             })
             assert task_response == {
                 'repositories': ['unique-repo', 'primary-repo'],
-                'koji_builds': [koji_build_id]
+                'koji_builds': [koji_build_id],
+                'component': 'fedora-docker',
             }
         else:
             with pytest.raises(should_raise[0]) as exc_info:
@@ -457,7 +484,8 @@ class TestBuilder(object):
 
             assert task_response == {
                 'repositories': ['unique-repo', 'primary-repo'],
-                'koji_builds': [koji_build_id]
+                'koji_builds': [koji_build_id],
+                'component': 'fedora-docker',
             }
 
     @pytest.mark.parametrize('orchestrator', (True, False))
@@ -778,5 +806,2461 @@ class TestBuilder(object):
 
             assert task_response == {
                 'repositories': ['unique-repo', 'primary-repo'],
-                'koji_builds': [koji_build_id]
+                'koji_builds': [koji_build_id],
+                'component': 'fedora-docker',
             }
+
+    def _mock_reuse_task(self, tmpdir, koji_task_id, session, build_not_started):
+        folders_info = self._mock_folders(str(tmpdir))
+        src = self._mock_git_source()
+        options = flexmock(allowed_scms='pkgs.example.com:/*:no')
+        task = builder_containerbuild.BuildContainerTask(id=koji_task_id,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session=session,
+                                                         options=options,
+                                                         workdir='workdir',
+                                                         demux=True)
+        task._config = dict(builder_containerbuild.CONFIG_DEFAULTS,
+                            failure_signatures=[])
+        task._source_commit = 'abc123'
+        (flexmock(task)
+            .should_receive('fetchDockerfile')
+            .with_args(src['src'])
+            .and_return(folders_info['dockerfile_path']))
+        flexmock(task).should_receive('_write_incremental_logs')
+        flexmock(task).should_receive('_write_demultiplexed_logs')
+        task._osbs = self._mock_osbs(koji_build_id=999,
+                                     src=src,
+                                     koji_task_id=koji_task_id,
+                                     orchestrator=True,
+                                     build_not_started=build_not_started,
+                                     create_build_args={'scratch': True})
+        return task, src
+
+    def test_reuse_scratch(self, tmpdir):
+        koji_task_id = 123
+        session = self._mock_session(456, koji_task_id)
+        session.should_receive('getRepo').with_args('build-tag').and_return(
+            {'id': 1, 'create_event': 400})
+        task, src = self._mock_reuse_task(tmpdir, koji_task_id, session,
+                                          build_not_started=False)
+        opts = {'scratch': True, 'reuse_scratch': True}
+
+        (session
+            .should_receive('listContainerBuilds')
+            .with_args(commit='abc123', target='target-name', state='CLOSED',
+                       scratch=True, after=float, limit=int)
+            .and_return([]).once())
+        session.should_receive('listTasks').never()
+        first = task.handler(src['src'], 'target', opts=dict(opts))
+        cache_key = first['cache_key']
+        assert first == {
+            'repositories': ['unique-repo', 'primary-repo'],
+            'koji_builds': [999],
+            'component': 'fedora-docker',
+            'commit': 'abc123',
+            'osbs_builds': ['os-build-id'],
+            'cache_key': cache_key,
+        }
+
+        # same inputs in another task, build isn't started again
+        session = self._mock_session(457, 124)
+        session.should_receive('getRepo').with_args('build-tag').and_return(
+            {'id': 1, 'create_event': 400})
+        (session
+            .should_receive('listContainerBuilds')
+            .and_return([{'task_id': 100}, {'task_id': 123}]))
+        session.should_receive('getTaskResult').with_args(100).and_return(
+            {'cache_key': 'other', 'repositories': ['other-repo']})
+        session.should_receive('getTaskResult').with_args(123).and_return(first)
+        task, src = self._mock_reuse_task(tmpdir.mkdir('second'), 124, session,
+                                          build_not_started=True)
+        task._osbs.should_receive('wait_for_build_to_get_scheduled').never()
+        assert task.handler(src['src'], 'target', opts=dict(opts)) == {
+            'repositories': ['unique-repo', 'primary-repo'],
+            'koji_builds': [],
+            'component': 'fedora-docker',
+            'commit': 'abc123',
+            'osbs_builds': ['os-build-id'],
+            'cache_key': cache_key,
+            'reused_task_id': 123,
+        }
+
+    def test_reuse_scratch_without_build_list(self, tmpdir):
+        session = self._mock_session(457, 124)
+        session.should_receive('listContainerBuilds').and_raise(
+            koji.GenericError('Invalid method: listContainerBuilds'))
+        (session
+            .should_receive('listTasks')
+            .with_args(opts=dict, queryOpts={'order': '-completion_time'})
+            .replace_with(lambda opts, queryOpts: [
+                {'id': 124, 'result': {'cache_key': 'key', 'repositories': ['a']}},
+                {'id': 100, 'result': None},
+                {'id': 123, 'result': {'cache_key': 'key', 'repositories': ['b']}},
+            ] if opts['owner'] == 'owner' else []))
+        task, src = self._mock_reuse_task(tmpdir, 124, session, build_not_started=True)
+        assert task._find_reusable_build('key', 'target-name') == (
+            123, {'cache_key': 'key', 'repositories': ['b']})
+
+    def test_get_source_commit(self, tmpdir):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session=flexmock(),
+                                                         options='options',
+                                                         workdir='workdir')
+        sourcedir = str(tmpdir)
+        assert task._get_source_commit(sourcedir) is None
+
+        env = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@example.com',
+                   GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@example.com')
+        subprocess.check_call(['git', 'init', '-q', sourcedir])
+        subprocess.check_call(['git', 'commit', '-q', '--allow-empty', '-m', 'x'],
+                              cwd=sourcedir, env=env)
+        proc = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=sourcedir,
+                                stdout=subprocess.PIPE)
+        commit = proc.communicate()[0]
+        assert proc.returncode == 0
+        assert task._get_source_commit(sourcedir) == commit.strip()
+
+    @pytest.mark.parametrize(('commit', 'repo_event', 'opts', 'same'), (
+        ('abc123', 400, {}, True),
+        ('def456', 400, {}, False),
+        ('abc123', 401, {}, False),
+        ('abc123', 400, {'yum_repourls': ['http://repo']}, False),
+        ('abc123', 400, {'git_branch': 'other'}, False),
+    ))
+    def test_scratch_cache_key(self, commit, repo_event, opts, same):
+        def cache_key(commit, repo_event, opts):
+            session = flexmock()
+            session.should_receive('getRepo').and_return({'create_event': repo_event})
+            task = builder_containerbuild.BuildContainerTask(id=1,
+                                                             method='buildContainer',
+                                                             params='params',
+                                                             session=session,
+                                                             options='options',
+                                                             workdir='workdir')
+            task.opts = dict({'scratch': True, 'reuse_scratch': True,
+                              'git_branch': 'master'}, **opts)
+            task._source_commit = commit
+            target_info = {'name': 'target', 'build_tag': 'build-tag'}
+            return task._scratch_cache_key('git://example.com/repo#HEAD',
+                                           target_info, ['x86_64', 'ppc64le'])
+
+        assert (cache_key(commit, repo_event, opts) ==
+                cache_key('abc123', 400, {})) == same
+
+    def test_scratch_cache_key_without_commit(self):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session=flexmock(),
+                                                         options='options',
+                                                         workdir='workdir')
+        task.opts = {'scratch': True}
+        assert task._scratch_cache_key('git://example.com/repo#HEAD',
+                                       {'name': 'target'}, ['x86_64']) is None
+
+    @pytest.mark.parametrize(('scratch', 'valid'), ((True, True), (False, False)))
+    def test_reuse_scratch_restriction(self, scratch, valid):
+        options = flexmock(allowed_scms='pkgs.example.com:/*:no')
+        options.quiet = False
+        test_args = ['test', 'test', '--git-branch', 'the-branch', '--reuse-scratch']
+        if scratch:
+            test_args.append('--scratch')
+
+        if not valid:
+            with pytest.raises(SystemExit):
+                parse_arguments(options, test_args, flatpak=False)
+            return
+
+        build_opts, parsed_args, opts, _ = parse_arguments(options, test_args, flatpak=False)
+        assert opts == {'git_branch': 'the-branch', 'scratch': True,
+                        'reuse_scratch': True}
+
+class TestFileWatcher(object):
+    def _upload_all(self, watcher):
+        uploaded = {}
+        for fd, fname in watcher.files_to_upload():
+            offset = fd.tell()
+            uploaded[fname] = (offset, fd.read())
+        return uploaded
+
+    @pytest.mark.parametrize(('new_content', 'truncated_to', 'offset'), (
+        # replaced with same content, nothing is uploaded again
+        ('a' * 70000 + 'b' * 70000, None, 140000),
+        # replaced with same content and more, only new content is uploaded
+        ('a' * 70000 + 'b' * 70000 + 'c', None, 140000),
+        # diverged in second block, hub copy is truncated at block boundary
+        ('a' * 70000 + 'c' * 100, 65536, 65536),
+        # diverged in first block, everything is uploaded again
+        ('c' * 100, None, 0),
+    ))
+    def test_reupload_after_replace(self, tmpdir, new_content, truncated_to, offset):
+        log_path = os.path.join(str(tmpdir), 'x86_64.log')
+        with open(log_path, 'w') as f:
+            f.write('a' * 70000 + 'b' * 70000)
+
+        truncated = []
+
+        def truncate_upload(fname, size):
+            truncated.append((fname, size))
+            return True
+
+        watcher = builder_containerbuild.FileWatcher(
+            str(tmpdir), logger=flexmock(info=lambda *args: None),
+            truncate_upload=truncate_upload)
+        assert self._upload_all(watcher)['x86_64.log'][0] == 0
+
+        os.unlink(log_path)
+        with open(log_path, 'w') as f:
+            f.write(new_content)
+
+        uploaded = self._upload_all(watcher)
+        watcher.clean()
+
+        assert uploaded['x86_64.log'] == (offset, new_content[offset:])
+        if truncated_to is None:
+            assert truncated == []
+        else:
+            assert truncated == [('x86_64.log', truncated_to)]
+
+    def test_reupload_without_hub_support(self, tmpdir):
+        log_path = os.path.join(str(tmpdir), 'x86_64.log')
+        with open(log_path, 'w') as f:
+            f.write('a' * 70000 + 'b' * 70000)
+
+        watcher = builder_containerbuild.FileWatcher(
+            str(tmpdir), logger=flexmock(info=lambda *args: None),
+            truncate_upload=lambda fname, size: False)
+        self._upload_all(watcher)
+
+        with open(log_path, 'r+') as f:
+            f.truncate(70000)
+
+        assert self._upload_all(watcher)['x86_64.log'] == (0, 'a' * 70000)
+        watcher.clean()
+
+
+class TestLogCompressor(object):
+    def test_compress(self, tmpdir):
+        source_dir = os.path.join(str(tmpdir), 'source')
+        target_dir = os.path.join(str(tmpdir), 'target')
+        os.mkdir(source_dir)
+        log_path = os.path.join(source_dir, 'x86_64.log')
+        with open(log_path, 'w') as f:
+            f.write('line 1\n' * 20000)
+
+        compressor = builder_containerbuild.LogCompressor(
+            source_dir, target_dir, logger=flexmock(info=lambda *args: None))
+        compressor.compress()
+        gz_path = os.path.join(target_dir, 'x86_64.log.gz')
+        # flushed content is readable while the log is still being written
+        f = gzip.open(gz_path)
+        assert f.read(14) == 'line 1\nline 1\n'
+        f.close()
+
+        with open(log_path, 'a') as f:
+            f.write('line 2\n')
+        compressor.compress(final=True)
+
+        assert os.path.getsize(gz_path) < os.path.getsize(log_path)
+        f = gzip.open(gz_path)
+        assert f.read() == 'line 1\n' * 20000 + 'line 2\n'
+        f.close()
+
+        # no time in the header, the same content is compressed the same way
+        with open(gz_path, 'rb') as f:
+            assert f.read(10) == builder_containerbuild.GzipWriter.HEADER
+        compressed = []
+        for name in ('again-1', 'again-2'):
+            other_dir = os.path.join(str(tmpdir), name)
+            builder_containerbuild.LogCompressor(
+                source_dir, other_dir,
+                logger=flexmock(info=lambda *args: None)).compress(final=True)
+            with open(os.path.join(other_dir, 'x86_64.log.gz'), 'rb') as f:
+                compressed.append(f.read())
+        assert compressed[0] == compressed[1]
+
+    def test_read_config(self, tmpdir):
+        config_path = os.path.join(str(tmpdir), 'builder_containerbuild.conf')
+        with open(config_path, 'w') as f:
+            f.write(dedent("""\
+                [containerbuild]
+                compress_logs = live
+                """))
+
+        config = builder_containerbuild.read_config(config_path)
+        assert config['compress_logs'] == 'live'
+        assert config['compress_level'] == 6
+        assert config['failure_signatures'] == []
+        assert (builder_containerbuild.read_config(config_path + '.missing') ==
+                dict(builder_containerbuild.CONFIG_DEFAULTS, failure_signatures=[]))
+
+    @pytest.mark.parametrize('content', (
+        '[containerbuild]\n continuation without option\n',
+        '[containerbuild]\ncompress_level = high\n',
+    ))
+    def test_read_broken_config(self, tmpdir, content):
+        config_path = os.path.join(str(tmpdir), 'builder_containerbuild.conf')
+        with open(config_path, 'w') as f:
+            f.write(content)
+        assert (builder_containerbuild.read_config(config_path) ==
+                dict(builder_containerbuild.CONFIG_DEFAULTS, failure_signatures=[]))
+
+    def test_read_shipped_config(self):
+        config_path = os.path.join(os.path.dirname(builder_containerbuild.__file__),
+                                   'builder_containerbuild.conf')
+        # every option is commented out, the file has to parse to defaults
+        parser = ConfigParser.SafeConfigParser()
+        assert parser.read(config_path) == [config_path]
+        assert (builder_containerbuild.read_config(config_path) ==
+                dict(builder_containerbuild.CONFIG_DEFAULTS, failure_signatures=[]))
+
+
+class TestUploadLimiter(object):
+    @pytest.mark.parametrize('shared', (True, False))
+    def test_acquire(self, tmpdir, shared):
+        now = [1000.0]
+        flexmock(builder_containerbuild.time).should_receive('time').replace_with(lambda: now[0])
+        state_file = os.path.join(str(tmpdir), 'state') if shared else None
+
+        def limiter():
+            return builder_containerbuild.UploadLimiter(1000, 10, burst=2.0, reserve=0.25,
+                                                        state_file=state_file)
+        first = limiter()
+        assert first.acquire(1000, 1)
+        # shared limiter sees tokens taken by the other one
+        second = limiter() if shared else first
+        # 1000 tokens left, regular upload has to leave 500 of them
+        assert not second.acquire(600, 1)
+        assert second.acquire(500, 1)
+        # priority upload goes into debt
+        assert second.acquire(1000, 1, priority=True)
+        assert not second.acquire(1, 1)
+
+        now[0] += 2
+        # refilled to -500 + 2000
+        assert not first.acquire(1100, 1)
+        assert first.acquire(1000, 1)
+
+        now[0] += 10
+        # upload bigger than the bucket passes once the bucket is full
+        assert first.acquire(5000, 1)
+        assert not first.acquire(1, 1)
+
+
+class TestUploadCadence(object):
+    def test_interval(self):
+        cadence = builder_containerbuild.UploadCadence(min_interval=0.25, max_interval=4.0,
+                                                       busy_rate=1000,
+                                                       max_round_bytes=4 * 65536)
+        assert cadence.interval == 1.0
+
+        # quiet logs back off exponentially up to the maximum
+        for expected in (2.0, 4.0, 4.0):
+            cadence.update(0)
+            assert cadence.interval == expected
+
+        # slow growth keeps the interval
+        cadence.update(100)
+        assert cadence.interval == 4.0
+
+        # fast growth speeds up to the minimum
+        for expected in (2.0, 1.0, 0.5, 0.25, 0.25):
+            cadence.update(10000)
+            assert cadence.interval == expected
+
+        assert cadence.summary() == (9, 18.75 / 9, 50100 // 9)
+
+    def test_round_bytes(self):
+        cadence = builder_containerbuild.UploadCadence(min_interval=0.25, max_interval=4.0,
+                                                       busy_rate=1000,
+                                                       max_round_bytes=4 * 65536)
+        assert cadence.round_bytes == 4 * 65536
+        cadence.update(100)
+        assert cadence.round_bytes == 2 * 65536
+        cadence.update(100)
+        cadence.update(100)
+        assert cadence.round_bytes == 65536
+        cadence.update(65536, backlog=True)
+        assert cadence.round_bytes == 2 * 65536
+
+    def test_backlog_is_not_growth(self, tmpdir):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session='session',
+                                                         options='options',
+                                                         workdir=str(tmpdir))
+        block = builder_containerbuild.UPLOAD_BLOCK_SIZE
+        task._config = dict(builder_containerbuild.CONFIG_DEFAULTS, failure_signatures=[],
+                            upload_round_max=block)
+        with open(os.path.join(task.resultdir(), 'x86_64.log'), 'w') as f:
+            f.write('a' * 3 * block)
+        # child finishes in the fourth round, the log grows in the third one
+        rounds = []
+
+        def wait_for_child(child_pid, timeout):
+            rounds.append(timeout)
+            if len(rounds) == 3:
+                with open(os.path.join(task.resultdir(), 'x86_64.log'), 'a') as f:
+                    f.write('b' * 10)
+            return len(rounds) == 4
+
+        flexmock(task).should_receive('_wait_for_child').replace_with(wait_for_child)
+        updates = []
+        (flexmock(builder_containerbuild.UploadCadence)
+            .should_receive('update')
+            .replace_with(lambda appended, backlog=False: updates.append((appended,
+                                                                          backlog))))
+
+        task._incremental_upload_logs(12345)
+
+        assert updates == [(3 * block, True), (0, True), (10, True), (0, False)]
+
+
+class TestMmapFile(object):
+    def test_read(self, tmpdir):
+        log_path = os.path.join(str(tmpdir), 'x86_64.log')
+        content = ''.join(chr(ord('a') + i % 26) for i in range(5 * mmap.ALLOCATIONGRANULARITY + 7))
+        with open(log_path, 'w') as f:
+            f.write(content)
+
+        fd = builder_containerbuild.MmapFile(open(log_path, 'r'),
+                                             window=2 * mmap.ALLOCATIONGRANULARITY)
+        fd.seek(3)
+        data = ''
+        while True:
+            chunk = fd.read(1000)
+            if not chunk:
+                break
+            assert len(chunk) <= 1000
+            data += chunk
+        assert data == content[3:]
+        assert fd.tell() == len(content)
+        fd.close()
+
+    def test_watcher_switches_to_mmap(self, tmpdir):
+        log_path = os.path.join(str(tmpdir), 'x86_64.log')
+        with open(log_path, 'w') as f:
+            f.write('a' * 100)
+
+        watcher = builder_containerbuild.FileWatcher(
+            str(tmpdir), logger=flexmock(info=lambda *args: None),
+            large_log_threshold=1000, large_log_window=mmap.ALLOCATIONGRANULARITY)
+        (fd, fname), = watcher.files_to_upload()
+        assert fd.read() == 'a' * 100
+
+        with open(log_path, 'a') as f:
+            f.write('b' * 10000)
+        (fd, fname), = watcher.files_to_upload()
+        assert isinstance(watcher._logs[fname][0], builder_containerbuild.MmapFile)
+        assert fd.tell() == 100
+        assert fd.read() == 'b' * 10000
+        watcher.clean()
+
+    def _in_child(self, func):
+        """Run func in forked process, returns its exit status
+
+        SIGBUS on reading unmapped pages would kill the tests otherwise.
+        """
+        pid = os.fork()
+        if not pid:
+            try:
+                func()
+            except BaseException:
+                os._exit(1)
+            os._exit(0)
+        return os.waitpid(pid, 0)[1]
+
+    def test_truncated_in_place(self, tmpdir):
+        log_path = os.path.join(str(tmpdir), 'x86_64.log')
+        with open(log_path, 'w') as f:
+            f.write('a' * (3 * mmap.ALLOCATIONGRANULARITY))
+
+        def read():
+            fd = builder_containerbuild.MmapFile(open(log_path, 'r'),
+                                                 window=2 * mmap.ALLOCATIONGRANULARITY)
+            assert fd.read(10) == 'a' * 10
+            with open(log_path, 'w') as f:
+                f.write('b' * 100)
+            fd.seek(20)
+            assert fd.read(1000) == 'b' * 80
+            assert fd.read(1000) == ''
+
+        assert self._in_child(read) == 0
+
+    def test_rewritten_log_is_replaced(self, tmpdir):
+        path = os.path.join(str(tmpdir), 'x86_64.log')
+        with builder_containerbuild.LogFiles(str(tmpdir)) as logs:
+            logs.write('x86_64', 'a' * (2 * mmap.ALLOCATIONGRANULARITY))
+        fd = builder_containerbuild.MmapFile(open(path, 'r'),
+                                             window=mmap.ALLOCATIONGRANULARITY)
+        assert fd.read(10) == 'a' * 10
+
+        # log follower retried, the log is written again from the beginning
+        with builder_containerbuild.LogFiles(str(tmpdir)) as logs:
+            logs.write('x86_64', 'b' * 10)
+
+        # reader of the old file isn't affected
+        assert os.fstat(fd.fileno()).st_ino != os.stat(path).st_ino
+        assert fd.read() == 'a' * (2 * mmap.ALLOCATIONGRANULARITY - 10)
+        fd.close()
+        with open(path) as f:
+            assert f.read() == 'b' * 10
+
+
+class TestLogIndexer(object):
+    def test_index(self, tmpdir):
+        lines = [
+            '2017-10-04 10:00:00,000 - atomic_reactor.plugin - DEBUG - running plugin \'pull_base_image\'',
+            '2017-10-04 10:00:01,500 - atomic_reactor.util - INFO - pulling',
+            '2017-10-04 10:00:02,000 - atomic_reactor.plugin - DEBUG - running plugin \'add_labels_in_dockerfile\'',
+            'continuation of a message',
+            '2017-10-04 10:00:12,250 - atomic_reactor.plugin - ERROR - plugin \'add_labels_in_dockerfile\' raised an exception: KeyError',
+            '2017-10-04 10:00:13,000 - atomic_reactor.inner - INFO - build failed',
+        ]
+        index_path = os.path.join(str(tmpdir), 'x86_64.idx.json')
+        indexer = builder_containerbuild.LogIndexer(index_path)
+        offset = 0
+        offsets = []
+        for line in lines:
+            offsets.append(offset)
+            indexer.feed(offset, line)
+            offset += len(line) + 1
+        indexer.finish(offset)
+
+        with open(index_path) as f:
+            index = json.load(f)
+
+        assert index['size'] == offset
+        assert [(plugin['name'], plugin['offset'], plugin['end'], plugin['duration'], plugin['failed'])
+                for plugin in index['plugins']] == [
+            ('pull_base_image', offsets[0], offsets[2], 2.0, False),
+            ('add_labels_in_dockerfile', offsets[2], offset, 11.0, True),
+        ]
+        assert index['errors'] == [{
+            'offset': offsets[4],
+            'plugin': 'add_labels_in_dockerfile',
+            'message': "plugin 'add_labels_in_dockerfile' raised an exception: KeyError",
+        }]
+
+    def test_demultiplexed_logs_indexed(self, tmpdir):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session='session',
+                                                         options='options',
+                                                         workdir=str(tmpdir))
+        task._osbs = flexmock()
+        (task._osbs
+            .should_receive('get_orchestrator_build_logs')
+            .with_args('os-build-id', follow=True)
+            .and_return(logs))
+        task._write_demultiplexed_logs('os-build-id', str(tmpdir))
+
+        assert sorted(os.listdir(str(tmpdir))) == ['log-tails.json',
+                                                   'orchestrator.idx.json', 'orchestrator.log',
+                                                   'x86_64.idx.json', 'x86_64.log']
+        with open(os.path.join(str(tmpdir), 'x86_64.idx.json')) as f:
+            index = json.load(f)
+        assert index['size'] == os.path.getsize(os.path.join(str(tmpdir), 'x86_64.log'))
+
+
+class TestFailureClassifier(object):
+    def _write_logs(self, tmpdir, logs):
+        paths = []
+        for fname, content in logs:
+            path = os.path.join(str(tmpdir), fname)
+            with open(path, 'w') as f:
+                f.write(content)
+            paths.append(path)
+        return paths
+
+    @pytest.mark.parametrize(('logs', 'failure_class', 'excerpt'), (
+        ([('x86_64.log', 'line 1\nline 2\n')], None, None),
+        ([('x86_64.log', 'a\nb\nc\nd\n'
+                         'Error: Failed to download metadata for repo \'fedora\'\ne\n')],
+         'repo_unavailable',
+         "x86_64.log:\nb\nc\nd\nError: Failed to download metadata for repo 'fedora'"),
+        # earlier signature wins even if it's found later
+        ([('x86_64.log', 'Error: nothing provides libfoo.so\n'),
+          ('ppc64le.log', 'x\nfatal: MemoryError\n')],
+         'oom', 'ppc64le.log:\nx\nfatal: MemoryError'),
+        ([('x86_64.log', 'Failed to push image: Read timed out\n')],
+         'registry_push_timeout', 'x86_64.log:\nFailed to push image: Read timed out'),
+    ))
+    def test_classify(self, tmpdir, logs, failure_class, excerpt):
+        paths = self._write_logs(tmpdir, logs)
+        classifier = builder_containerbuild.FailureClassifier()
+        assert classifier.classify(paths) == (failure_class, excerpt)
+
+    def test_custom_signatures(self, tmpdir):
+        paths = self._write_logs(tmpdir, [('x86_64.log', 'write: No space left on device\n')])
+        classifier = builder_containerbuild.FailureClassifier(
+            builder_containerbuild.FAILURE_SIGNATURES + [('disk_full', 'No space left')])
+        assert classifier.classify(paths) == ('disk_full',
+                                              'x86_64.log:\nwrite: No space left on device')
+
+    def test_classify_failed_build(self, tmpdir):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session='session',
+                                                         options='options',
+                                                         workdir=str(tmpdir))
+        task._config = dict(builder_containerbuild.CONFIG_DEFAULTS, failure_signatures=[])
+        self._write_logs(tmpdir.join('osbslogs').ensure(dir=True), [
+            ('orchestrator.log', 'Problem: conflicting requests\n'),
+            ('osbs-client.log', 'Cannot allocate memory\n'),
+            ('x86_64.log', 'Problem: conflicting requests\n'),
+        ])
+        assert task._classify_failure() == ('dnf_depsolve',
+                                            'x86_64.log:\nProblem: conflicting requests')
+
+
+class TestFailureTail(object):
+    def test_failure_tail(self, tmpdir):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session='session',
+                                                         options='options',
+                                                         workdir=str(tmpdir))
+        task._config = dict(builder_containerbuild.CONFIG_DEFAULTS, failure_tail_lines=12)
+        entries = [LogEntry(None, 'orchestrator line')]
+        entries += [LogEntry('x86_64', 'line %d' % i) for i in range(20)]
+        task._osbs = flexmock()
+        (task._osbs
+            .should_receive('get_orchestrator_build_logs')
+            .and_return(entries))
+        task._write_demultiplexed_logs('os-build-id', task.resultdir())
+
+        tail_path = os.path.join(str(tmpdir), 'failure-tail.log')
+        flexmock(task).should_receive('uploadFile').with_args(tail_path).once()
+        summary = task._failure_tail('Image build failed.')
+
+        assert summary == '\n'.join(
+            ['Last lines of x86_64.log:'] + ['line %d' % i for i in range(10, 20)] +
+            ['Last lines of orchestrator.log:', 'orchestrator line'])
+        with open(tail_path) as f:
+            assert f.read() == '\n'.join(
+                ['Image build failed.', '', '==> x86_64.log <=='] +
+                ['line %d' % i for i in range(8, 20)] +
+                ['', '==> orchestrator.log <==', 'orchestrator line', ''])
+
+    def test_tails_written_while_reading(self, tmpdir):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session='session',
+                                                         options='options',
+                                                         workdir=str(tmpdir))
+        task._config = dict(builder_containerbuild.CONFIG_DEFAULTS)
+        flexmock(builder_containerbuild, LOG_TAILS_INTERVAL=0)
+        tails_path = os.path.join(task.resultdir(), 'log-tails.json')
+        seen = []
+
+        def entries():
+            yield LogEntry('x86_64', 'line 1')
+            # the log writer child is killed when the task is cancelled, the
+            # tails have to be saved before the logs end
+            with open(tails_path) as f:
+                seen.append(json.load(f))
+            yield LogEntry('x86_64', 'line 2')
+
+        task._osbs = flexmock()
+        task._osbs.should_receive('get_orchestrator_build_logs').and_return(entries())
+        task._write_demultiplexed_logs('os-build-id', task.resultdir())
+
+        assert seen == [{'x86_64': ['line 1']}]
+        with open(tails_path) as f:
+            assert json.load(f) == {'x86_64': ['line 1', 'line 2']}
+
+    def test_no_tails(self, tmpdir):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session='session',
+                                                         options='options',
+                                                         workdir=str(tmpdir))
+        flexmock(task).should_receive('uploadFile').never()
+        assert task._failure_tail('Image build failed.') == ''
+
+    @pytest.mark.parametrize('cancelled', (False, True))
+    def test_non_ascii_failure(self, tmpdir, cancelled):
+        task = container_task(tmpdir, progress_interval=0)
+        build_response = flexmock(get_build_name=lambda: 'os-build-id')
+        task._osbs.should_receive('create_orchestrator_build').and_return(build_response)
+        task._osbs.should_receive('wait_for_build_to_get_scheduled')
+        tails = {'x86_64': [u'Fehler: Paket \u201eb\xe4r\u201c fehlt']}
+        (flexmock(task)
+            .should_receive('_stream_logs_to_hub')
+            .replace_with(lambda build_id: task._write_log_tails(task.resultdir(), tails)))
+        response = flexmock(status='failed', json={}, is_cancelled=lambda: cancelled,
+                            is_failed=lambda: True, is_succeeded=lambda: False,
+                            get_error_message=lambda: u'Erreur: d\xe9p\xf4t')
+        task._osbs.should_receive('wait_for_build_to_finish').and_return(response)
+        flexmock(task).should_receive('uploadFile').once()
+        task.session.should_receive('cancelTask').with_args(1).times(1 if cancelled else 0)
+        expected = (builder_containerbuild.ContainerCancelled if cancelled
+                    else builder_containerbuild.ContainerError)
+
+        with pytest.raises(expected) as exc:
+            create_container(task)
+
+        assert u'Fehler: Paket \u201eb\xe4r\u201c fehlt' in exc.value.args[0]
+        with open(os.path.join(str(tmpdir), 'failure-tail.log')) as f:
+            content = f.read().decode('utf-8')
+        assert u'b\xe4r' in content
+        if not cancelled:
+            assert u'Erreur: d\xe9p\xf4t' in exc.value.args[0]
+            assert u'Erreur: d\xe9p\xf4t' in content
+
+    def test_non_ascii_failure_excerpt(self, tmpdir):
+        task = container_task(tmpdir, progress_interval=0)
+        build_response = flexmock(get_build_name=lambda: 'os-build-id')
+        task._osbs.should_receive('create_orchestrator_build').and_return(build_response)
+        task._osbs.should_receive('wait_for_build_to_get_scheduled')
+        flexmock(task).should_receive('_stream_logs_to_hub')
+        response = flexmock(status='failed', json={}, is_cancelled=lambda: False,
+                            is_failed=lambda: True, is_succeeded=lambda: False,
+                            get_error_message=lambda: u'Erreur: d\xe9p\xf4t')
+        task._osbs.should_receive('wait_for_build_to_finish').and_return(response)
+        # excerpt is raw bytes of the log
+        (flexmock(task)
+            .should_receive('_classify_failure')
+            .and_return(('dnf_depsolve',
+                         'x86_64.log:\nNo package b\xc3\xa4r available')))
+
+        with pytest.raises(builder_containerbuild.ContainerError) as exc:
+            create_container(task)
+
+        # kojid sends str() of koji errors to the hub as the fault
+        fault = str(exc.value)
+        assert fault.startswith('[dnf_depsolve] Image build failed. ')
+        assert '\nx86_64.log:\nNo package b\xc3\xa4r available' in fault
+
+
+class TestLogFiles(object):
+    def _open_fds(self):
+        return len(os.listdir('/proc/self/fd'))
+
+    def _task(self, workdir, entries, max_open):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session='session',
+                                                         options='options',
+                                                         workdir=workdir)
+        task._config = dict(builder_containerbuild.CONFIG_DEFAULTS, max_open_logs=max_open)
+        task._osbs = flexmock()
+        (task._osbs
+            .should_receive('get_orchestrator_build_logs')
+            .and_return(entries))
+        return task
+
+    def test_reopen_in_append_mode(self, tmpdir):
+        with builder_containerbuild.LogFiles(str(tmpdir), max_open=2) as log_files:
+            offsets = [log_files.write(prefix, 'line\n')
+                       for prefix in ('a', 'b', 'c', 'a', 'c', 'b', 'a')]
+            # the least recently written one was closed
+            assert sorted(log_files._handles) == ['a', 'b']
+            assert log_files.sizes() == [('a', 15), ('b', 10), ('c', 10)]
+        assert log_files._handles == {}
+        assert offsets == [0, 0, 0, 5, 5, 5, 10]
+        for prefix, size in (('a', 15), ('b', 10), ('c', 10)):
+            assert os.path.getsize(os.path.join(str(tmpdir), prefix + '.log')) == size
+
+    def test_files_closed_on_error(self, tmpdir):
+        def entries():
+            for platform in ('x86_64', 'ppc64le', 's390x'):
+                yield LogEntry(platform, 'line')
+            raise RuntimeError('connection dropped')
+
+        task = self._task(str(tmpdir), entries(), max_open=8)
+        open_fds = self._open_fds()
+        with pytest.raises(RuntimeError):
+            task._write_demultiplexed_logs('os-build-id', str(tmpdir))
+        assert self._open_fds() == open_fds
+
+    @pytest.mark.parametrize(('platforms', 'tasks', 'max_open'), ((16, 50, 4),))
+    def test_concurrent_tasks(self, tmpdir, platforms, tasks, max_open):
+        open_fds = self._open_fds()
+        max_fds = []
+
+        def entries():
+            for i in range(10):
+                for platform in range(platforms):
+                    max_fds.append(self._open_fds())
+                    yield LogEntry('platform-%d' % platform, 'line %d' % i)
+
+        threads = []
+        for task_no in range(tasks):
+            logs_dir = str(tmpdir.mkdir('task-%d' % task_no))
+            task = self._task(logs_dir, entries(), max_open=max_open)
+            threads.append(threading.Thread(target=task._write_demultiplexed_logs,
+                                            args=('os-build-id', logs_dir)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # each task holds at most max_open logs plus an index or tails file
+        # which is being written
+        assert max(max_fds) <= open_fds + tasks * (max_open + 1)
+        assert self._open_fds() == open_fds
+        for task_no in range(tasks):
+            for platform in range(platforms):
+                log_path = str(tmpdir.join('task-%d' % task_no, 'platform-%d.log' % platform))
+                with open(log_path) as f:
+                    assert f.read() == ''.join('line %d\n' % i for i in range(10))
+
+
+class TestDirectLogUpload(object):
+    def test_log_stream_spool(self, tmpdir):
+        spool_path = os.path.join(str(tmpdir), 'x86_64.log.spool')
+        stream = builder_containerbuild.LogStream('x86_64.log', spool_path, max_buffer=10)
+        stream.append('12345')
+        stream.append('67890')
+        # memory buffer is full, rest goes to spool
+        stream.append('abc')
+        stream.append('def')
+        assert os.path.exists(spool_path)
+        assert stream.pending() == 16
+
+        assert stream.take(4) == '1234'
+        assert stream.take(100) == '567890'
+        # spooling continues until the spool is drained to keep the order
+        stream.append('ghi')
+        assert stream.take(5) == 'abcde'
+        assert stream.take(100) == 'fghi'
+        assert stream.take(100) == ''
+        assert not os.path.exists(spool_path)
+
+        stream.append('jkl')
+        assert stream.take(100) == 'jkl'
+        assert not os.path.exists(spool_path)
+
+    def test_stream_logs_to_hub(self, tmpdir):
+        task = builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session='session',
+                                                         options='options',
+                                                         workdir=str(tmpdir))
+        task._config = dict(builder_containerbuild.CONFIG_DEFAULTS,
+                            failure_signatures=[], direct_log_buffer=10,
+                            upload_interval_min=0, upload_interval_max=0.1)
+
+        def entries():
+            yield LogEntry(None, 'orchestrator')
+            yield LogEntry('x86_64', 'line 1')
+            yield LogEntry('x86_64', 'Error: Unable to find a match: foo')
+            yield LogEntry('x86_64', 'line 3')
+
+        build_response = flexmock(status='failed')
+        build_response.should_receive('is_running').and_return(False)
+        build_response.should_receive('is_pending').and_return(False)
+        # logs are read by a client of the reader thread only
+        task._osbs = flexmock()
+        task._osbs.should_receive('get_orchestrator_build_logs').never()
+        reader_osbs = flexmock()
+        (reader_osbs
+            .should_receive('get_orchestrator_build_logs')
+            .with_args('os-build-id', follow=True)
+            .and_return(entries()))
+        reader_osbs.should_receive('get_build').and_return(build_response)
+        flexmock(task).should_receive('_create_osbs').and_return(reader_osbs).once()
+
+        uploaded = {}
+
+        def upload(session, fname, fd, uploadpath, logger=None):
+            content = uploaded.setdefault(fname, '')
+            assert fd.tell() == len(content)
+            uploaded[fname] = content + fd.read()
+
+        flexmock(builder_containerbuild).should_receive('incremental_upload').replace_with(upload)
+        uploaded_files = []
+        (flexmock(task)
+            .should_receive('uploadFile')
+            .replace_with(lambda path: uploaded_files.append(os.path.basename(path))))
+
+        task._stream_logs_to_hub('os-build-id')
+
+        assert uploaded == {
+            'orchestrator.log': 'orchestrator\n',
+            'x86_64.log': 'line 1\nError: Unable to find a match: foo\nline 3\n',
+        }
+        assert uploaded_files == ['orchestrator.idx.json', 'x86_64.idx.json']
+        # no log files on the builder
+        assert sorted(os.listdir(task.resultdir())) == ['log-tails.json',
+                                                        'orchestrator.idx.json',
+                                                        'x86_64.idx.json']
+        assert task._classify_failure() == ('dnf_depsolve',
+                                            'x86_64.log:\nline 1\n'
+                                            'Error: Unable to find a match: foo')
+
+
+class TestPreflight(object):
+    def _task(self, session=None):
+        return builder_containerbuild.BuildContainerTask(id=1,
+                                                         method='buildContainer',
+                                                         params='params',
+                                                         session=session or flexmock(),
+                                                         options='options',
+                                                         workdir='workdir')
+
+    def test_steps_run_concurrently(self):
+        task = self._task()
+        started = threading.Event()
+
+        def first():
+            # waits for the second step, would time out if run one by one
+            assert started.wait(5)
+            return 'first'
+
+        def second():
+            started.set()
+            return 'second'
+
+        assert task._run_preflight([first, second]) == ['first', 'second']
+
+    def test_first_error_wins(self):
+        task = self._task()
+        first_failing = threading.Event()
+
+        def first():
+            first_failing.wait(5)
+            raise koji.BuildError('first')
+
+        def second():
+            try:
+                raise koji.BuildError('second')
+            finally:
+                first_failing.set()
+
+        with pytest.raises(koji.BuildError) as exc:
+            task._run_preflight([lambda: None, first, second])
+        assert str(exc.value) == 'first'
+
+    def test_session_calls_serialized(self):
+        active = []
+        overlaps = []
+
+        def hub_call(*args):
+            active.append(args)
+            if len(active) > 1:
+                overlaps.append(args)
+            time.sleep(0.01)
+            active.remove(args)
+            return args
+
+        session = flexmock(getTaskInfo=hub_call)
+        task = self._task(session)
+        steps = [lambda i=i: task.session.getTaskInfo(i) for i in range(8)]
+
+        assert task._run_preflight(steps) == [(i,) for i in range(8)]
+        assert overlaps == []
+        assert task.session is session
+
+
+class MulticallSession(object):
+    """Base of fake hubs, calls of methods from _call go through multicall"""
+
+    def __init__(self):
+        self.multicall = False
+        self.calls = []
+        self._queued = []
+
+    def _call(self, func, *args, **kwargs):
+        if self.multicall:
+            self._queued.append((func, args, kwargs))
+            return None
+        return func(*args, **kwargs)
+
+    def multiCall(self, strict=False):
+        self.calls.append(('multiCall', len(self._queued)))
+        self.multicall = False
+        results = []
+        for func, args, kwargs in self._queued:
+            try:
+                results.append([func(*args, **kwargs)])
+            except koji.GenericError as error:
+                if strict:
+                    raise
+                results.append({'faultCode': 1000, 'faultString': str(error)})
+        self._queued = []
+        return results
+
+    def getTaskInfo(self, task_id):
+        return self._call(self._get_task_info, task_id)
+
+    def getTaskResult(self, task_id):
+        return self._call(self._get_task_result, task_id)
+
+    def getContainerTaskStates(self, task_ids, since=None):
+        return self._call(self._get_container_task_states, task_ids, since)
+
+    def _get_container_task_states(self, task_ids, since):
+        tasks = []
+        for task_id in task_ids:
+            info = dict(self._get_task_info(task_id), id=task_id)
+            tasks.append(info)
+        return {'ts': time.time(), 'tasks': tasks}
+
+
+class ChainSession(MulticallSession):
+    """Hub which finishes each build task on the second check of its state"""
+
+    def __init__(self, fail=()):
+        super(ChainSession, self).__init__()
+        self.fail = fail
+        self.tasks = {}
+        self.checks = {}
+        self.running = 0
+        self.max_running = 0
+
+    def buildContainer(self, source, target, opts, priority=None, channel=None):
+        task_id = len(self.tasks) + 1
+        self.tasks[task_id] = (source, opts)
+        self.checks[task_id] = 0
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        return task_id
+
+    def _get_task_info(self, task_id):
+        self.checks[task_id] += 1
+        if self.checks[task_id] < 2:
+            return {'state': koji.TASK_STATES['OPEN']}
+        self.running -= 1
+        if self.tasks[task_id][0] in self.fail:
+            return {'state': koji.TASK_STATES['FAILED']}
+        return {'state': koji.TASK_STATES['CLOSED']}
+
+    def _get_task_result(self, task_id):
+        if self.checks[task_id] < 2:
+            raise koji.GenericError('task %s is not finished' % task_id)
+        if self.tasks[task_id][0] in self.fail:
+            raise koji.GenericError('Image build failed. Step: build')
+        return {'koji_builds': [task_id * 100]}
+
+    def getBuild(self, build_id):
+        return {'nvr': 'build-%s' % build_id}
+
+
+class TestChain(object):
+    def _write_chain(self, tmpdir, builds):
+        path = str(tmpdir.join('chain.json'))
+        with open(path, 'w') as f:
+            json.dump(builds, f)
+        return path
+
+    def _build(self, name, parent=None):
+        build = {'name': name, 'target': 'target', 'git_branch': 'master',
+                 'source': 'git://example.com/%s#HEAD' % name}
+        if parent:
+            build['parent'] = parent
+        return build
+
+    def test_load_chain_orders_parents_first(self, tmpdir):
+        path = self._write_chain(tmpdir, [self._build('app', 'runtime'),
+                                          self._build('runtime', 'base'),
+                                          self._build('base')])
+        assert [build['name'] for build in cli.load_chain(path)] == [
+            'base', 'runtime', 'app']
+
+    @pytest.mark.parametrize(('builds', 'error'), (
+        ([{'name': 'base'}], 'missing target, source, git_branch'),
+        ([{'name': 'a', 'target': 't', 'source': 's', 'git_branch': 'b',
+           'scratch': True}], 'unknown keys: scratch'),
+        ([('a', None), ('a', None)], 'Duplicate build name'),
+        ([('a', 'b'), ('b', 'a')], 'Cycle in chain'),
+        ([('a', 'a')], 'Cycle in chain'),
+        ([('a', 'missing')], 'Unknown parent missing'),
+    ))
+    def test_load_chain_invalid(self, tmpdir, builds, error):
+        builds = [self._build(*build) if isinstance(build, tuple) else build
+                  for build in builds]
+        path = self._write_chain(tmpdir, builds)
+        with pytest.raises(ValueError) as exc:
+            cli.load_chain(path)
+        assert error in str(exc.value)
+
+    def test_run_chain(self, tmpdir):
+        # base -> runtime -> app, base -> tools, other
+        builds = cli.load_chain(self._write_chain(tmpdir, [
+            self._build('base'), self._build('runtime', 'base'),
+            self._build('app', 'runtime'), self._build('tools', 'base'),
+            self._build('other')]))
+        session = ChainSession()
+
+        states = cli.run_chain(session, builds, max_concurrent=2,
+                               poll_interval=0, quiet=True)
+
+        assert session.max_running == 2
+        assert states == {
+            'base': ('succeeded', 1, 'build-100'),
+            'other': ('succeeded', 2, 'build-200'),
+            'runtime': ('succeeded', 3, 'build-300'),
+            'tools': ('succeeded', 4, 'build-400'),
+            'app': ('succeeded', 5, 'build-500'),
+        }
+        # children are built on top of their parents' builds
+        assert session.tasks[3][1]['koji_parent_build'] == 'build-100'
+        assert session.tasks[4][1]['koji_parent_build'] == 'build-100'
+        assert session.tasks[5][1]['koji_parent_build'] == 'build-300'
+        assert 'koji_parent_build' not in session.tasks[1][1]
+
+    def test_run_chain_skips_children_of_failed(self, tmpdir, capsys):
+        builds = cli.load_chain(self._write_chain(tmpdir, [
+            self._build('base'), self._build('runtime', 'base'),
+            self._build('app', 'runtime'), self._build('other')]))
+        session = ChainSession(fail=('git://example.com/base#HEAD',))
+
+        states = cli.run_chain(session, builds, max_concurrent=4,
+                               poll_interval=0)
+
+        # fault of the task is shown
+        assert ('base: task 1 failed: Image build failed. Step: build' in
+                capsys.readouterr()[0].splitlines())
+
+        assert states == {
+            'base': ('failed', 1, None),
+            'other': ('succeeded', 2, 'build-200'),
+            'runtime': ('skipped', None, None),
+            'app': ('skipped', None, None),
+        }
+
+    @pytest.mark.parametrize('sibling', (True, False))
+    def test_run_chain_submit_failed(self, tmpdir, capsys, sibling):
+        # base -> runtime -> app, base -> tools
+        builds = [self._build('base'), self._build('runtime', 'base'),
+                  self._build('app', 'runtime')]
+        if sibling:
+            builds.append(self._build('tools', 'base'))
+        builds = cli.load_chain(self._write_chain(tmpdir, builds))
+        session = ChainSession()
+        build_container = session.buildContainer
+
+        def buildContainer(source, *args, **kwargs):
+            if source == 'git://example.com/runtime#HEAD':
+                raise koji.GenericError('Invalid target')
+            return build_container(source, *args, **kwargs)
+
+        session.buildContainer = buildContainer
+
+        states = cli.run_chain(session, builds, max_concurrent=4,
+                               poll_interval=0)
+
+        assert ('runtime: failed to create task: Invalid target' in
+                capsys.readouterr()[0].splitlines())
+        expected = {
+            'base': ('succeeded', 1, 'build-100'),
+            'runtime': ('failed', None, None),
+            'app': ('skipped', None, None),
+        }
+        if sibling:
+            # build submitted after the failed one is still watched
+            expected['tools'] = ('succeeded', 2, 'build-200')
+        assert states == expected
+
+
+class TestAdmissionControl(object):
+    def _admission(self, tmpdir, **kwargs):
+        return builder_containerbuild.AdmissionControl(str(tmpdir.join('state')),
+                                                      **kwargs)
+
+    def test_queue_depth(self, tmpdir):
+        admission = self._admission(tmpdir, max_queue=5, sample_interval=60)
+        samples = []
+
+        def sample(depth):
+            samples.append(depth)
+            return depth
+
+        assert admission.admit('default', lambda: sample(3)) == (True, None)
+        # last sample is still fresh
+        assert admission.admit('default', lambda: sample(10)) == (True, None)
+        assert samples == [3]
+        # another process sees it too
+        other = self._admission(tmpdir, max_queue=5, sample_interval=0)
+        assert other.admit('default', lambda: sample(10)) == (False, 'queue')
+        # sections are sampled separately
+        assert other.admit('scratch', lambda: sample(1)) == (True, None)
+
+    def test_failed_sample_admits(self, tmpdir):
+        admission = self._admission(tmpdir, max_queue=5)
+
+        def sample():
+            raise RuntimeError('OSBS is down')
+
+        assert admission.admit('default', sample) == (True, None)
+
+    def test_latency(self, tmpdir):
+        admission = self._admission(tmpdir, max_latency=30)
+        no_sample = lambda: 1 / 0
+
+        for latency in (10, 40, 50):
+            flexmock(time).should_receive('time').and_return(1000.0)
+            admission.wait_started(1, 'default')
+            flexmock(time).should_receive('time').and_return(1000.0 + latency)
+            admission.wait_finished(1, 'default')
+        # median of recent latencies
+        assert admission.admit('default', no_sample) == (False, 'latency')
+        # until they're too old
+        flexmock(time).should_receive('time').and_return(1000.0 + 700)
+        assert admission.admit('default', no_sample) == (True, None)
+
+        # build which isn't scheduled yet counts with its current wait
+        admission.wait_started(2, 'default')
+        flexmock(time).should_receive('time').and_return(1000.0 + 800)
+        assert admission.admit('default', no_sample) == (False, 'latency')
+        admission.wait_finished(2, 'default', scheduled=False)
+        assert admission.admit('default', no_sample) == (True, None)
+
+    def test_wait_of_dead_process_expires(self, tmpdir):
+        admission = self._admission(tmpdir, max_latency=30)
+        flexmock(time).should_receive('time').and_return(1000.0)
+        admission.wait_started(1, 'default')
+        flexmock(time).should_receive('time').and_return(1100.0)
+        flexmock(os).should_receive('kill').and_raise(OSError)
+        assert admission.admit('default', None) == (True, None)
+
+    def test_metrics(self, tmpdir):
+        metrics = str(tmpdir.join('metrics.prom'))
+        admission = self._admission(tmpdir, max_queue=5, sample_interval=0,
+                                    metrics_file=metrics)
+        admission.admit('default', lambda: 2)
+        admission.admit('default', lambda: 2)
+        admission.admit('default', lambda: 7)
+        with open(metrics) as f:
+            lines = [line for line in f.read().splitlines()
+                     if not line.startswith('#')]
+        assert lines == [
+            'koji_containerbuild_admission_decisions_total'
+            '{decision="accepted",reason=""} 2',
+            'koji_containerbuild_admission_decisions_total'
+            '{decision="declined",reason="queue"} 1',
+            'koji_containerbuild_osbs_queue_depth{section="default"} 7',
+        ]
+
+    @pytest.mark.parametrize(('config', 'depth', 'admitted'), (
+        ({}, None, True),
+        ({'admission_max_queue': 5}, 3, True),
+        ({'admission_max_queue': 5}, 6, False),
+    ))
+    def test_check_host(self, tmpdir, config, depth, admitted):
+        task = builder_containerbuild.BuildContainerTask(
+            id=1, method='buildContainer',
+            params=['git://example.com/repo#HEAD', 'target', {'scratch': True}],
+            session=flexmock(), options='options', workdir=str(tmpdir))
+        task._config = dict(builder_containerbuild.CONFIG_DEFAULTS,
+                            admission_state=str(tmpdir.join('state')), **config)
+        builds = [flexmock(is_pending=lambda: True)] * (depth or 0)
+        builds.append(flexmock(is_pending=lambda: False))
+        osbs = flexmock()
+        osbs.should_receive('list_builds').with_args(running=True).and_return(builds)
+        flexmock(task).should_receive('_create_osbs').and_return(osbs)
+
+        assert task.checkHost({}) == admitted
+        if depth is not None:
+            with open(str(tmpdir.join('state'))) as f:
+                assert json.load(f)['queue']['scratch'][1] == depth
+
+
+def container_task(tmpdir, **config):
+    """Task with fake hub and OSBS for calls of createContainer"""
+    task = builder_containerbuild.BuildContainerTask(
+        id=1, method='buildContainer', params='params', session=flexmock(),
+        options=flexmock(allowed_scms='pkgs.example.com:/*:no'),
+        workdir=str(tmpdir))
+    task._config = dict(builder_containerbuild.CONFIG_DEFAULTS,
+                        direct_log_upload=True, **config)
+    task.session.should_receive('getTaskInfo').and_return({'owner': 1})
+    task.session.should_receive('getUser').and_return({'name': 'owner-name'})
+    task._osbs = flexmock()
+    return task
+
+
+def create_container(task):
+    return task.createContainer(src='git://pkgs.example.com/rpms/fedora-docker#HEAD',
+                                target_info={'name': 'target'}, arches=['x86_64'])
+
+
+class TestCancelCoordinator(object):
+    def _coordinator(self, failures=0, timeout=8.0):
+        cancelled = []
+
+        def cancel_build(build_id):
+            cancelled.append(build_id)
+            if len(cancelled) <= failures:
+                raise RuntimeError('500 Internal Server Error')
+
+        coordinator = builder_containerbuild.CancelCoordinator(
+            cancel_build, logging.getLogger('koji.build'),
+            timeout=timeout, retry_delay=0.5)
+        return coordinator, cancelled
+
+    def test_handler_only_records_request(self):
+        coordinator, cancelled = self._coordinator()
+        coordinator.set_build('os-build-id')
+        flexmock(coordinator).should_receive('cancel').never()
+
+        coordinator._handle_signal(signal.SIGINT, None)
+
+        assert coordinator.stopped.is_set()
+        assert coordinator.requested is not None
+        with pytest.raises(builder_containerbuild.ContainerCancelled):
+            coordinator.check()
+
+    def test_cancel_with_retries(self):
+        coordinator, cancelled = self._coordinator(failures=2)
+        sleeps = []
+        flexmock(time).should_receive('sleep').replace_with(sleeps.append)
+        coordinator.set_build('os-build-id')
+        coordinator.requested = time.time()
+
+        assert coordinator.cancel()
+
+        assert cancelled == ['os-build-id'] * 3
+        assert sleeps == [0.5, 1.0]
+        assert coordinator.latency is not None
+        assert coordinator.message() == 'Task cancelled, OSBS build os-build-id cancelled'
+
+    def test_cancel_gives_up(self):
+        coordinator, cancelled = self._coordinator(failures=100, timeout=0)
+        coordinator.set_build('os-build-id')
+        coordinator.requested = time.time()
+
+        assert not coordinator.cancel()
+
+        assert cancelled == ['os-build-id']
+        assert coordinator.latency is None
+        assert 'failed to cancel' in coordinator.message()
+
+    def test_thread_cancels_build(self):
+        coordinator, cancelled = self._coordinator()
+        coordinator.install()
+        try:
+            # build is being created, it's cancelled once it exists
+            coordinator._handle_signal(signal.SIGINT, None)
+            time.sleep(0.3)
+            assert cancelled == []
+            coordinator.set_build('os-build-id')
+        finally:
+            coordinator.uninstall()
+        assert cancelled == ['os-build-id']
+
+    def test_nothing_cancelled_without_request(self):
+        coordinator, cancelled = self._coordinator()
+        coordinator.install()
+        coordinator.set_build('os-build-id')
+        coordinator.uninstall()
+        assert cancelled == []
+        coordinator.check()
+
+    def test_stop_kills_child(self):
+        coordinator, cancelled = self._coordinator()
+        child = subprocess.Popen(['sleep', '60'])
+        coordinator.child_pid = child.pid
+
+        coordinator.stop()
+
+        assert child.wait() == -signal.SIGKILL
+
+    def test_install(self):
+        coordinator, cancelled = self._coordinator()
+        previous = signal.getsignal(signal.SIGINT)
+        coordinator.install()
+        try:
+            assert signal.getsignal(signal.SIGINT) == coordinator._handle_signal
+            assert signal.getsignal(signal.SIGTERM) == coordinator._handle_signal
+        finally:
+            coordinator.uninstall()
+        assert signal.getsignal(signal.SIGINT) == previous
+
+    def test_cancel_while_build_runs(self, tmpdir):
+        task = container_task(tmpdir)
+        build_response = flexmock(get_build_name=lambda: 'os-build-id')
+        task._osbs.should_receive('create_orchestrator_build').and_return(build_response)
+        task._osbs.should_receive('wait_for_build_to_get_scheduled')
+        # tails saved by the log reader before the task got cancelled
+        (flexmock(task)
+            .should_receive('_stream_logs_to_hub')
+            .replace_with(lambda build_id: task._write_log_tails(
+                task.resultdir(), {'x86_64': ['STEP 3: RUN make']})))
+        tail_path = os.path.join(str(tmpdir), 'failure-tail.log')
+        flexmock(task).should_receive('uploadFile').with_args(tail_path).once()
+
+        build_cancelled = threading.Event()
+        cancel_calls = []
+
+        def cancel_build(build_id):
+            # cancelled out of the signal handler
+            assert threading.current_thread().name == 'osbs-cancel'
+            cancel_calls.append(build_id)
+            build_cancelled.set()
+
+        def wait_for_build_to_finish(build_id):
+            os.kill(os.getpid(), signal.SIGINT)
+            build_cancelled.wait(5)
+            return flexmock(status='cancelled', json={}, is_cancelled=lambda: True,
+                            is_failed=lambda: True, is_succeeded=lambda: False)
+
+        (task._osbs.should_receive('wait_for_build_to_finish')
+            .replace_with(wait_for_build_to_finish))
+        # the thread has its own client, the task's one is busy waiting
+        task._osbs.should_receive('cancel_build').never()
+        cancel_osbs = flexmock()
+        cancel_osbs.should_receive('cancel_build').replace_with(cancel_build)
+        flexmock(task).should_receive('_create_osbs').and_return(cancel_osbs).once()
+        # the task was cancelled in koji already
+        task.session.should_receive('cancelTask').never()
+        previous = signal.getsignal(signal.SIGINT)
+
+        with pytest.raises(builder_containerbuild.ContainerCancelled) as exc:
+            create_container(task)
+
+        assert str(exc.value) == ('Task cancelled, OSBS build os-build-id cancelled\n'
+                                  'Last lines of x86_64.log:\nSTEP 3: RUN make')
+        with open(tail_path) as f:
+            assert f.read().startswith('Task cancelled, OSBS build os-build-id cancelled\n')
+        assert cancel_calls == ['os-build-id']
+        assert task._cancelled()
+        assert signal.getsignal(signal.SIGINT) == previous
+
+    def test_cancel_interrupts_creation(self, tmpdir):
+        task = container_task(tmpdir)
+
+        def create_orchestrator_build(**kwargs):
+            task._canceller._handle_signal(signal.SIGINT, None)
+            raise IOError(4, 'Interrupted system call')
+
+        (task._osbs.should_receive('create_orchestrator_build')
+            .replace_with(create_orchestrator_build))
+        running = flexmock(get_build_name=lambda: 'os-build-id',
+                           is_running=lambda: False, is_pending=lambda: True)
+        task._osbs.should_receive('list_builds').with_args(koji_task_id=1).and_return([running])
+        cancel_osbs = flexmock()
+        cancel_osbs.should_receive('cancel_build').with_args('os-build-id').once()
+        flexmock(task).should_receive('_create_osbs').and_return(cancel_osbs)
+        task._osbs.should_receive('wait_for_build_to_get_scheduled').never()
+
+        with pytest.raises(builder_containerbuild.ContainerCancelled):
+            create_container(task)
+
+
+class TestRetryPolicy(object):
+    @pytest.mark.parametrize(('error', 'retryable'), (
+        (OsbsResponseException('Internal Server Error', status_code=500), True),
+        (OsbsResponseException('etcdserver: request timed out', status_code=400), True),
+        (OsbsResponseException('pods "x" is forbidden: exceeded quota: compute',
+                               status_code=403), True),
+        (OsbsResponseException('Forbidden', status_code=403), False),
+        (IOError(104, 'Connection reset by peer'), True),
+        (OsbsValidationException('unknown platform'), False),
+        (builder_containerbuild.ContainerCancelled('timed out'), False),
+    ))
+    def test_retryable_error(self, error, retryable):
+        assert builder_containerbuild.retryable_error(error) == retryable
+
+    def _policy(self, budget=3):
+        return builder_containerbuild.RetryPolicy(budget, delay=10, max_delay=30,
+                                                  logger=logging.getLogger('koji.build'))
+
+    def _failing(self, errors, result='ok'):
+        calls = []
+
+        def func():
+            calls.append(len(calls))
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return result
+        return func, calls
+
+    def test_retries_with_backoff(self):
+        policy = self._policy()
+        sleeps = []
+        flexmock(time).should_receive('sleep').replace_with(sleeps.append)
+        flexmock(builder_containerbuild.random).should_receive('uniform').replace_with(
+            lambda low, high: high)
+        error = OsbsResponseException('Service Unavailable', status_code=503)
+        func, calls = self._failing([error] * 3)
+
+        assert policy.call('Creating OSBS build', func) == 'ok'
+        assert sleeps == [10, 20, 30]
+        assert policy.retries == 3
+
+    def test_budget_is_shared(self):
+        policy = self._policy(budget=2)
+        flexmock(time).should_receive('sleep')
+        error = OsbsResponseException('Bad Gateway', status_code=502)
+        func, calls = self._failing([error])
+        assert policy.call('first', func) == 'ok'
+        func, calls = self._failing([error] * 2)
+        with pytest.raises(OsbsResponseException):
+            policy.call('second', func)
+        assert len(calls) == 2
+
+    def test_permanent_error(self):
+        policy = self._policy()
+        func, calls = self._failing([OsbsValidationException('invalid')])
+        with pytest.raises(OsbsValidationException):
+            policy.call('Creating OSBS build', func)
+        assert calls == [0]
+
+    def test_stop(self):
+        policy = self._policy()
+        flexmock(time).should_receive('sleep')
+        func, calls = self._failing([IOError('timed out')] * 2)
+        stopped = []
+        with pytest.raises(IOError):
+            policy.call('Creating OSBS build', func, stop=lambda: stopped.append(1) or
+                        len(stopped) > 1)
+        assert calls == [0]
+
+    def test_create_container_retries(self, tmpdir):
+        task = container_task(tmpdir, submit_retry_delay=0)
+        calls = []
+
+        def fail_once(error, result=None):
+            def func(*args, **kwargs):
+                calls.append(error)
+                if calls.count(error) == 1:
+                    raise error
+                return result
+            return func
+
+        (task._osbs.should_receive('create_orchestrator_build')
+            .replace_with(fail_once(
+                OsbsResponseException('Internal Server Error', status_code=500),
+                flexmock(get_build_name=lambda: 'os-build-id'))))
+        # the build isn't there after the failed request
+        task._osbs.should_receive('list_builds').with_args(koji_task_id=1).and_return([])
+        (task._osbs.should_receive('wait_for_build_to_get_scheduled')
+            .replace_with(fail_once(
+                OsbsResponseException('etcdserver: request timed out', status_code=400))))
+        flexmock(task).should_receive('_stream_logs_to_hub')
+        response = flexmock(status='failed', json={}, is_cancelled=lambda: False,
+                            is_failed=lambda: True, is_succeeded=lambda: False)
+        task._osbs.should_receive('wait_for_build_to_finish').and_return(response)
+        flexmock(task).should_receive('_get_error_message').and_return(None)
+        flexmock(task).should_receive('_failure_tail').and_return(None)
+
+        with pytest.raises(builder_containerbuild.ContainerError) as exc:
+            create_container(task)
+        assert 'OSBS build id: os-build-id' in str(exc.value)
+        assert len(calls) == 4
+
+    def test_create_container_dedups_builds(self, tmpdir):
+        task = container_task(tmpdir, submit_retry_delay=0)
+        (task._osbs.should_receive('create_orchestrator_build')
+            .and_raise(IOError(104, 'Connection reset by peer'))
+            .once())
+        running = flexmock(get_build_name=lambda: 'os-build-id',
+                           is_running=lambda: True, is_pending=lambda: False)
+        task._osbs.should_receive('list_builds').with_args(koji_task_id=1).and_return([running])
+        task._osbs.should_receive('wait_for_build_to_get_scheduled').with_args('os-build-id')
+        flexmock(task).should_receive('_stream_logs_to_hub')
+        response = flexmock(status='succeeded', json={}, is_cancelled=lambda: False,
+                            is_failed=lambda: False, is_succeeded=lambda: True)
+        task._osbs.should_receive('wait_for_build_to_finish').and_return(response)
+        flexmock(task).should_receive('_get_repositories').and_return(['repo'])
+        flexmock(task).should_receive('_get_koji_build_id').and_return(10)
+
+        result = create_container(task)
+
+        assert result['osbs_build_id'] == 'os-build-id'
+        assert result['koji_build_id'] == 10
+
+
+class TestProgressReport(object):
+    def _worker_builds(self, **platforms):
+        workers = dict((platform, {'digests': [{'registry': 'registry.example.com',
+                                                 'repository': 'fedora-docker',
+                                                 'tag': tag, 'digest': 'sha256:1'}]})
+                       for platform, tag in platforms.items())
+        return {'metadata': {'annotations': {'worker-builds': json.dumps(workers)}}}
+
+    def test_progress(self):
+        progress = builder_containerbuild.ProgressReport('os-build-id',
+                                                         ['x86_64', 'ppc64le'])
+        progress.logs_seen(['orchestrator.log', 'x86_64.log', 'osbs-client.log'])
+        assert progress.data['platforms'] == {
+            'x86_64': {'state': 'building', 'repositories': []},
+            'ppc64le': {'state': 'pending', 'repositories': []}}
+
+        progress.update_build(flexmock(status='running',
+                                       json=self._worker_builds(x86_64='1.0-1-x86_64')))
+        assert progress.data['state'] == 'running'
+        assert progress.data['platforms']['x86_64'] == {
+            'state': 'succeeded',
+            'repositories': ['registry.example.com/fedora-docker:1.0-1-x86_64']}
+
+        progress.finish('failed')
+        assert progress.data['platforms']['x86_64']['state'] == 'succeeded'
+        assert progress.data['platforms']['ppc64le']['state'] == 'failed'
+        assert json.loads(progress.content())['state'] == 'failed'
+
+    def test_corrupted_annotation(self):
+        progress = builder_containerbuild.ProgressReport('os-build-id', ['x86_64'])
+        progress.update_build(flexmock(status='running', json={
+            'metadata': {'annotations': {'worker-builds': '{'}}}))
+        assert progress.data['platforms']['x86_64']['state'] == 'pending'
+
+    def test_published_during_build(self, tmpdir):
+        task = container_task(tmpdir, progress_interval=1000)
+        build_response = flexmock(get_build_name=lambda: 'os-build-id')
+        task._osbs.should_receive('create_orchestrator_build').and_return(build_response)
+        task._osbs.should_receive('wait_for_build_to_get_scheduled')
+        (task._osbs.should_receive('get_build')
+            .with_args('os-build-id')
+            .and_return(flexmock(status='pending', json={}))
+            .once())
+        (flexmock(task)
+            .should_receive('_stream_logs_to_hub')
+            .replace_with(lambda build_id: task._publish_progress(['x86_64.log'])))
+        response = flexmock(status='complete', json=self._worker_builds(x86_64='latest'),
+                            is_cancelled=lambda: False, is_failed=lambda: False,
+                            is_succeeded=lambda: True)
+        task._osbs.should_receive('wait_for_build_to_finish').and_return(response)
+        flexmock(task).should_receive('_get_repositories').and_return(['repo'])
+        flexmock(task).should_receive('_get_koji_build_id').and_return(10)
+        uploads = []
+
+        def upload(session, fname, fd, uploadpath, logger=None):
+            assert fd.tell() == 0
+            uploads.append((fname, json.loads(fd.read())))
+
+        flexmock(builder_containerbuild).should_receive('incremental_upload').replace_with(upload)
+
+        create_container(task)
+
+        assert [fname for fname, progress in uploads] == ['progress.json'] * 4
+        assert [(progress['state'], progress['platforms']['x86_64']['state'])
+                for fname, progress in uploads] == [('pending', 'pending'),
+                                                    ('running', 'pending'),
+                                                    ('running', 'building'),
+                                                    ('succeeded', 'succeeded')]
+        assert uploads[-1][1] == {
+            'osbs_build_id': 'os-build-id', 'state': 'succeeded',
+            'repositories': ['repo'], 'koji_build_id': 10,
+            'platforms': {'x86_64': {
+                'state': 'succeeded',
+                'repositories': ['registry.example.com/fedora-docker:latest']}}}
+
+    @pytest.mark.parametrize('cancelled', (False, True))
+    def test_final_state_when_aborted(self, tmpdir, cancelled):
+        task = container_task(tmpdir, progress_interval=1000)
+        build_response = flexmock(get_build_name=lambda: 'os-build-id')
+        task._osbs.should_receive('create_orchestrator_build').and_return(build_response)
+        task._osbs.should_receive('get_build').and_return(flexmock(status='pending',
+                                                                   json={}))
+        flexmock(task).should_receive('_create_osbs').and_return(
+            flexmock(cancel_build=lambda build_id: None))
+
+        def wait_for_build_to_get_scheduled(build_id):
+            if cancelled:
+                task._canceller._handle_signal(signal.SIGINT, None)
+            raise OsbsValidationException('build failed to get scheduled')
+
+        (task._osbs.should_receive('wait_for_build_to_get_scheduled')
+            .replace_with(wait_for_build_to_get_scheduled))
+        uploads = []
+
+        def upload(session, fname, fd, uploadpath, logger=None):
+            uploads.append(json.loads(fd.read()))
+            if len(uploads) > 1:
+                # failed upload doesn't replace the error of the task
+                raise IOError('hub unavailable')
+
+        flexmock(builder_containerbuild).should_receive('incremental_upload').replace_with(upload)
+        expected = (builder_containerbuild.ContainerCancelled if cancelled
+                    else OsbsValidationException)
+
+        with pytest.raises(expected):
+            create_container(task)
+
+        state = 'cancelled' if cancelled else 'failed'
+        assert uploads[-1]['state'] == state
+        assert uploads[-1]['platforms'] == {'x86_64': {'state': state,
+                                                       'repositories': []}}
+
+    def test_disabled(self, tmpdir):
+        task = container_task(tmpdir, progress_interval=0)
+        build_response = flexmock(get_build_name=lambda: 'os-build-id')
+        task._osbs.should_receive('create_orchestrator_build').and_return(build_response)
+        task._osbs.should_receive('wait_for_build_to_get_scheduled')
+        task._osbs.should_receive('get_build').never()
+        flexmock(task).should_receive('_stream_logs_to_hub')
+        response = flexmock(status='complete', json={}, is_cancelled=lambda: False,
+                            is_failed=lambda: False, is_succeeded=lambda: True)
+        task._osbs.should_receive('wait_for_build_to_finish').and_return(response)
+        flexmock(task).should_receive('_get_repositories').and_return(['repo'])
+        (flexmock(builder_containerbuild)
+            .should_receive('incremental_upload')
+            .never())
+
+        assert create_container(task)['repositories'] == ['repo']
+
+
+class BatchSession(MulticallSession):
+    """Hub with multicall, tasks finish on the second check of their state"""
+
+    def __init__(self, targets, states=None):
+        super(BatchSession, self).__init__()
+        self.targets = targets
+        self.states = states or {}
+        self.submitted = []
+        self.checks = {}
+
+    def getBuildTarget(self, name):
+        self.calls.append(('getBuildTarget', name))
+        if name in self.targets:
+            return {'dest_tag': name, 'dest_tag_name': name}
+        return None
+
+    def getTag(self, name):
+        self.calls.append(('getTag', name))
+        return {'name': name, 'locked': self.targets[name]}
+
+    def logout(self):
+        pass
+
+    def buildContainer(self, *args, **kwargs):
+        return self._call(self._build_container, *args, **kwargs)
+
+    def _build_container(self, source, target, opts, priority=None, channel=None):
+        if 'broken' in source:
+            raise koji.GenericError('broken source')
+        self.submitted.append((source, target, opts))
+        return len(self.submitted)
+
+    def _get_task_info(self, task_id):
+        self.checks[task_id] = self.checks.get(task_id, 0) + 1
+        if self.checks[task_id] < 2:
+            return {'state': koji.TASK_STATES['OPEN'], 'create_ts': time.time()}
+        return {'state': koji.TASK_STATES[self.states.get(task_id, 'CLOSED')],
+                'create_ts': time.time()}
+
+    def _get_task_result(self, task_id):
+        if self.checks[task_id] < 2:
+            raise koji.GenericError('task %s is not finished' % task_id)
+        if self.states.get(task_id, 'CLOSED') != 'CLOSED':
+            raise koji.GenericError('task %s failed' % task_id)
+        return {'repositories': ['repo-%s' % task_id], 'koji_builds': [task_id * 10]}
+
+
+class TestBatch(object):
+    def _write_manifest(self, tmpdir, builds, name='manifest.json'):
+        path = str(tmpdir.join(name))
+        with open(path, 'w') as f:
+            json.dump(builds, f)
+        return path
+
+    def _build(self, target='target', source='git://example.com/repo#HEAD', **kwargs):
+        return dict(target=target, source=source, git_branch='master', **kwargs)
+
+    @pytest.mark.parametrize(('build', 'error'), (
+        ({'target': 'target'}, 'missing source, git_branch'),
+        (dict(foo=1), 'unknown keys: foo'),
+        (dict(arch_override='x86_64'), 'only allowed for scratch'),
+        (dict(scratch=True, isolated=True), 'both isolated and scratch'),
+        (dict(source='git://example.com/repo'), 'must be of the form'),
+    ))
+    def test_load_batch_invalid(self, tmpdir, build, error):
+        if 'target' not in build:
+            build = self._build(**build)
+        with pytest.raises(ValueError) as exc:
+            cli.load_batch(self._write_manifest(tmpdir, [build]))
+        assert error in str(exc.value)
+
+    def test_load_batch_yaml(self, tmpdir):
+        pytest.importorskip('yaml')
+        path = str(tmpdir.join('manifest.yaml'))
+        with open(path, 'w') as f:
+            f.write('- target: target\n'
+                    '  source: git://example.com/repo#HEAD\n'
+                    '  git_branch: master\n')
+        assert cli.load_batch(path) == [dict(self._build(), name='1')]
+
+    def test_check_batch_targets(self):
+        session = BatchSession({'target': False, 'locked': True})
+        builds = [dict(self._build(), name='a'), dict(self._build(), name='b'),
+                  dict(self._build('locked'), name='c'),
+                  dict(self._build('locked', scratch=True), name='d'),
+                  dict(self._build('missing'), name='e')]
+
+        errors = cli.check_batch_targets(session, builds)
+
+        assert errors == {'c': 'Destination tag locked is locked',
+                          'e': 'Unknown build target: missing'}
+        # each target is looked up once
+        assert session.calls == [('getBuildTarget', 'target'), ('getTag', 'target'),
+                                 ('getBuildTarget', 'locked'), ('getTag', 'locked'),
+                                 ('getBuildTarget', 'missing')]
+
+    def test_submit_batch(self):
+        session = BatchSession({})
+        builds = [dict(self._build(source='git://example.com/%s#HEAD' % i), name=str(i))
+                  for i in range(5)]
+        builds[3]['source'] = 'git://example.com/broken#HEAD'
+        builds[4].update(scratch=True, arch_override='x86_64,ppc64le')
+
+        submitted = cli.submit_batch(session, builds, batch_size=2)
+
+        assert submitted == [(1, None), (2, None), (3, None), (None, 'broken source'),
+                             (4, None)]
+        assert session.calls == [('multiCall', 2), ('multiCall', 2), ('multiCall', 1)]
+        assert session.submitted[3][2] == {'git_branch': 'master', 'scratch': True,
+                                           'arch_override': 'x86_64 ppc64le'}
+
+    def test_watch_batch(self):
+        session = BatchSession({}, states={2: 'FAILED'})
+        out = StringIO()
+
+        watcher = cli.watch_batch(session, [('a', 1), ('b', 2)], poll_interval=0,
+                                  out=out, live=False)
+
+        assert (watcher.state(1), watcher.state(2)) == ('CLOSED', 'FAILED')
+        assert out.getvalue().splitlines() == ['a (1): OPEN', 'b (2): OPEN',
+                                               'a (1): CLOSED', 'b (2): FAILED: task 2 failed']
+        # one hub call per round, states of all tasks in one call, results
+        # come with the final states
+        assert session.calls == [('multiCall', 1), ('multiCall', 3)]
+        assert watcher.result(1) == {'repositories': ['repo-1'], 'koji_builds': [10]}
+        assert watcher.error(2) == 'task 2 failed'
+
+    def test_batch_command(self, tmpdir, capsys):
+        session = BatchSession({'target': False, 'locked': True}, states={2: 'FAILED'})
+        manifest = self._write_manifest(tmpdir, [
+            dict(self._build(), name='ok'),
+            dict(self._build(), name='fails'),
+            dict(self._build('locked'), name='locked'),
+            dict(self._build(source='git://example.com/broken#HEAD'), name='broken'),
+        ])
+        summary_path = str(tmpdir.join('summary.json'))
+        flexmock(cli).should_receive('activate_session')
+        options = flexmock(quiet=False)
+
+        rv = cli.handle_container_build_batch(
+            options, session, ['--poll-interval', '0', '--summary', summary_path,
+                               manifest])
+
+        assert rv == 1
+        with open(summary_path) as f:
+            summary = json.load(f)
+        assert [(entry['name'], entry['task_id'], entry['state'], entry['exit_code'])
+                for entry in summary] == [('ok', 1, 'CLOSED', 0),
+                                          ('fails', 2, 'FAILED', 1),
+                                          ('locked', None, 'invalid', 3),
+                                          ('broken', None, 'submit_failed', 4)]
+        assert summary[0]['repositories'] == ['repo-1']
+        assert summary[0]['koji_builds'] == [10]
+        assert summary[1]['error'] == 'task 2 failed'
+        out = capsys.readouterr()[0]
+        assert 'locked: Destination tag locked is locked' in out
+
+
+class TestOutputFormats(object):
+    def _build_args(self, *args):
+        return ['target', 'git://example.com/repo#HEAD', '--git-branch', 'master'] + \
+            list(args)
+
+    def _events(self, out):
+        return [json.loads(line) for line in out.splitlines()]
+
+    def test_jsonl(self, capsys):
+        session = BatchSession({'target': False})
+        flexmock(cli).should_receive('activate_session')
+        flexmock(time).should_receive('sleep')
+        options = flexmock(quiet=False, weburl='http://koji')
+
+        rv = cli.handle_build(options, session,
+                              self._build_args('--wait', '--output', 'jsonl'), False)
+
+        assert rv == 0
+        events = self._events(capsys.readouterr()[0])
+        assert [(event['event'], event.get('state')) for event in events] == [
+            ('created', None), ('state', 'OPEN'), ('state', 'CLOSED'),
+            ('result', 'CLOSED')]
+        assert events[0]['url'] == 'http://koji/taskinfo?taskID=1'
+        assert events[-1]['result'] == {'repositories': ['repo-1'],
+                                        'koji_builds': ['http://koji/buildinfo?buildID=10']}
+
+    @pytest.mark.parametrize('uploaded', (True, False))
+    def test_json_failed(self, capsys, uploaded):
+        session = BatchSession({'target': False}, states={1: 'FAILED'})
+        outputs = ['osbs-client.log']
+        if uploaded:
+            outputs.append('failure-tail.log')
+        session.listTaskOutput = lambda task_id: outputs
+        flexmock(cli).should_receive('activate_session')
+        flexmock(time).should_receive('sleep')
+        options = flexmock(quiet=False, weburl='http://koji')
+
+        rv = cli.handle_build(options, session,
+                              self._build_args('--wait', '--output', 'json'), False)
+
+        assert rv == 1
+        final = json.loads(capsys.readouterr()[0])
+        expected = {
+            'task_id': 1, 'url': 'http://koji/taskinfo?taskID=1', 'state': 'FAILED',
+            'error': 'task 1 failed'}
+        if uploaded:
+            expected['failure_summary'] = \
+                'http://koji/getfile?taskID=1&name=failure-tail.log'
+        assert final == expected
+
+    @pytest.mark.parametrize('uploaded', (True, False))
+    def test_text_failed(self, capsys, uploaded):
+        session = BatchSession({'target': False}, states={1: 'FAILED'})
+        session.listTaskOutput = lambda task_id: ['failure-tail.log'] if uploaded else []
+        flexmock(cli).should_receive('activate_session')
+        flexmock(time).should_receive('sleep')
+        options = flexmock(quiet=False, weburl='http://koji')
+
+        assert cli.handle_build(options, session, self._build_args('--wait'), False) == 1
+        lines = capsys.readouterr()[0].splitlines()
+        assert '1: FAILED: task 1 failed' in lines
+        summary = 'Failure summary: http://koji/getfile?taskID=1&name=failure-tail.log'
+        assert (summary in lines) == uploaded
+
+    def test_json_nowait(self, capsys):
+        session = BatchSession({'target': False})
+        flexmock(cli).should_receive('activate_session')
+        options = flexmock(quiet=False, weburl='http://koji')
+
+        cli.handle_build(options, session,
+                         self._build_args('--nowait', '--output', 'json'), False)
+
+        assert json.loads(capsys.readouterr()[0]) == {
+            'task_id': 1, 'url': 'http://koji/taskinfo?taskID=1'}
+
+    def test_batch_jsonl(self, tmpdir, capsys):
+        session = BatchSession({'target': False}, states={2: 'FAILED'})
+        manifest = str(tmpdir.join('manifest.json'))
+        with open(manifest, 'w') as f:
+            json.dump([{'name': name, 'target': target, 'git_branch': 'master',
+                        'source': 'git://example.com/repo#HEAD'}
+                       for name, target in (('a', 'target'), ('b', 'target'),
+                                            ('c', 'missing'))], f)
+        flexmock(cli).should_receive('activate_session')
+        options = flexmock(quiet=False, weburl='http://koji')
+
+        rv = cli.handle_container_build_batch(
+            options, session, ['--poll-interval', '0', '--output', 'jsonl', manifest])
+
+        assert rv == 1
+        events = self._events(capsys.readouterr()[0])
+        assert [(event['event'], event.get('name'), event.get('state'))
+                for event in events] == [
+            ('created', 'a', None), ('created', 'b', None), ('invalid', 'c', None),
+            ('state', 'a', 'OPEN'), ('state', 'b', 'OPEN'),
+            ('state', 'a', 'CLOSED'), ('state', 'b', 'FAILED'),
+            ('result', 'a', 'CLOSED'), ('result', 'b', 'FAILED')]
+        assert events[2]['error'] == 'Unknown build target: missing'
+        assert events[-2]['result']['repositories'] == ['repo-1']
+        assert events[-1]['error'] == 'task 2 failed'
+
+    def test_batch_json(self, tmpdir, capsys):
+        session = BatchSession({'target': False})
+        manifest = str(tmpdir.join('manifest.json'))
+        with open(manifest, 'w') as f:
+            json.dump([{'target': 'target', 'git_branch': 'master',
+                        'source': 'git://example.com/repo#HEAD'}], f)
+        flexmock(cli).should_receive('activate_session')
+        options = flexmock(quiet=False, weburl='http://koji')
+
+        rv = cli.handle_container_build_batch(
+            options, session, ['--poll-interval', '0', '--output', 'json', manifest])
+
+        assert rv == 0
+        summary = json.loads(capsys.readouterr()[0])
+        assert [(entry['name'], entry['state']) for entry in summary] == [('1', 'CLOSED')]
+
+    def test_batch_jsonl_with_summary_on_stdout(self, tmpdir):
+        flexmock(cli).should_receive('activate_session').never()
+        with pytest.raises(SystemExit):
+            cli.handle_container_build_batch(
+                flexmock(quiet=False), BatchSession({}),
+                ['--output', 'jsonl', '--summary', '-', str(tmpdir.join('manifest.json'))])
+
+    def test_follow_logs_with_json(self):
+        options = flexmock(quiet=False)
+        with pytest.raises(SystemExit):
+            parse_arguments(options, self._build_args('--follow-logs', '--output',
+                                                      'json'), False)
+
+
+class TestTaskWatcher(object):
+    @pytest.mark.parametrize(('ages', 'interval'), (
+        ([], 2),
+        ([5], 2),
+        ([100], 10),
+        ([100, 30], 3),
+        ([5000], 60),
+    ))
+    def test_interval_backs_off(self, ages, interval):
+        watcher = cli.TaskWatcher(flexmock(), min_interval=2, max_interval=60,
+                                  backoff=0.1)
+        flexmock(time).should_receive('time').and_return(10000.0)
+        for task_id, age in enumerate(ages):
+            watcher.add(task_id)
+            watcher.tasks[task_id].update(state='OPEN', create_ts=10000.0 - age)
+        assert watcher.interval() == pytest.approx(interval)
+
+    def test_finished_task_without_result(self):
+        session = BatchSession({})
+        watcher = cli.TaskWatcher(session, min_interval=5)
+        watcher.add(1)
+        # task closes before it's seen open, result wasn't asked for yet
+        session.checks[1] = 1
+        assert watcher.poll() == [1]
+        assert watcher.unfinished() == []
+        assert watcher.result(1)['koji_builds'] == [10]
+        # the result is asked for right away, in the same round
+        assert session.calls == [('multiCall', 1), ('multiCall', 1)]
+
+    def test_states_since_previous_round(self):
+        session = BatchSession({})
+        flexmock(session).should_receive('getContainerTaskStates').replace_with(
+            lambda task_ids, since: session.states_calls.append(since) or
+            session._call(session._get_container_task_states, task_ids, since))
+        session.states_calls = []
+        watcher = cli.TaskWatcher(session)
+        watcher.add(1)
+        assert watcher.poll() == [1]
+        watcher.add(2)
+        assert watcher.poll() == [1, 2]
+        assert watcher.poll() == [2]
+        # all states for new tasks, then only changes
+        assert session.states_calls[0] is None
+        assert session.states_calls[1] is None
+        assert session.states_calls[2] is not None
+
+    def test_hub_without_task_states(self):
+        session = BatchSession({})
+        flexmock(session).should_receive('_get_container_task_states').and_raise(
+            koji.GenericError('Invalid method: getContainerTaskStates'))
+        watcher = cli.TaskWatcher(session)
+        watcher.add(1)
+        watcher.add(2)
+        assert watcher.poll() == [1, 2]
+        assert not watcher.task_states
+        assert watcher.poll() == [1, 2]
+        assert watcher.unfinished() == []
+        # info of each task from then on
+        assert session.calls == [('multiCall', 1), ('multiCall', 2), ('multiCall', 4)]
+
+    def test_unknown_task(self):
+        session = BatchSession({})
+        flexmock(session).should_receive('_get_container_task_states').and_return(
+            {'ts': 1000.0, 'tasks': []})
+        watcher = cli.TaskWatcher(session)
+        watcher.add(1)
+        with pytest.raises(koji.GenericError):
+            watcher.poll()
+
+
+class OutputSession(object):
+    """Hub with task output which grows between polls"""
+
+    def __init__(self):
+        self.files = {}
+        self.downloads = []
+
+    def listTaskOutput(self, task_id, stat=False):
+        return dict((fname, {'st_size': str(len(content))})
+                    for fname, content in self.files.items())
+
+    def downloadTaskOutput(self, task_id, fname, offset=0, size=-1):
+        self.downloads.append((fname, offset, size))
+        return base64.b64encode(self.files[fname][offset:offset + size])
+
+
+class TestLogFollower(object):
+    def test_follow(self):
+        session = OutputSession()
+        out = StringIO()
+        follower = cli.LogFollower(session, 1, out=out, chunk_size=8)
+
+        session.files = {'orchestrator.log': 'start\n', 'x86_64.log': 'line 1\nline',
+                         'osbs-client.log': 'debug\n', 'x86_64.idx.json': '{}'}
+        follower.poll()
+        assert out.getvalue() == '[orchestrator] start\n[x86_64] line 1\n'
+
+        session.files['x86_64.log'] += ' 2\nline 3'
+        session.downloads = []
+        follower.poll()
+        assert out.getvalue().splitlines()[2:] == ['[x86_64] line 2']
+        # only new bytes are fetched, in chunks
+        assert session.downloads == [('x86_64.log', 11, 8), ('x86_64.log', 19, 1)]
+
+        follower.poll(final=True)
+        assert out.getvalue().splitlines()[3:] == ['[x86_64] line 3']
+
+    def test_long_line_is_not_kept(self):
+        session = OutputSession()
+        out = StringIO()
+        follower = cli.LogFollower(session, 1, out=out, chunk_size=4)
+        session.files = {'x86_64.log': 'x' * 10}
+        follower.poll()
+        # split rather than kept in memory until its end comes
+        assert out.getvalue() == '[x86_64] xxxx\n[x86_64] xxxx\n'
+        assert follower._partial['x86_64.log'] == 'xx'
+
+    def test_compressed(self, tmpdir):
+        path = str(tmpdir.join('x86_64.log.gz'))
+        gz = gzip.GzipFile(path, 'wb')
+        gz.write('line 1\nline 2\n')
+        gz.flush()
+        with open(path, 'rb') as f:
+            flushed = f.read()
+        gz.write('line 3\n')
+        gz.close()
+        with open(path, 'rb') as f:
+            complete = f.read()
+
+        session = OutputSession()
+        out = StringIO()
+        follower = cli.LogFollower(session, 1, out=out, chunk_size=5)
+        session.files = {'x86_64.log.gz': flushed}
+        follower.poll()
+        assert out.getvalue() == '[x86_64] line 1\n[x86_64] line 2\n'
+        session.files = {'x86_64.log.gz': complete}
+        follower.poll(final=True)
+        assert out.getvalue().splitlines()[2:] == ['[x86_64] line 3']
+
+    def test_compressed_log_rewritten(self, tmpdir):
+        def compressed(text):
+            path = str(tmpdir.join('x86_64.log.gz'))
+            gz = gzip.GzipFile(path, 'wb')
+            gz.write(text)
+            gz.close()
+            with open(path, 'rb') as f:
+                return f.read()
+
+        session = OutputSession()
+        out = StringIO()
+        follower = cli.LogFollower(session, 1, out=out)
+        session.files = {'x86_64.log.gz': compressed('line 1\n' * 50 + 'line')}
+        follower.poll()
+        assert len(out.getvalue().splitlines()) == 50
+        # compressed again from the beginning into fewer bytes
+        session.files = {'x86_64.log.gz': compressed('new 1\n')}
+        session.downloads = []
+        follower.poll(final=True)
+        assert out.getvalue().splitlines()[50:] == ['[x86_64] new 1']
+        assert session.downloads[0][1] == 0
+
+    @pytest.mark.parametrize('finished', (False, True))
+    def test_compressed_log_rewritten_past_offset(self, tmpdir, finished):
+        path = str(tmpdir.join('x86_64.log.gz'))
+        gz = gzip.GzipFile(path, 'wb')
+        gz.write('old 1\n')
+        if finished:
+            gz.close()
+        else:
+            gz.flush()
+        with open(path, 'rb') as f:
+            old = f.read()
+        gz = gzip.GzipFile(path, 'wb', compresslevel=1)
+        gz.write(''.join('new %d\n' % i for i in range(1, 200)))
+        gz.close()
+        with open(path, 'rb') as f:
+            new = f.read()
+        assert len(new) > len(old)
+
+        session = OutputSession()
+        out = StringIO()
+        follower = cli.LogFollower(session, 1, out=out)
+        session.files = {'x86_64.log.gz': old}
+        follower.poll()
+        assert out.getvalue() == '[x86_64] old 1\n'
+        # compressed again and uploaded past the old offset between polls
+        session.files = {'x86_64.log.gz': new}
+        follower.poll(final=True)
+        assert out.getvalue().splitlines()[1:] == [
+            '[x86_64] new %d' % i for i in range(1, 200)]
+
+    def test_follow_logs_restrictions(self):
+        options = flexmock(quiet=False)
+        args = ['target', 'git://example.com/repo#HEAD', '--git-branch', 'master']
+        build_opts = parse_arguments(options, args + ['--follow-logs'], False)[0]
+        assert build_opts.wait
+        with pytest.raises(SystemExit):
+            parse_arguments(options, args + ['--follow-logs', '--nowait'], False)
+
+
+def _not_available(*args, **kwargs):
+    raise AssertionError('unexpected call of kojihub')
+
+
+def import_hub_plugin():
+    """Returns hub_containerbuild, kojihub is replaced by a stub module"""
+    if 'kojihub' not in sys.modules:
+        kojihub = imp.new_module('kojihub')
+        for name in ('Host', 'Task', 'get_upload_path', 'make_task', 'get_user',
+                     '_singleValue', '_dml', 'InsertProcessor', 'QueryProcessor'):
+            setattr(kojihub, name, _not_available)
+        sys.modules['kojihub'] = kojihub
+    from koji_containerbuild.plugins import hub_containerbuild
+    return hub_containerbuild
+
+
+class TestHubTruncateUpload(object):
+    def _upload(self, tmpdir, hub, task_id=1234, owner=True):
+        path = 'tasks/%d/%d' % (task_id % 10000, task_id)
+        fn = os.path.join(str(tmpdir), 'x86_64.log')
+        with open(fn, 'w') as f:
+            f.write('0123456789')
+        host = flexmock(id=5)
+        host.should_receive('verify')
+        flexmock(hub.kojihub).should_receive('Host').and_return(host)
+        task = flexmock()
+        if owner:
+            task.should_receive('assertHost').with_args(5)
+        else:
+            task.should_receive('assertHost').and_raise(koji.ActionNotAllowed)
+        flexmock(hub.kojihub).should_receive('Task').with_args(task_id).and_return(task)
+        (flexmock(hub.kojihub)
+            .should_receive('get_upload_path')
+            .with_args(path, 'x86_64.log')
+            .and_return(fn))
+        return path, fn
+
+    def test_truncate(self, tmpdir):
+        hub = import_hub_plugin()
+        path, fn = self._upload(tmpdir, hub)
+        hub.truncateContainerUpload(path, 'x86_64.log', 4)
+        with open(fn) as f:
+            assert f.read() == '0123'
+
+    def test_task_of_other_host(self, tmpdir):
+        hub = import_hub_plugin()
+        path, fn = self._upload(tmpdir, hub, owner=False)
+        with pytest.raises(koji.ActionNotAllowed):
+            hub.truncateContainerUpload(path, 'x86_64.log', 4)
+        assert os.path.getsize(fn) == 10
+
+    @pytest.mark.parametrize('path', ('work/1234', 'tasks/1234', 'tasks/1234/foo',
+                                      'tasks/../../etc'))
+    def test_not_task_path(self, tmpdir, path):
+        hub = import_hub_plugin()
+        self._upload(tmpdir, hub)
+        with pytest.raises(koji.ActionNotAllowed):
+            hub.truncateContainerUpload(path, 'x86_64.log', 4)
+
+    def test_locked(self, tmpdir):
+        hub = import_hub_plugin()
+        path, fn = self._upload(tmpdir, hub)
+        # upload in progress in another hub process
+        locker = subprocess.Popen([sys.executable, '-c', dedent("""\
+            import fcntl, sys, time
+            fd = open(sys.argv[1], 'r+b')
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            sys.stdout.write('locked\\n')
+            sys.stdout.flush()
+            time.sleep(60)
+            """), fn], stdout=subprocess.PIPE)
+        try:
+            assert locker.stdout.readline() == 'locked\n'
+            with pytest.raises(koji.LockError):
+                hub.truncateContainerUpload(path, 'x86_64.log', 4)
+        finally:
+            locker.kill()
+            locker.wait()
+        assert os.path.getsize(fn) == 10
+
+
+class TestHubTaskStates(object):
+    def _clock(self, start=1000.0):
+        clock = [start]
+        flexmock(time).should_receive('time').replace_with(lambda: clock[0])
+        return clock
+
+    def _task(self, task_id, state, start_ts=None, completion_ts=None):
+        return {'id': task_id, 'state': koji.TASK_STATES[state], 'create_ts': 900.0,
+                'start_ts': start_ts, 'completion_ts': completion_ts}
+
+    def test_cache(self):
+        hub = import_hub_plugin()
+        clock = self._clock()
+        cache = hub.TaskStatesCache(2.0, 600.0, 100)
+        tasks = {1: self._task(1, 'OPEN', 950.0),
+                 2: self._task(2, 'CLOSED', 950.0, 990.0)}
+        fetched = []
+
+        def fetch(task_ids):
+            fetched.append(sorted(task_ids))
+            return [tasks[task_id] for task_id in task_ids if task_id in tasks]
+
+        assert sorted(cache.get_tasks([1, 2, 3], fetch)) == [1, 2]
+        assert cache.get_tasks([1, 2], fetch) == tasks
+        clock[0] += 5
+        assert cache.get_tasks([1, 2], fetch) == tasks
+        # states of finished tasks are kept longer
+        assert fetched == [[1, 2, 3], [1]]
+
+    def test_cache_size(self):
+        hub = import_hub_plugin()
+        self._clock()
+        cache = hub.TaskStatesCache(2.0, 600.0, 3)
+        fetch = lambda task_ids: [self._task(task_id, 'OPEN') for task_id in task_ids]
+        for task_id in range(10):
+            cache.get_tasks([task_id], fetch)
+            assert len(cache._tasks) <= 3
+
+    def test_changes_since(self):
+        hub = import_hub_plugin()
+        clock = self._clock()
+        flexmock(hub, _task_states_cache=hub.TaskStatesCache(2.0, 600.0, 100))
+        db_time = [1000.0]
+        flexmock(hub.kojihub).should_receive('_singleValue').replace_with(
+            lambda query, values: db_time[0])
+        tasks = {1: self._task(1, 'CLOSED', 950.0, 990.0),
+                 2: self._task(2, 'OPEN', 995.0),
+                 3: self._task(3, 'FREE')}
+        flexmock(hub).should_receive('_fetch_task_states').replace_with(
+            lambda task_ids: [tasks[task_id] for task_id in task_ids])
+
+        result = hub.getContainerTaskStates([1, 2, 3])
+        assert result['ts'] == 1000.0
+        assert [task['id'] for task in result['tasks']] == [1, 2, 3]
+
+        # nothing happens, the cursor advances anyway
+        clock[0] += 100
+        db_time[0] = 1100.0
+        result = hub.getContainerTaskStates([1, 2, 3], since=result['ts'])
+        assert result == {'ts': 1100.0, 'tasks': []}
+
+        clock[0] += 100
+        db_time[0] = 1200.0
+        tasks[2] = self._task(2, 'CLOSED', 995.0, 1150.0)
+        tasks[3] = self._task(3, 'OPEN', 1199.0)
+        result = hub.getContainerTaskStates([1, 2, 3], since=result['ts'])
+        assert result['ts'] == 1200.0
+        assert result['tasks'] == [tasks[2], tasks[3]]
+
+    def test_too_many_tasks(self):
+        hub = import_hub_plugin()
+        with pytest.raises(koji.ParameterError):
+            hub.getContainerTaskStates(range(hub.TASK_STATES_MAX_TASKS + 1))
+
+
+class TestHubFairShare(object):
+    def teardown_method(self, method):
+        import_hub_plugin().context._threadclear()
+
+    def _hub(self, usage=None, **config):
+        hub = import_hub_plugin()
+        fair_share = dict(hub.CONFIG_DEFAULTS['fair_share'], enabled=True)
+        fair_share.update(config)
+        flexmock(hub, _config={'fair_share': fair_share})
+        session = flexmock(user_data={'name': 'alice'})
+        session.should_receive('hasPerm').and_return(False)
+        hub.context.session = session
+        usage = usage or {}
+        flexmock(hub).should_receive('_get_usage').replace_with(
+            lambda kind, name, half_life: usage.get((kind, name), 0.0))
+        return hub
+
+    @pytest.mark.parametrize(('age', 'usage'), (
+        (0, 8.0),
+        (3600, 4.0),
+        (7200, 2.0),
+        # clocks of hub database servers may differ a bit
+        (-10, 8.0),
+    ))
+    def test_decay(self, age, usage):
+        hub = import_hub_plugin()
+        assert hub._decayed(8.0, age, 3600.0) == pytest.approx(usage)
+
+    def test_usage_of_new_owner(self):
+        hub = import_hub_plugin()
+        query = flexmock(executeOne=lambda: None)
+        flexmock(hub.kojihub).should_receive('QueryProcessor').and_return(query)
+        assert hub._get_usage('owner', 'alice', 3600.0) == 0
+
+    def test_usage_decays(self):
+        hub = import_hub_plugin()
+        query = flexmock(executeOne=lambda: {'usage': 10.0, 'age': 1800.0})
+        flexmock(hub.kojihub).should_receive('QueryProcessor').and_return(query)
+        assert hub._get_usage('owner', 'alice', 1800.0) == pytest.approx(5.0)
+
+    @pytest.mark.parametrize(('usage', 'penalty'), (
+        ({}, 0),
+        ({('owner', 'alice'): 19.9}, 0),
+        ({('owner', 'alice'): 40.0}, 2),
+        ({('owner', 'alice'): 20.0, ('package', 'repo'): 30.0}, 4),
+        ({('package', 'repo'): 1000.0}, 10),
+    ))
+    def test_penalty(self, usage, penalty):
+        hub = self._hub(usage)
+        assert hub.fair_share_penalty('git://example.com/repo.git#HEAD') == penalty
+
+    def test_disabled(self):
+        hub = self._hub({('owner', 'alice'): 1000.0}, enabled=False)
+        flexmock(hub).should_receive('_add_usage').never()
+        flexmock(hub.kojihub).should_receive('make_task').and_return(1)
+        assert hub.fair_share_penalty('git://example.com/repo#HEAD') == 0
+        hub.buildContainer('git://example.com/repo#HEAD', 'target')
+
+    def test_charged_after_task_is_created(self):
+        hub = self._hub({('owner', 'alice'): 40.0})
+        calls = []
+        (flexmock(hub.kojihub).should_receive('make_task')
+            .replace_with(lambda method, args, **opts: calls.append(opts) or 7))
+        flexmock(hub).should_receive('_add_usage').replace_with(
+            lambda kind, name, half_life: calls.append((kind, name)))
+        assert hub.buildContainer('git://example.com/repo#HEAD', 'target') == 7
+        assert calls == [{'priority': koji.PRIO_DEFAULT + 2, 'channel': 'container'},
+                         ('owner', 'alice'), ('package', 'repo')]
+
+    def test_not_charged_for_failed_task(self):
+        hub = self._hub()
+        flexmock(hub.kojihub).should_receive('make_task').and_raise(
+            koji.GenericError('no such channel'))
+        flexmock(hub).should_receive('_add_usage').never()
+        with pytest.raises(koji.GenericError):
+            hub.buildContainer('git://example.com/repo#HEAD', 'target')
+
+    def test_admin_high_priority(self):
+        hub = self._hub({('owner', 'alice'): 1000.0})
+        hub.context.session.should_receive('hasPerm').with_args('admin').and_return(True)
+        flexmock(hub.kojihub).should_receive('make_task').with_args(
+            'buildContainer', object, priority=koji.PRIO_DEFAULT - 5,
+            channel='container').and_return(1).once()
+        flexmock(hub).should_receive('_add_usage').never()
+        hub.buildContainer('git://example.com/repo#HEAD', 'target', priority=-5)
+
+
+class TestHubRecordBuild(object):
+    def test_record(self):
+        hub = import_hub_plugin()
+        flexmock(hub, _config={'container_builds': {'enabled': True}})
+        task = flexmock(getResult=lambda: {'component': 'fedora-docker',
+                                           'commit': 'abc123', 'koji_builds': [10]},
+                        getInfo=lambda: {'completion_time': '2020-01-01 10:00:00'})
+        flexmock(hub.kojihub).should_receive('Task').with_args(1).and_return(task)
+        flexmock(hub.kojihub).should_receive('_dml').once()
+        inserted = []
+        insert = flexmock(execute=lambda: None)
+        flexmock(hub.kojihub).should_receive('InsertProcessor').replace_with(
+            lambda table, data: inserted.append(data) or insert)
+        info = {'id': 1, 'method': 'buildContainer', 'owner': 5,
+                'request': ['git://example.com/repo#abc123', 'target', {}],
+                'completion_time': None}
+        hub.record_container_build('postTaskStateChange', attribute='state',
+                                   old=koji.TASK_STATES['OPEN'],
+                                   new=koji.TASK_STATES['CLOSED'], info=info)
+        assert inserted == [{
+            'task_id': 1, 'component': 'fedora-docker', 'target': 'target',
+            'source': 'git://example.com/repo#abc123', 'scm_commit': 'abc123',
+            'owner': 5, 'state': koji.TASK_STATES['CLOSED'], 'scratch': False,
+            'koji_build_id': 10, 'completed': '2020-01-01 10:00:00',
+        }]